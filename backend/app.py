@@ -1,20 +1,25 @@
 import os
 
 import redis
-from flask import Flask, render_template, request
+from flask import request
 from flask.typing import ResponseReturnValue
 
 from instancer import api, backend
+from instancer.assets import InstancerFlask, serve_shell
 from instancer.config import config, connect_pg
 from instancer.config import rclient as r
+from instancer.metrics import instrument
+from instancer.profiler import listen_for_profiles
 
-app = Flask(
+app = InstancerFlask(
     __name__, static_folder="static", static_url_path="/", template_folder="static"
 )
 
 
 # Serve APIs
 app.register_blueprint(api.blueprint)
+instrument(app)
+app.before_request(listen_for_profiles)
 
 
 # Serve react app
@@ -27,13 +32,12 @@ app.register_blueprint(api.blueprint)
 @app.route("/login")
 @app.route("/register")
 def react(chall_id: str = "") -> ResponseReturnValue:
-    return render_template(
-        "index.html",
-        client_conf={
+    return serve_shell(
+        {
             "rctf_mode": config.rctf_mode,
             "rctf_url": config.rctf_url,
             "recaptcha_site_key": config.recaptcha_site_key,
-        },
+        }
     )
 
 
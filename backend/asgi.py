@@ -0,0 +1,192 @@
+"""ASGI app of the async serving mode (INSTANCER_SERVING_MODE=async).
+
+Deployment status polls and event streams are served by coroutines using the async
+Redis client and Postgres pool, so thousands of clients waiting on their instances share
+one event loop per worker process. Every other request goes to the Flask app, which runs on a pool of
+INSTANCER_THREADS threads per process; deploys and other Kubernetes calls happen there
+without blocking the event loop.
+"""
+
+import os
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.types import Receive, Scope, Send
+from werkzeug.datastructures import Authorization
+from werkzeug.http import parse_etags, quote_etag
+
+from app import app as flask_app
+from instancer import aio
+from instancer.api.challenge import deployment_info, server_sent_event, too_many_streams
+from instancer.api.conditional import make_etag
+from instancer.config import config
+from instancer.events import StreamLimit
+from instancer.metrics import request_duration
+
+streams = StreamLimit(config.event_stream_max)
+"Event streams served by this process."
+
+
+def error(status: str, msg: str, code: int) -> JSONResponse:
+    return JSONResponse({"status": status, "msg": msg}, code)
+
+
+async def authenticate(request: Request) -> dict[str, Any] | JSONResponse:
+    """Return the session of the request's bearer token, or the error response the
+    Flask app would return for it."""
+
+    auth = Authorization.from_header(request.headers.get("Authorization"))
+    if auth is None:
+        return error("missing_authorization", "authentication is required", 401)
+    if auth.type != "bearer":
+        return error(
+            "unsupported_authorization_type", 'authorization type must be "Bearer"', 401
+        )
+    if auth.token is None:
+        return error("missing_token", "missing session token", 401)
+    session = await aio.get_session(auth.token)
+    if session is None:
+        return error("invalid_token", "invalid token", 401)
+    return session
+
+
+def timed(
+    rule: str, endpoint: Callable[[Request], Awaitable[Response]]
+) -> Callable[[Request], Awaitable[Response]]:
+    """Record the duration of an endpoint under the URL rule of its Flask counterpart."""
+
+    async def timed_endpoint(request: Request) -> Response:
+        start = perf_counter()
+        response = await endpoint(request)
+        if config.metrics_enabled:
+            request_duration.labels(
+                rule, request.method, str(response.status_code)
+            ).observe(perf_counter() - start)
+        return response
+
+    return timed_endpoint
+
+
+async def deployment(request: Request) -> Response:
+    """Return a team's challenge deployment info, like GET /deployment of the Flask app,
+    including its conditional request handling."""
+
+    session = await authenticate(request)
+    if isinstance(session, Response):
+        return session
+    chall = await aio.fetch_challenge(
+        request.path_params["chall_id"], session["team_id"]
+    )
+    if chall is None:
+        return error("invalid_chall_id", "invalid challenge ID", 404)
+    etag = make_etag(
+        "deployment",
+        chall.namespace,
+        *await aio.status_versions([chall.namespace]),
+    )
+    response: Response
+    if parse_etags(request.headers.get("If-None-Match")).contains(etag):
+        response = Response(status_code=304)
+    else:
+        response = JSONResponse(
+            {
+                "status": "ok",
+                "deployment": deployment_info(await aio.deployment_status(chall)),
+            }
+        )
+    response.headers["ETag"] = quote_etag(etag)
+    # every endpoint needs a session token, so shared caches must not store responses
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+class EventStream(StreamingResponse):
+    """A server-sent event stream that gives back its slot in `streams` when it ends."""
+
+    def __init__(self, content: AsyncIterator[str]):
+        super().__init__(
+            content,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            streams.release()
+
+
+async def deployment_events(request: Request) -> Response:
+    """Stream a team's challenge deployment progress as server-sent events, like
+    GET /deployment/events of the Flask app."""
+
+    session = await authenticate(request)
+    if isinstance(session, Response):
+        return session
+    chall = await aio.fetch_challenge(
+        request.path_params["chall_id"], session["team_id"]
+    )
+    if chall is None:
+        return error("invalid_chall_id", "invalid challenge ID", 404)
+    if not streams.acquire():
+        body, code, headers = too_many_streams()
+        return JSONResponse(body, code, headers)
+
+    async def deployment() -> dict[str, Any] | None:
+        return deployment_info(await aio.deployment_status(chall))
+
+    async def stream() -> AsyncIterator[str]:
+        events = aio.listen(
+            chall.namespace, keepalive=15, duration=config.event_stream_duration
+        )
+        try:
+            # wait for the subscription before taking a snapshot so no event is missed
+            await anext(events)
+            yield "retry: 3000\n\n"
+            yield server_sent_event(
+                "status",
+                {
+                    "last_event": await aio.last_event(chall.namespace),
+                    "deployment": await deployment(),
+                },
+            )
+            async for event in events:
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield server_sent_event(
+                        event["phase"], {**event, "deployment": await deployment()}
+                    )
+        finally:
+            await events.aclose()
+
+    return EventStream(stream())
+
+
+app = Starlette(
+    routes=[
+        Route(
+            "/api/challenge/{chall_id}/deployment",
+            timed("/api/challenge/<chall_id>/deployment", deployment),
+            methods=["GET"],
+        ),
+        Route(
+            "/api/challenge/{chall_id}/deployment/events",
+            timed("/api/challenge/<chall_id>/deployment/events", deployment_events),
+            methods=["GET"],
+        ),
+        Mount(
+            "/",
+            app=WSGIMiddleware(
+                flask_app,  # type: ignore[arg-type]
+                workers=int(os.environ.get("INSTANCER_THREADS", "16")),
+            ),
+        ),
+    ]
+)
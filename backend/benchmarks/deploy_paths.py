@@ -0,0 +1,204 @@
+"""Benchmark the deploy paths of the instancer without a cluster.
+
+Starts instances with Challenge.start, reads their status with
+Challenge.deployment_status (first uncached, then cached), runs the worker's resync
+and stops the instances with Challenge.stop_namespace, all in-process against a fake
+Kubernetes API server (see fake_kube.py). Reports the throughput and latency of each
+step and the Kubernetes calls and Redis commands each operation of it took.
+
+Instance state is written to the Redis from config.yml (or the INSTANCER_* environment
+variables), so use a local Redis that nothing else uses. Postgres isn't needed.
+
+Run from the backend directory:
+
+    python benchmarks/deploy_paths.py --instances 200 --concurrency 16 --kube-latency 0.005
+
+The fake server can also keep deleted namespaces Terminating and inject failures,
+such as --error create:services:0.01 to fail 1% of service creations.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_kube import ErrorRule, FakeKube
+from load_test import redis_ops
+from serving_modes import LoadResult
+
+T = TypeVar("T")
+
+CHALLENGE_ID = "bench-deploy"
+"ID of the challenge the benchmark starts instances of."
+CHALLENGE_CONFIG: dict[str, Any] = {
+    "containers": {
+        "web": {"image": "nginx:alpine", "ports": [80]},
+        "nc": {"image": "busybox", "ports": [1337]},
+    },
+    "http": {"web": [[80, "web"]]},
+    "tcp": {"nc": [1337]},
+}
+"Config of the benchmark challenge: one HTTP and one TCP container."
+
+
+def run_ops(func: Callable[[T], Any], items: list[T], concurrency: int) -> LoadResult:
+    """Call `func` on every item from `concurrency` threads and time each call."""
+
+    result = LoadResult()
+
+    def timed(item: T) -> float | None:
+        start = time.perf_counter()
+        try:
+            func(item)
+        except Exception as e:
+            print(f"error: {type(e).__name__}: {e}", file=sys.stderr)
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for took in executor.map(timed, items):
+            if took is None:
+                result.errors += 1
+            else:
+                result.latencies.append(took)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark starting, checking and stopping instances against a fake Kubernetes API server."
+    )
+    parser.add_argument("--instances", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--resyncs", type=int, default=3)
+    parser.add_argument(
+        "--isolation",
+        choices=["namespace", "labels"],
+        default="namespace",
+        help="give every instance a namespace or share one namespace between them",
+    )
+    parser.add_argument(
+        "--kube-latency",
+        type=float,
+        default=0,
+        help="seconds every call to the fake Kubernetes API server takes",
+    )
+    parser.add_argument(
+        "--termination-delay",
+        type=float,
+        default=0,
+        help="seconds deleted namespaces stay Terminating",
+    )
+    parser.add_argument(
+        "--error",
+        action="append",
+        default=[],
+        type=ErrorRule.parse,
+        help="fail Kubernetes calls as verb:resource:rate[:code], may be given multiple times",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--calls", action="store_true", help="show the Kubernetes calls of every step"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kube = FakeKube(
+            latency=args.kube_latency,
+            termination_delay=args.termination_delay,
+            errors=args.error,
+            seed=args.seed,
+        )
+        kube_server = kube.serve()
+        kubeconfig = os.path.join(tmp, "kubeconfig")
+        kube_server.write_kubeconfig(kubeconfig)
+        # the instancer modules load the kubeconfig when they are imported
+        os.environ["KUBECONFIG"] = kubeconfig
+        os.environ["INSTANCER_IN_CLUSTER"] = "false"
+
+        import worker
+        from instancer.backend import kclient  # type: ignore[attr-defined]
+        from instancer.backend import (
+            Challenge,
+            _cache_chall_info,
+            _ChallengeInfo,
+            _make_challenge,
+            kapi,
+        )
+        from instancer.config import rclient
+
+        cfg = dict(CHALLENGE_CONFIG)
+        if args.isolation == "labels":
+            cfg = {**cfg, "containers": {"web": cfg["containers"]["web"]}}
+            cfg.pop("tcp")
+            cfg["isolation"] = "labels"
+        info = _ChallengeInfo(
+            cfg=cfg,
+            per_team=True,
+            lifetime=3600,
+            boot_time=0,
+            name="Benchmark",
+            description="Challenge deployed by the deploy path benchmark.",
+            author="benchmarks",
+        )
+        # the worker looks the challenge up, so keep it cached instead of in Postgres
+        _cache_chall_info(CHALLENGE_ID, info)
+        challs = [
+            _make_challenge(CHALLENGE_ID, info, str(uuid.uuid4()))
+            for _ in range(args.instances)
+        ]
+        capi = kclient.CoreV1Api(kapi)
+        api = kclient.AppsV1Api(kapi)
+
+        def step(
+            name: str, func: Callable[[T], Any], items: list[T], concurrency: int
+        ) -> None:
+            calls_before = dict(kube.calls)
+            redis_before = redis_ops()
+            result = run_ops(func, items, concurrency)
+            kube_calls = {
+                call: count - calls_before.get(call, 0)
+                for call, count in kube.calls.items()
+                if count != calls_before.get(call, 0)
+            }
+            # the first reading itself takes one command
+            redis_count = redis_ops() - redis_before - 1
+            print(
+                f"{name:>14}: {result.summary()}  "
+                f"kube {sum(kube_calls.values()) / len(items):6.1f}/op  "
+                f"redis {redis_count / len(items):6.1f}/op",
+                flush=True,
+            )
+            if args.calls:
+                print(f"{'':>16}{json.dumps(kube_calls, sort_keys=True)}")
+
+        def clear_status_cache() -> None:
+            rclient.delete(*(f"ports:{chall.namespace}" for chall in challs))
+
+        try:
+            step("start", lambda chall: chall.start(), challs, args.concurrency)
+            clear_status_cache()
+            status = lambda chall: chall.deployment_status()
+            step("status (cold)", status, challs, args.concurrency)
+            step("status (cached)", status, challs, args.concurrency)
+            # the worker runs one resync at a time
+            step("resync", lambda _: worker.resync(capi, api), [None] * args.resyncs, 1)
+            stop = lambda chall: Challenge.stop_namespace(chall.namespace)
+            step("stop", stop, challs, args.concurrency)
+        finally:
+            rclient.delete(f"chall:{CHALLENGE_ID}")
+            kube_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
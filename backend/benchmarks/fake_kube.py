@@ -0,0 +1,550 @@
+"""A fake Kubernetes API server for benchmarks.
+
+Keeps objects in memory and implements the parts of the API the instancer uses:
+namespaces, deployments, services, pods, nodes, network policies, autoscalers and
+Traefik ingress routes, with label selectors, collection deletes and NodePort
+allocation. Objects aren't reconciled, so deployments never create pods.
+
+To make benchmarks behave like a real cluster, every call can be delayed, deleted
+namespaces can stay Terminating for a while and calls can be made to fail at a given
+rate. Failures are drawn from a seeded random generator so runs are repeatable.
+
+Start it in-process and point the instancer at it with a kubeconfig:
+
+    server = FakeKube(latency=0.01, termination_delay=5).serve()
+    server.write_kubeconfig("/tmp/fake-kube.yaml")
+    os.environ["KUBECONFIG"] = "/tmp/fake-kube.yaml"
+
+or run it on its own to point a local API server or worker at it:
+
+    python benchmarks/fake_kube.py --port 8001 --kubeconfig /tmp/fake-kube.yaml \
+        --latency 0.01 --error create:services:0.05:500
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+KINDS = {
+    "namespaces": "Namespace",
+    "nodes": "Node",
+    "pods": "Pod",
+    "services": "Service",
+    "deployments": "Deployment",
+    "daemonsets": "DaemonSet",
+    "horizontalpodautoscalers": "HorizontalPodAutoscaler",
+    "networkpolicies": "NetworkPolicy",
+    "ingressroutes": "IngressRoute",
+    "ingressroutetcps": "IngressRouteTCP",
+}
+"Kinds of the resources the fake server knows, by plural name."
+CLUSTER_SCOPED = {"namespaces", "nodes"}
+"Resources that don't belong to a namespace."
+VERBS = {
+    ("GET", True): "list",
+    ("POST", True): "create",
+    ("DELETE", True): "deletecollection",
+    ("GET", False): "get",
+    ("PUT", False): "update",
+    ("PATCH", False): "patch",
+    ("DELETE", False): "delete",
+}
+"Kubernetes API verbs by HTTP method and whether a collection is addressed."
+
+
+class ApiError(Exception):
+    """An error response of the fake server."""
+
+    def __init__(self, code: int, reason: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "kind": "Status",
+            "apiVersion": "v1",
+            "metadata": {},
+            "status": "Failure",
+            "message": self.message,
+            "reason": self.reason,
+            "code": self.code,
+        }
+
+
+@dataclass
+class ErrorRule:
+    """Makes calls fail at a given rate."""
+
+    verb: str | None
+    "The verb of the calls to fail, such as create, or None for every verb."
+    resource: str | None
+    "The resource of the calls to fail, such as services, or None for every resource."
+    rate: float
+    "The fraction of matching calls that fail."
+    code: int = 500
+    "The status code of the failures."
+
+    @classmethod
+    def parse(cls, spec: str) -> "ErrorRule":
+        """Parse a rule written as verb:resource:rate[:code], where an empty or *
+        verb or resource matches everything."""
+
+        verb, resource, rate, *code = spec.split(":")
+        return cls(
+            verb=None if verb in ("", "*") else verb,
+            resource=None if resource in ("", "*") else resource,
+            rate=float(rate),
+            code=int(code[0]) if code else 500,
+        )
+
+    def matches(self, verb: str, resource: str) -> bool:
+        return self.verb in (None, verb) and self.resource in (None, resource)
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def matches(labels: dict[str, str], selector: str | None) -> bool:
+    """Check labels against a label selector of `key=value` and `key` terms."""
+
+    if not selector:
+        return True
+    for term in selector.split(","):
+        key, _, value = term.partition("=")
+        if key not in labels or (value and labels[key] != value):
+            return False
+    return True
+
+
+def merge(target: dict[str, Any], patch: dict[str, Any]) -> None:
+    """Apply a JSON merge patch to `target` in place."""
+
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class FakeKube:
+    """In-memory state of the fake API server."""
+
+    def __init__(
+        self,
+        node_ports: range = range(30000, 32768),
+        latency: float = 0,
+        latencies: dict[str, float] | None = None,
+        termination_delay: float = 0,
+        errors: list[ErrorRule] | None = None,
+        seed: int = 0,
+    ):
+        """Create an empty cluster with one node.
+
+        `latency` is the number of seconds every call takes, and `latencies` overrides
+        it for calls given as verb and resource, such as `{"delete namespaces": 0.5}`.
+        Deleted namespaces stay Terminating for `termination_delay` seconds. `errors`
+        make calls fail, drawing from a random generator seeded with `seed`."""
+
+        self.lock = threading.Lock()
+        # (api prefix, resource, namespace or "") -> name -> object
+        self.objects: dict[tuple[str, str, str], dict[str, dict[str, Any]]] = {}
+        self.resource_version = 0
+        self.free_node_ports = list(node_ports)
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.termination_delay = termination_delay
+        self.errors = errors or []
+        self.random = random.Random(seed)
+        # namespace -> time its termination finishes
+        self.terminating: dict[str, float] = {}
+        self.calls: dict[str, int] = {}
+        "Number of calls to the server by verb and resource, such as `create services`."
+        self.add_node("fake-node", cpu="64", memory="256Gi")
+
+    def add_node(self, name: str, cpu: str, memory: str) -> None:
+        """Add a ready node with the given allocatable resources."""
+
+        self._store("/api/v1", "nodes", "")[name] = {
+            "apiVersion": "v1",
+            "kind": "Node",
+            "metadata": self._metadata({"name": name}, ""),
+            "spec": {"podCIDR": "10.244.0.0/24"},
+            "status": {
+                "allocatable": {"cpu": cpu, "memory": memory},
+                "conditions": [{"type": "Ready", "status": "True"}],
+            },
+        }
+
+    def _store(
+        self, prefix: str, resource: str, namespace: str
+    ) -> dict[str, dict[str, Any]]:
+        return self.objects.setdefault((prefix, resource, namespace), {})
+
+    def _metadata(self, metadata: dict[str, Any], namespace: str) -> dict[str, Any]:
+        self.resource_version += 1
+        return {
+            **metadata,
+            **({"namespace": namespace} if namespace else {}),
+            "uid": str(uuid.uuid4()),
+            "resourceVersion": str(self.resource_version),
+            "creationTimestamp": now(),
+            "labels": metadata.get("labels") or {},
+            "annotations": metadata.get("annotations") or {},
+        }
+
+    def _namespace_exists(self, namespace: str) -> None:
+        if namespace not in self._store("/api/v1", "namespaces", ""):
+            raise ApiError(404, "NotFound", f'namespaces "{namespace}" not found')
+
+    def _allocate_node_ports(self, obj: dict[str, Any]) -> None:
+        spec = obj.setdefault("spec", {})
+        if spec.get("type") != "NodePort":
+            return
+        for port in spec.get("ports", []):
+            if port.get("nodePort") is None:
+                if len(self.free_node_ports) == 0:
+                    raise ApiError(
+                        500,
+                        "InternalError",
+                        "failed to allocate a nodePort: range is full",
+                    )
+                port["nodePort"] = self.free_node_ports.pop(0)
+
+    def _release(self, resource: str, obj: dict[str, Any]) -> None:
+        if resource == "services":
+            for port in obj.get("spec", {}).get("ports", []):
+                if port.get("nodePort") is not None:
+                    self.free_node_ports.append(port["nodePort"])
+
+    def create(
+        self, prefix: str, resource: str, namespace: str, obj: dict[str, Any]
+    ) -> dict[str, Any]:
+        name = obj.get("metadata", {}).get("name")
+        if not name:
+            raise ApiError(422, "Invalid", "metadata.name: Required value")
+        if namespace:
+            self._namespace_exists(namespace)
+            if namespace in self.terminating:
+                raise ApiError(
+                    403,
+                    "Forbidden",
+                    f"unable to create new content in namespace {namespace} because it is being terminated",
+                )
+        store = self._store(prefix, resource, namespace)
+        if name in store:
+            raise ApiError(409, "AlreadyExists", f'{resource} "{name}" already exists')
+        if resource == "services":
+            self._allocate_node_ports(obj)
+        obj["metadata"] = self._metadata(obj["metadata"], namespace)
+        if resource == "namespaces":
+            obj["status"] = {"phase": "Active"}
+        store[name] = obj
+        return obj
+
+    def get(
+        self, prefix: str, resource: str, namespace: str, name: str
+    ) -> dict[str, Any]:
+        store = self._store(prefix, resource, namespace)
+        if name not in store:
+            raise ApiError(404, "NotFound", f'{resource} "{name}" not found')
+        return store[name]
+
+    def list(
+        self, prefix: str, resource: str, namespace: str | None, selector: str | None
+    ) -> dict[str, Any]:
+        items = [
+            obj
+            for (p, r, ns), store in self.objects.items()
+            if p == prefix and r == resource and namespace in (None, ns)
+            for obj in store.values()
+            if matches(obj["metadata"].get("labels") or {}, selector)
+        ]
+        return {
+            "apiVersion": prefix.removeprefix("/apis/").removeprefix("/api/"),
+            "kind": KINDS.get(resource, "Object") + "List",
+            "metadata": {"resourceVersion": str(self.resource_version)},
+            "items": items,
+        }
+
+    def replace(
+        self,
+        prefix: str,
+        resource: str,
+        namespace: str,
+        name: str,
+        obj: dict[str, Any],
+    ) -> dict[str, Any]:
+        old = self.get(prefix, resource, namespace, name)
+        self.resource_version += 1
+        obj["metadata"] = {
+            **obj.get("metadata", {}),
+            "uid": old["metadata"]["uid"],
+            "creationTimestamp": old["metadata"]["creationTimestamp"],
+            "resourceVersion": str(self.resource_version),
+        }
+        if "status" not in obj and "status" in old:
+            obj["status"] = old["status"]
+        self._store(prefix, resource, namespace)[name] = obj
+        return obj
+
+    def patch(
+        self,
+        prefix: str,
+        resource: str,
+        namespace: str,
+        name: str,
+        patch: dict[str, Any],
+    ) -> dict[str, Any]:
+        obj = self.get(prefix, resource, namespace, name)
+        merge(obj, patch)
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        return obj
+
+    def delete(
+        self, prefix: str, resource: str, namespace: str, name: str
+    ) -> dict[str, Any]:
+        obj = self.get(prefix, resource, namespace, name)
+        if resource == "namespaces":
+            if name not in self.terminating:
+                if self.termination_delay <= 0:
+                    self._remove_namespace(name)
+                    return obj
+                obj["metadata"]["deletionTimestamp"] = now()
+                obj["status"] = {"phase": "Terminating"}
+                self.terminating[name] = time.monotonic() + self.termination_delay
+            return obj
+        del self._store(prefix, resource, namespace)[name]
+        self._release(resource, obj)
+        return obj
+
+    def _remove_namespace(self, name: str) -> None:
+        """Remove a namespace and everything in it."""
+
+        del self._store("/api/v1", "namespaces", "")[name]
+        self.terminating.pop(name, None)
+        for (p, r, ns), store in list(self.objects.items()):
+            if ns == name:
+                for child in store.values():
+                    self._release(r, child)
+                del self.objects[p, r, ns]
+
+    def _finish_terminations(self) -> None:
+        """Remove the Terminating namespaces whose termination delay passed."""
+
+        curtime = time.monotonic()
+        for name, done in list(self.terminating.items()):
+            if done <= curtime:
+                self._remove_namespace(name)
+
+    def delete_collection(
+        self, prefix: str, resource: str, namespace: str, selector: str | None
+    ) -> dict[str, Any]:
+        store = self._store(prefix, resource, namespace)
+        for name, obj in list(store.items()):
+            if matches(obj["metadata"].get("labels") or {}, selector):
+                del store[name]
+                self._release(resource, obj)
+        return {"kind": "Status", "apiVersion": "v1", "status": "Success"}
+
+    def handle(
+        self, method: str, path: str, query: dict[str, str], body: Any
+    ) -> tuple[int, Any]:
+        """Serve an API request. Returns the status code and the response body."""
+
+        # /api/v1/... or /apis/<group>/<version>/...
+        parts = path.strip("/").split("/")
+        split = 2 if parts[0] == "api" else 3
+        prefix = "/" + "/".join(parts[:split])
+        rest = parts[split:]
+        # None lists across all namespaces, "" is used for cluster-scoped resources
+        namespace: str | None = None
+        if len(rest) >= 3 and rest[0] == "namespaces":
+            namespace = rest[1]
+            rest = rest[2:]
+        if len(rest) == 0 or len(rest) > 2:
+            raise ApiError(404, "NotFound", f"unknown path {path}")
+        resource = rest[0]
+        name = rest[1] if len(rest) == 2 else None
+        if resource in CLUSTER_SCOPED:
+            namespace = ""
+        selector = query.get("labelSelector")
+
+        if (method, name is None) not in VERBS:
+            raise ApiError(
+                405, "MethodNotAllowed", f"{method} is not supported on {path}"
+            )
+        verb = VERBS[method, name is None]
+        if verb == "list" and query.get("watch") in ("true", "1"):
+            verb = "watch"
+        call = f"{verb} {resource}"
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+            failed = next(
+                (
+                    rule
+                    for rule in self.errors
+                    if rule.matches(verb, resource) and self.random.random() < rule.rate
+                ),
+                None,
+            )
+        delay = self.latencies.get(call, self.latency)
+        if delay > 0:
+            time.sleep(delay)
+        if failed is not None:
+            raise ApiError(failed.code, "InternalError", f"injected failure of {call}")
+
+        with self.lock:
+            self._finish_terminations()
+            ns = namespace or ""
+            if verb == "watch":
+                return 200, None
+            if verb == "list":
+                return 200, self.list(prefix, resource, namespace, selector)
+            if verb == "create":
+                return 201, self.create(prefix, resource, ns, body)
+            if verb == "deletecollection":
+                return 200, self.delete_collection(prefix, resource, ns, selector)
+            assert name is not None
+            if verb == "get":
+                return 200, self.get(prefix, resource, ns, name)
+            if verb == "update":
+                return 200, self.replace(prefix, resource, ns, name, body)
+            if verb == "patch":
+                return 200, self.patch(prefix, resource, ns, name, body)
+            return 200, self.delete(prefix, resource, ns, name)
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> "FakeKubeServer":
+        """Serve the API on a background thread. Port 0 picks a free port."""
+
+        server = FakeKubeServer(self, (host, port))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class FakeKubeServer(ThreadingHTTPServer):
+    """HTTP server of a FakeKube."""
+
+    daemon_threads = True
+
+    def __init__(self, kube: FakeKube, address: tuple[str, int]):
+        super().__init__(address, _Handler)
+        self.kube = kube
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def write_kubeconfig(self, path: str) -> None:
+        """Write a kubeconfig that points at this server."""
+
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "apiVersion": "v1",
+                    "kind": "Config",
+                    "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+                    "users": [{"name": "fake", "user": {"token": "fake"}}],
+                    "contexts": [
+                        {"name": "fake", "context": {"cluster": "fake", "user": "fake"}}
+                    ],
+                    "current-context": "fake",
+                },
+                f,
+            )
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, which Nagle's algorithm would delay
+    disable_nagle_algorithm = True
+    server: FakeKubeServer
+
+    def _respond(self, code: int, body: Any) -> None:
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self) -> None:
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length > 0 else None
+        try:
+            code, response = self.server.kube.handle(
+                self.command, url.path, query, body
+            )
+        except ApiError as e:
+            self._respond(e.code, e.status())
+            return
+        if query.get("watch") in ("true", "1"):
+            # nothing changes on its own, so watches just time out
+            time.sleep(min(int(query.get("timeoutSeconds", 1)), 1))
+        self._respond(code, response)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a fake Kubernetes API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--kubeconfig", help="write a kubeconfig pointing at the server to this file"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds every call takes"
+    )
+    parser.add_argument(
+        "--termination-delay",
+        type=float,
+        default=0,
+        help="seconds deleted namespaces stay Terminating",
+    )
+    parser.add_argument(
+        "--error",
+        action="append",
+        default=[],
+        type=ErrorRule.parse,
+        help="fail calls as verb:resource:rate[:code], may be given multiple times",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--node-ports", type=int, default=2768)
+    args = parser.parse_args()
+
+    kube = FakeKube(
+        node_ports=range(30000, 30000 + args.node_ports),
+        latency=args.latency,
+        termination_delay=args.termination_delay,
+        errors=args.error,
+        seed=args.seed,
+    )
+    server = FakeKubeServer(kube, (args.host, args.port))
+    if args.kubeconfig:
+        server.write_kubeconfig(args.kubeconfig)
+    print(f"Serving a fake Kubernetes API at {server.url}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""End-to-end load test of the instancer API.
+
+Simulates teams that log in with their login URLs, list challenges, deploy a per-team
+challenge, poll its status and terminate it. Every scenario runs for all teams at once
+and is reported with its throughput, latency percentiles and the Redis commands and
+Postgres transactions it needed per request.
+
+The app runs under gunicorn against the Redis and Postgres from config.yml (or the
+INSTANCER_* environment variables) and a fake Kubernetes API server (see fake_kube.py),
+so no cluster is needed. Use local, otherwise idle Redis and Postgres instances since
+the operation counts include everything else using them, and a config without a
+reCAPTCHA secret. The challenges the benchmark creates have IDs starting with bench-.
+
+Run from the backend directory:
+
+    python benchmarks/load_test.py --teams 50
+
+Baselines are recorded on a reference machine with --save-baseline and committed
+under benchmarks/baselines/. Later runs with --baseline exit with an error if a
+scenario needs more Redis commands or Postgres transactions per request than the
+baseline, or if its p99 latency or throughput got worse by more than --tolerance:
+
+    python benchmarks/load_test.py --save-baseline benchmarks/baselines/ci.json
+    python benchmarks/load_test.py --baseline benchmarks/baselines/ci.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_kube import FakeKube
+from serving_modes import LoadResult, free_port, wait_for_server
+
+CHALLENGE_ID = "bench-web"
+"ID of the per-team challenge the teams deploy."
+CHALLENGE_CONFIG = {
+    "containers": {
+        "web": {"image": "nginx:alpine", "ports": [80]},
+        "nc": {"image": "busybox", "ports": [1337]},
+    },
+    "http": {"web": [[80, "web"]]},
+    "tcp": {"nc": [1337]},
+}
+"Config of the benchmark challenge: one HTTP and one TCP container."
+OPS_TOLERANCE = 0.5
+"Increase in Redis commands or Postgres transactions per request that counts as a regression."
+
+
+@dataclass
+class Call:
+    """One API request of a scenario."""
+
+    method: str
+    path: str
+    headers: dict[str, str] = field(default_factory=dict)
+    data: dict[str, str] | None = None
+
+
+@dataclass
+class ScenarioResult:
+    """Results of a scenario."""
+
+    load: LoadResult
+    "Throughput and latency of the requests."
+    redis_ops: float
+    "Redis commands per request."
+    pg_xacts: float
+    "Postgres transactions per request."
+
+    def summary(self) -> str:
+        return (
+            f"{self.load.summary()}  "
+            f"redis {self.redis_ops:6.1f}/req  postgres {self.pg_xacts:5.2f}/req"
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "requests": len(self.load.latencies) + self.load.errors,
+            "errors": self.load.errors,
+            "throughput": self.load.throughput(),
+            "p50": self.load.percentile(50),
+            "p99": self.load.percentile(99),
+            "redis_ops": self.redis_ops,
+            "pg_xacts": self.pg_xacts,
+        }
+
+
+def run_calls(
+    base_url: str, calls: list[Call], concurrency: int
+) -> tuple[LoadResult, list[Any]]:
+    """Send every call from `concurrency` client threads.
+
+    Returns the load result and the JSON body of each response, or None for requests
+    that failed."""
+
+    result = LoadResult()
+    bodies: list[Any] = [None] * len(calls)
+    lock = threading.Lock()
+    counter = iter(range(len(calls)))
+
+    def client() -> None:
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            call = calls[i]
+            start = time.perf_counter()
+            try:
+                res = session.request(
+                    call.method,
+                    base_url + call.path,
+                    headers=call.headers,
+                    data=call.data,
+                    timeout=60,
+                )
+                ok = res.ok
+                if ok:
+                    bodies[i] = res.json()
+            except (requests.RequestException, ValueError):
+                ok = False
+            took = time.perf_counter() - start
+            with lock:
+                if ok:
+                    result.latencies.append(took)
+                else:
+                    result.errors += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result.elapsed = time.perf_counter() - start
+    return result, bodies
+
+
+def redis_ops() -> int:
+    """Return the number of commands the Redis server has run."""
+
+    from instancer.config import rclient
+
+    stats = rclient.info("commandstats")
+    return sum(int(stat["calls"]) for stat in stats.values())
+
+
+def pg_xacts(stats_delay: float) -> int:
+    """Return the number of transactions the Postgres database has run.
+
+    Backends report their statistics with a delay, so this waits `stats_delay` seconds
+    before reading them."""
+
+    from instancer.config import connect_pg
+
+    time.sleep(stats_delay)
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_stat_clear_snapshot()")
+            cur.execute(
+                "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()"
+            )
+            row = cur.fetchone()
+    assert row is not None
+    return int(row[0])
+
+
+def login_call(team_id: str) -> Call:
+    """Log in the way the frontend does when a team opens its login URL."""
+
+    from instancer.api.account import LoginToken
+
+    url = LoginToken(team_id).get_login_url()
+    token = parse_qs(urlparse(url).query)["token"][0]
+    return Call("POST", "/api/accounts/login", data={"login_token": token})
+
+
+def start_app(
+    args: argparse.Namespace, kubeconfig: str
+) -> tuple[subprocess.Popen[bytes], str]:
+    port = free_port()
+    env = {
+        **os.environ,
+        "KUBECONFIG": kubeconfig,
+        "INSTANCER_IN_CLUSTER": "false",
+        "INSTANCER_SERVING_MODE": args.mode,
+        "INSTANCER_WORKERS": str(args.workers),
+        "INSTANCER_THREADS": str(args.threads),
+        # every team deploys once per run, the limits would only add noise
+        "INSTANCER_TEAM_DEPLOY_BURST": "1000000",
+        "INSTANCER_CHALLENGE_DEPLOY_BURST": "1000000",
+        "INSTANCER_CHALLENGE_DEPLOY_PER_MINUTE": "1000000",
+    }
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-c",
+            "gunicorn.conf.py",
+            "--bind",
+            f"127.0.0.1:{port}",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    wait_for_server(base_url)
+    return server, base_url
+
+
+def create_challenge(base_url: str, admin_headers: dict[str, str]) -> None:
+    res = requests.post(
+        base_url + "/api/admin/challenges/create",
+        headers=admin_headers,
+        data={
+            "chall_id": CHALLENGE_ID,
+            "per_team": "true",
+            "cfg": json.dumps(CHALLENGE_CONFIG),
+            "lifetime": "3600",
+            "boot_time": "0",
+            "name": "Benchmark",
+            "description": "Challenge deployed by the load test.",
+            "author": "benchmarks",
+            "categories": "bench",
+            "tags": "",
+            "replace_existing": "true",
+        },
+        timeout=60,
+    )
+    res.raise_for_status()
+
+
+def compare(
+    results: dict[str, dict[str, Any]], baseline: dict[str, Any], tolerance: float
+) -> list[str]:
+    """Return the regressions of the results compared to a baseline."""
+
+    regressions = []
+    for name, base in baseline["scenarios"].items():
+        if name not in results:
+            continue
+        cur = results[name]
+        for ops in ("redis_ops", "pg_xacts"):
+            if cur[ops] > base[ops] + OPS_TOLERANCE:
+                regressions.append(
+                    f"{name}: {ops} per request went from {base[ops]:.2f} to {cur[ops]:.2f}"
+                )
+        if cur["p99"] > base["p99"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p99 went from {base['p99'] * 1000:.1f} ms to {cur['p99'] * 1000:.1f} ms"
+            )
+        if cur["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput went from {base['throughput']:.1f} to {cur['throughput']:.1f} req/s"
+            )
+        if cur["errors"] > base["errors"]:
+            regressions.append(
+                f"{name}: errors went from {base['errors']} to {cur['errors']}"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load test the instancer API with simulated teams."
+    )
+    parser.add_argument("--teams", type=int, default=50)
+    parser.add_argument(
+        "--polls", type=int, default=10, help="status polls and listings per team"
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--mode", default="threaded", help="serving mode: sync, threaded or async"
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument(
+        "--kube-latency",
+        type=float,
+        default=0,
+        help="seconds every call to the fake Kubernetes API server takes",
+    )
+    parser.add_argument(
+        "--stats-delay",
+        type=float,
+        default=11,
+        help="seconds to wait for Postgres to publish its statistics after a scenario",
+    )
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare the results to this file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed fraction of p99 latency and throughput regression",
+    )
+    parser.add_argument("--verbose", action="store_true", help="show the app's logs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kube_server = FakeKube(latency=args.kube_latency).serve()
+        kubeconfig = os.path.join(tmp, "kubeconfig")
+        kube_server.write_kubeconfig(kubeconfig)
+        # the instancer modules load the kubeconfig when they are imported
+        os.environ["KUBECONFIG"] = kubeconfig
+        os.environ["INSTANCER_IN_CLUSTER"] = "false"
+
+        from instancer.config import config
+
+        if config.recaptcha_secret is not None:
+            sys.exit("The load test needs a config without a reCAPTCHA secret.")
+
+        server, base_url = start_app(args, kubeconfig)
+        try:
+            _, (admin_login,) = run_calls(
+                base_url, [login_call(str(config.admin_team_id))], 1
+            )
+            if admin_login is None:
+                sys.exit("Could not log in as the admin team.")
+            create_challenge(
+                base_url, {"Authorization": f"Bearer {admin_login['token']}"}
+            )
+
+            results: dict[str, dict[str, Any]] = {}
+
+            def measure(name: str, calls: list[Call]) -> list[Any]:
+                redis_before = redis_ops()
+                pg_before = pg_xacts(args.stats_delay)
+                load, bodies = run_calls(base_url, calls, args.concurrency)
+                # the first reading itself takes one command and one transaction
+                result = ScenarioResult(
+                    load,
+                    (redis_ops() - redis_before - 1) / len(calls),
+                    (pg_xacts(args.stats_delay) - pg_before - 1) / len(calls),
+                )
+                print(f"{name:>10}: {result.summary()}", flush=True)
+                results[name] = result.to_json()
+                return bodies
+
+            logins = measure(
+                "login",
+                [login_call(str(uuid.uuid4())) for _ in range(args.teams)],
+            )
+            teams = [
+                {"Authorization": f"Bearer {body['token']}"}
+                for body in logins
+                if body is not None
+            ]
+            if len(teams) == 0:
+                sys.exit("No team could log in.")
+            chall = f"/api/challenge/{CHALLENGE_ID}"
+            polls = [headers for _ in range(args.polls) for headers in teams]
+            measure("list", [Call("GET", "/api/challenges", h) for h in polls])
+            measure("deploy", [Call("POST", chall + "/deploy", h) for h in teams])
+            measure("status", [Call("GET", chall + "/deployment", h) for h in polls])
+            measure(
+                "terminate", [Call("DELETE", chall + "/deployment", h) for h in teams]
+            )
+        finally:
+            server.terminate()
+            server.wait()
+            kube_server.shutdown()
+
+    settings = {
+        "teams": args.teams,
+        "polls": args.polls,
+        "concurrency": args.concurrency,
+        "mode": args.mode,
+        "workers": args.workers,
+        "threads": args.threads,
+        "kube_latency": args.kube_latency,
+    }
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump({"settings": settings, "scenarios": results}, f, indent=2)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != settings:
+            print(
+                f"warning: the baseline was recorded with different settings {baseline['settings']}"
+            )
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Compare the serving modes of the instancer API.
+
+Starts the app under gunicorn once per serving mode (see gunicorn.conf.py) and runs the
+same teams through each one: every team deploys a per-team challenge, polls its status
+and terminates it. Reports the throughput and latency percentiles of each step.
+
+Like load_test.py, the app runs against the Redis and Postgres from config.yml (or the
+INSTANCER_* environment variables) and a fake Kubernetes API server (see fake_kube.py),
+so no cluster is needed. --kube-latency makes every Kubernetes call slower, which shows
+how much the modes hold up status polls while deploys wait on the Kubernetes API.
+
+Run from the backend directory:
+
+    python benchmarks/serving_modes.py --teams 100 --concurrency 64 --kube-latency 0.05
+"""
+
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from threading import Thread
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@dataclass
+class LoadResult:
+    """Results of a load run."""
+
+    latencies: list[float] = field(default_factory=list)
+    "Latency of every successful request, in seconds."
+    errors: int = 0
+    "Number of failed requests."
+    elapsed: float = 0
+    "Wall clock time of the whole run, in seconds."
+
+    def percentile(self, p: float) -> float:
+        if len(self.latencies) == 0:
+            return 0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed > 0 else 0
+
+    def summary(self) -> str:
+        return (
+            f"{self.throughput():8.1f} req/s  "
+            f"p50 {self.percentile(50) * 1000:7.1f} ms  "
+            f"p99 {self.percentile(99) * 1000:7.1f} ms  "
+            f"errors {self.errors}"
+        )
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port: int = s.getsockname()[1]
+        return port
+
+
+def wait_for_server(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise TimeoutError(f"server at {url} did not come up")
+
+
+def run_mode(args: argparse.Namespace, kubeconfig: str) -> list[tuple[str, LoadResult]]:
+    """Run the teams through the app in serving mode `args.mode` and return the result
+    of every step."""
+
+    from load_test import (
+        CHALLENGE_ID,
+        Call,
+        create_challenge,
+        login_call,
+        run_calls,
+        start_app,
+    )
+
+    from instancer.config import config
+
+    server, base_url = start_app(args, kubeconfig)
+    try:
+        _, (admin_login,) = run_calls(
+            base_url, [login_call(str(config.admin_team_id))], 1
+        )
+        if admin_login is None:
+            sys.exit("Could not log in as the admin team.")
+        create_challenge(base_url, {"Authorization": f"Bearer {admin_login['token']}"})
+        _, logins = run_calls(
+            base_url,
+            [login_call(str(uuid.uuid4())) for _ in range(args.teams)],
+            args.concurrency,
+        )
+        teams = [
+            {"Authorization": f"Bearer {body['token']}"}
+            for body in logins
+            if body is not None
+        ]
+        chall = f"/api/challenge/{CHALLENGE_ID}"
+        polls = [Call("GET", chall + "/deployment", h) for h in teams] * args.polls
+
+        # teams keep polling while the deploys of the others wait on Kubernetes
+        during: list[LoadResult] = []
+        poller = Thread(
+            target=lambda: during.append(
+                run_calls(base_url, polls, args.concurrency)[0]
+            )
+        )
+        poller.start()
+        deploys, _ = run_calls(
+            base_url,
+            [Call("POST", chall + "/deploy", h) for h in teams],
+            args.concurrency,
+        )
+        poller.join()
+        status, _ = run_calls(base_url, polls, args.concurrency)
+        terminates, _ = run_calls(
+            base_url,
+            [Call("DELETE", chall + "/deployment", h) for h in teams],
+            args.concurrency,
+        )
+        return [
+            ("deploy", deploys),
+            ("poll+deploy", during[0]),
+            ("status", status),
+            ("terminate", terminates),
+        ]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the serving modes of the instancer API."
+    )
+    parser.add_argument("--modes", default="sync,threaded,async")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--teams", type=int, default=100)
+    parser.add_argument("--polls", type=int, default=10, help="status polls per team")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument(
+        "--kube-latency",
+        type=float,
+        default=0,
+        help="seconds every call to the fake Kubernetes API server takes",
+    )
+    parser.add_argument("--verbose", action="store_true", help="show the app's logs")
+    args = parser.parse_args()
+
+    # load_test imports this module, so it is only imported once this one is loaded
+    from fake_kube import FakeKube
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kube_server = FakeKube(latency=args.kube_latency).serve()
+        kubeconfig = os.path.join(tmp, "kubeconfig")
+        kube_server.write_kubeconfig(kubeconfig)
+        # the instancer modules load the kubeconfig when they are imported
+        os.environ["KUBECONFIG"] = kubeconfig
+        os.environ["INSTANCER_IN_CLUSTER"] = "false"
+
+        from instancer.config import config
+
+        if config.recaptcha_secret is not None:
+            sys.exit("The benchmark needs a config without a reCAPTCHA secret.")
+
+        try:
+            for mode in args.modes.split(","):
+                args.mode = mode
+                for step, result in run_mode(args, kubeconfig):
+                    print(f"{mode:>10} {step:>12}: {result.summary()}", flush=True)
+        finally:
+            kube_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Gunicorn settings for the instancer API.
+
+The serving mode is selected with the INSTANCER_SERVING_MODE environment variable:
+
+- "threaded" (default): every worker process serves up to INSTANCER_THREADS requests
+  at once, so requests waiting on Redis, Postgres, reCAPTCHA or the Kubernetes API
+  don't hold up the rest of the process.
+- "sync": every worker process serves one request at a time.
+- "async": every worker process runs the ASGI app in asgi.py under uvicorn. Status polls
+  are served on its event loop with async Redis and Postgres clients, and every other
+  request by the Flask app on INSTANCER_THREADS threads.
+
+Worker processes share their Prometheus metrics through files in PROMETHEUS_MULTIPROC_DIR,
+which defaults to a directory under the system's temporary directory and is emptied
+when gunicorn starts.
+"""
+
+import os
+import shutil
+import tempfile
+from typing import Any
+
+serving_mode = os.environ.get("INSTANCER_SERVING_MODE", "threaded")
+
+workers = int(os.environ.get("INSTANCER_WORKERS", "4"))
+timeout = int(os.environ.get("INSTANCER_WORKER_TIMEOUT", "60"))
+
+if serving_mode == "threaded":
+    worker_class = "gthread"
+    threads = int(os.environ.get("INSTANCER_THREADS", "16"))
+elif serving_mode == "sync":
+    worker_class = "sync"
+elif serving_mode == "async":
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    raise ValueError(f"Unknown serving mode {serving_mode!r}")
+
+wsgi_app = "asgi:app" if serving_mode == "async" else "app:app"
+
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "instancer-metrics")
+)
+
+
+def on_starting(server: Any) -> None:
+    # metrics left behind by a previous run would be added to the new ones
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server: Any, worker: Any) -> None:
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)  # type: ignore[no-untyped-call]
@@ -0,0 +1,135 @@
+"""Async versions of the lookups behind the requests clients make most often.
+
+The async serving mode (see asgi.py) answers deployment status polls with these, so an
+idle or waiting client costs an open socket and a coroutine instead of a thread or a
+worker process. They read the same Redis keys and Postgres tables as their counterparts
+in authentication, backend and events, using the async Redis client and Postgres pool.
+Deployment event streams are served the same way, so an open stream costs no thread
+either.
+"""
+
+import asyncio
+import json
+from time import time
+from typing import Any, AsyncGenerator, cast
+
+from instancer.backend import (
+    CHALL_CACHE_TIME,
+    Challenge,
+    DeploymentInfo,
+    _ChallengeInfo,
+    _make_challenge,
+)
+from instancer.config import arclient, connect_pg_async
+from instancer.metrics import count_cache
+
+
+async def get_session(token: str) -> dict[str, Any] | None:
+    """Retrieve session data, like authentication.get_session."""
+
+    data = await arclient.get(f"session:{token}")
+    count_cache("session", [data is not None])
+    if data is None:
+        return None
+    return cast(dict[str, Any], json.loads(data))
+
+
+async def fetch_challenge(challenge_id: str, team_id: str) -> Challenge | None:
+    """Fetch a challenge for a team, like Challenge.fetch.
+
+    Returns None if the challenge doesn't exist."""
+
+    cached = await arclient.get(f"chall:{challenge_id}")
+    count_cache("chall", [cached is not None])
+    if cached is not None:
+        return _make_challenge(challenge_id, _ChallengeInfo.from_json(cached), team_id)
+
+    async with connect_pg_async() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT cfg, per_team, lifetime, boot_time, name, description, author FROM challenges WHERE id=%s",
+                (challenge_id,),
+            )
+            db_response = await cur.fetchone()
+    if db_response is None:
+        return None
+    cfg, per_team, lifetime, boot_time, name, description, author = db_response
+    info = _ChallengeInfo(
+        cfg=cfg,
+        per_team=per_team,
+        lifetime=lifetime,
+        name=name,
+        description=description,
+        author=author,
+        boot_time=boot_time,
+    )
+    await arclient.set(f"chall:{challenge_id}", info.to_json(), ex=CHALL_CACHE_TIME)
+    return _make_challenge(challenge_id, info, team_id)
+
+
+async def status_versions(keys: list[str]) -> list[str]:
+    """Return the status versions of namespaces or scopes, like events.status_versions."""
+
+    if len(keys) == 0:
+        return []
+    return [
+        "0" if version is None else version.decode()
+        for version in await arclient.mget([f"status_version:{key}" for key in keys])
+    ]
+
+
+async def deployment_status(chall: Challenge) -> DeploymentInfo | None:
+    """Return the deployment info of a challenge, or None if it isn't deployed.
+
+    The cached state is read in one Redis round trip. Port mappings that aren't cached
+    yet are looked up in Kubernetes on a worker thread, so the event loop never waits
+    on the Kubernetes API."""
+
+    pipe = arclient.pipeline(transaction=False)
+    pipe.zscore("expiration", chall.namespace)
+    pipe.zscore("ready_time", chall.namespace)
+    pipe.zscore("boot_time", chall.namespace)
+    pipe.get(f"ports:{chall.namespace}")
+    exp_score, ready_score, boot_score, ports = await pipe.execute()
+    if exp_score is not None and ports is None:
+        return await asyncio.to_thread(
+            chall._deployment_status, exp_score, ready_score, boot_score, ports
+        )
+    return chall._deployment_status(exp_score, ready_score, boot_score, ports)
+
+
+async def last_event(namespace: str) -> dict[str, Any] | None:
+    """Return the last event published for a namespace, like events.last_event."""
+
+    data = await arclient.get(f"last_event:{namespace}")
+    if data is None:
+        return None
+    event: dict[str, Any] = json.loads(data)
+    return event
+
+
+async def listen(
+    namespace: str, keepalive: float, duration: float
+) -> AsyncGenerator[Any, None]:
+    """Yield events published for a namespace for up to `duration` seconds, like
+    events.listen, including the None yielded first and after `keepalive` idle seconds.
+    """
+
+    pubsub = arclient.pubsub(ignore_subscribe_messages=True)
+    try:
+        await pubsub.subscribe(f"events:{namespace}")
+        deadline = time() + duration
+        last_yield = time()
+        yield None
+        while (remaining := deadline - time()) > 0:
+            msg = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=min(keepalive, remaining)
+            )
+            if msg is not None and msg["type"] == "message":
+                last_yield = time()
+                yield json.loads(msg["data"])
+            elif time() - last_yield >= keepalive:
+                last_yield = time()
+                yield None
+    finally:
+        await pubsub.reset()
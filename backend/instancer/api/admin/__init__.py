@@ -1,9 +1,20 @@
-from flask import Blueprint, g, request
+from flask import Blueprint, Response, g, request
 from flask.typing import ResponseReturnValue
 
+from instancer.capacity import capacity_status
 from instancer.config import config
+from instancer.deploy_queue import queue_length
+from instancer.prepull import prepull_status
+from instancer.profiler import (
+    MIN_INTERVAL,
+    ProfileRunningError,
+    collapsed_stacks,
+    profile_info,
+    start_profile,
+)
+from instancer.tracing import recent_traces, stage_breakdown
 
-from . import challenge, challenges
+from . import challenge, challenges, events, instances
 
 blueprint = Blueprint("admin", __name__, url_prefix="/admin")
 
@@ -19,6 +30,105 @@ def check_admin_team() -> ResponseReturnValue | None:
 
 blueprint.register_blueprint(challenges.blueprint)
 blueprint.register_blueprint(challenge.blueprint)
+blueprint.register_blueprint(instances.blueprint)
+blueprint.register_blueprint(events.blueprint)
+
+
+@blueprint.route("/capacity", methods=["GET"])
+def capacity() -> ResponseReturnValue:
+    """Returns the total, reserved and available cluster capacity and the number of
+    deploys queued for it.
+
+    CPU is in millicores and memory in bytes."""
+    return {
+        "status": "ok",
+        "capacity": capacity_status(),
+        "queued_deploys": queue_length(),
+    }
+
+
+@blueprint.route("/prepull", methods=["GET"])
+def prepull() -> ResponseReturnValue:
+    """Returns the images pre-pulled onto the nodes and the progress of each node."""
+    return {"status": "ok", "prepull": prepull_status()}
+
+
+@blueprint.route("/traces", methods=["GET"])
+def traces() -> ResponseReturnValue:
+    """Returns the most recent traces and the time spent in each of their stages.
+
+    `name` only includes traces of one operation, such as deploy or stop, and `limit`
+    sets how many traces are included."""
+    name = request.args.get("name")
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return {"status": "invalid_limit", "msg": "limit must be an integer"}, 400
+    if limit < 1:
+        return {"status": "invalid_limit", "msg": "limit must be positive"}, 400
+    return {
+        "status": "ok",
+        "enabled": config.tracing_enabled,
+        "stages": stage_breakdown(name, limit),
+        "traces": recent_traces(name, limit),
+    }
+
+
+@blueprint.route("/profile", methods=["POST"])
+def profile() -> ResponseReturnValue:
+    """Starts sampling the stacks of every API worker process.
+
+    The JSON body takes the `duration` in seconds and the `interval` between samples in
+    milliseconds. The response contains the `profile`, which can be polled with GET on
+    /profile/<profile_id> and fetched as collapsed stacks from
+    /profile/<profile_id>/collapsed once it is done."""
+    if not config.profiling_enabled:
+        return {"status": "profiling_disabled", "msg": "profiling is disabled"}, 404
+    body = request.json
+    if not isinstance(body, dict):
+        return {"status": "bad_request", "msg": "expected a JSON object"}, 400
+    duration = body.get("duration")
+    interval = body.get("interval", 10)
+    if (
+        not isinstance(duration, int)
+        or duration < 1
+        or duration > config.profiling_max_duration
+    ):
+        return {
+            "status": "invalid_duration",
+            "msg": f"duration must be an integer from 1 to {config.profiling_max_duration}",
+        }, 400
+    if not isinstance(interval, int) or interval < MIN_INTERVAL:
+        return {
+            "status": "invalid_interval",
+            "msg": f"interval must be an integer of at least {MIN_INTERVAL}",
+        }, 400
+    try:
+        info = start_profile(duration, interval)
+    except ProfileRunningError as e:
+        return {"status": "profile_running", "msg": str(e)}, 409
+    return {"status": "ok", "profile": info}, 202
+
+
+@blueprint.route("/profile/<profile_id>", methods=["GET"])
+def profile_get(profile_id: str) -> ResponseReturnValue:
+    """Returns the progress of a profile."""
+    info = profile_info(profile_id)
+    if info is None:
+        return {"status": "invalid_profile_id", "msg": "invalid profile ID"}, 404
+    return {"status": "ok", "profile": info}
+
+
+@blueprint.route("/profile/<profile_id>/collapsed", methods=["GET"])
+def profile_collapsed(profile_id: str) -> ResponseReturnValue:
+    """Returns the stacks sampled by a finished profile in the collapsed format, which
+    flame graph tools such as flamegraph.pl and speedscope read."""
+    info = profile_info(profile_id)
+    if info is None:
+        return {"status": "invalid_profile_id", "msg": "invalid profile ID"}, 404
+    if info["state"] != "done":
+        return {"status": "profile_running", "msg": "the profile is still running"}, 409
+    return Response(collapsed_stacks(profile_id), mimetype="text/plain")
 
 
 @blueprint.route("/request_info", methods=["GET"])
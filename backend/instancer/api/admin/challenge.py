@@ -11,12 +11,16 @@ blueprint = Blueprint("admin_challenge", __name__, url_prefix="/challenge")
 
 from typing import Any
 
+import jsonschema
 from flask import Blueprint, g, request
 from flask.typing import ResponseReturnValue
 
 from instancer.backend import Challenge, ChallengeTag, ResourceUnavailableError
+from instancer.capacity import CapacityExceededError
 from instancer.config import config
 
+from .challenges import autoscaling_schema, check_scaling, replicas_schema
+
 
 def deployment_status(chall: Challenge) -> dict[str, Any] | None:
     """Return a dict with the challenge deployment status or None if the challenge is not deployed."""
@@ -27,6 +31,7 @@ def deployment_status(chall: Challenge) -> dict[str, Any] | None:
     return {
         "expiration": status.expiration,
         "start_delay": status.start_timestamp,
+        "ready": status.ready_timestamp,
         "port_mappings": {
             f"{container}:{internal}": external
             for (
@@ -86,7 +91,12 @@ def challenge_deploy() -> ResponseReturnValue:
     """
 
     try:
-        g.chall.start()
+        g.chall.start(skip_queue=True)
+    except CapacityExceededError as e:
+        return {
+            "status": "capacity_exceeded",
+            "msg": f"Starting this challenge would overcommit cluster {e.resource}.",
+        }, 503
     except ResourceUnavailableError:
         return {
             "status": "temporarily_unavailable",
@@ -105,6 +115,59 @@ def challenge_deploy() -> ResponseReturnValue:
     }
 
 
+scaling_schema = {
+    "type": "object",
+    "additionalProperties": {
+        "type": "object",
+        "properties": {
+            "replicas": replicas_schema,
+            "autoscaling": {"oneOf": [autoscaling_schema, {"type": "null"}]},
+        },
+        "additionalProperties": False,
+    },
+}
+
+
+@blueprint.route("/scaling", methods=["PATCH"])
+def challenge_scaling() -> ResponseReturnValue:
+    """
+    Changes the replicas and autoscaling settings of containers of a challenge.
+
+    The body maps container names to an object with `replicas`, `autoscaling` or both;
+    set `autoscaling` to null to turn it off. The settings are saved in the challenge
+    config and applied to every running instance of the challenge.
+    """
+
+    scaling = request.json
+    try:
+        jsonschema.validate(scaling, scaling_schema)
+    except jsonschema.ValidationError as e:
+        return {"status": "invalid_scaling", "msg": str(e)}, 400
+    assert isinstance(scaling, dict)
+    for name, change in scaling.items():
+        if name not in g.chall.containers:
+            return {
+                "status": "invalid_container",
+                "msg": f"container {name!r} does not exist",
+            }, 400
+        merged = {**g.chall.containers[name], **change}
+        if merged.get("autoscaling") is None:
+            merged.pop("autoscaling", None)
+        if (scaling_error := check_scaling(merged)) is not None:
+            return {
+                "status": "invalid_scaling",
+                "msg": f"container {name!r} {scaling_error}",
+            }, 400
+
+    failed = g.chall.update_scaling(scaling)
+    if failed > 0:
+        return {
+            "status": "partially_applied",
+            "msg": f"Saved, but {failed} running instances could not be scaled",
+        }, 500
+    return {"status": "ok", "msg": "Scaling updated"}
+
+
 @blueprint.route("/deployment", methods=["DELETE"])
 def cd_terminate() -> ResponseReturnValue:
     """
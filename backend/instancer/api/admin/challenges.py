@@ -1,15 +1,98 @@
 import re
+from typing import Any
 
 import jsonschema
 from flask import Blueprint, json, request
 from flask.typing import ResponseReturnValue
 from psycopg.errors import UniqueViolation
 
-from instancer.backend import Challenge, ChallengeMetadata, ChallengeTag
+from instancer.backend import (
+    Challenge,
+    ChallengeMetadata,
+    ChallengeTag,
+    container_replicas,
+)
 
 blueprint = Blueprint("admin_challenges", __name__, url_prefix="/challenges")
 
 
+port_schema = {
+    "anyOf": [
+        {"type": "integer", "minimum": 1, "maximum": 65535},
+        {"type": "string"},
+    ]
+}
+
+probe_schema = {
+    "type": "object",
+    "properties": {
+        "exec": {
+            "type": "object",
+            "required": ["command"],
+            "properties": {"command": {"type": "array", "items": {"type": "string"}}},
+            "additionalProperties": False,
+        },
+        "httpGet": {
+            "type": "object",
+            "required": ["port"],
+            "properties": {
+                "path": {"type": "string"},
+                "port": port_schema,
+                "host": {"type": "string"},
+                "scheme": {"enum": ["HTTP", "HTTPS"]},
+                "httpHeaders": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["name", "value"],
+                        "properties": {
+                            "name": {"type": "string"},
+                            "value": {"type": "string"},
+                        },
+                    },
+                },
+            },
+            "additionalProperties": False,
+        },
+        "tcpSocket": {
+            "type": "object",
+            "required": ["port"],
+            "properties": {"port": port_schema, "host": {"type": "string"}},
+            "additionalProperties": False,
+        },
+        "grpc": {
+            "type": "object",
+            "required": ["port"],
+            "properties": {
+                "port": {"type": "integer", "minimum": 1, "maximum": 65535},
+                "service": {"type": "string"},
+            },
+            "additionalProperties": False,
+        },
+        "initialDelaySeconds": {"type": "integer", "minimum": 0},
+        "periodSeconds": {"type": "integer", "minimum": 1},
+        "timeoutSeconds": {"type": "integer", "minimum": 1},
+        "successThreshold": {"type": "integer", "minimum": 1},
+        "failureThreshold": {"type": "integer", "minimum": 1},
+        "terminationGracePeriodSeconds": {"type": "integer", "minimum": 1},
+    },
+    "additionalProperties": False,
+}
+
+replicas_schema = {"type": "integer", "minimum": 1, "maximum": 100}
+
+autoscaling_schema = {
+    "type": "object",
+    "required": ["maxReplicas"],
+    "properties": {
+        "minReplicas": replicas_schema,
+        "maxReplicas": replicas_schema,
+        "targetCPUUtilizationPercentage": {"type": "integer", "minimum": 1},
+        "targetMemoryUtilizationPercentage": {"type": "integer", "minimum": 1},
+    },
+    "additionalProperties": False,
+}
+
 container_schema = {
     "type": "object",
     "required": ["image"],
@@ -87,17 +170,38 @@ container_schema = {
                 },
             },
         },
+        "livenessProbe": probe_schema,
+        "readinessProbe": probe_schema,
+        "startupProbe": probe_schema,
         "hasEgress": {"type": "boolean"},
         "multiService": {"type": "boolean"},
+        "replicas": replicas_schema,
+        "autoscaling": autoscaling_schema,
     },
     "additionalProperties": False,
 }
 
+
+def check_scaling(container: dict[str, Any]) -> str | None:
+    """Return why the scaling settings of a container config are invalid, or None if
+    they're valid."""
+
+    autoscaling = container.get("autoscaling")
+    if (
+        autoscaling is not None
+        and container_replicas(container) > autoscaling["maxReplicas"]
+    ):
+        return "has more replicas than autoscaling.maxReplicas"
+    return None
+
+
 config_schema = {
     "type": "object",
     "required": ["containers"],
     "properties": {
         "containers": {"type": "object", "additionalProperties": container_schema},
+        "preemptible": {"type": "boolean"},
+        "isolation": {"enum": ["namespace", "labels"]},
         "tcp": {
             "type": "object",
             "additionalProperties": {
@@ -178,6 +282,19 @@ def challenge_upload() -> ResponseReturnValue:
     tcp = cfg.get("tcp", {})
     http = cfg.get("http", {})
 
+    if cfg.get("isolation") == "labels":
+        if not per_team or len(cfg["containers"]) != 1:
+            return {
+                "status": "invalid_config",
+                "msg": "isolation labels is only supported for per-team challenges with one container",
+            }, 400
+        # the names of the instance's objects get a 9 character suffix
+        if any(len(contname) > 35 for contname in cfg["containers"]):
+            return {
+                "status": "invalid_config",
+                "msg": "container ids of challenges with isolation labels must be at most 35 characters",
+            }, 400
+
     for contname in tcp:
         if contname not in cfg["containers"]:
             return {
@@ -201,6 +318,11 @@ def challenge_upload() -> ResponseReturnValue:
                 "status": "invalid_container",
                 "msg": "suffix -instancer-external is reserved and cannot be used for containers",
             }, 400
+        if (scaling_error := check_scaling(container)) is not None:
+            return {
+                "status": "invalid_container",
+                "msg": f"container {contname!r} {scaling_error}",
+            }, 400
         exposed_ports = tcp.get(contname, [])
         container_ports = container.get("ports", [])
         private_ports = [x for x in container_ports if x not in exposed_ports]
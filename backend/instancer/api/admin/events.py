@@ -0,0 +1,52 @@
+from uuid import UUID
+
+from flask import Blueprint, request
+from flask.typing import ResponseReturnValue
+
+from instancer.config import config
+from instancer.event_log import challenge_stats, recent_events
+
+blueprint = Blueprint("admin_events", __name__, url_prefix="/events")
+
+
+@blueprint.before_request
+def check_enabled() -> ResponseReturnValue | None:
+    if not config.event_log_enabled:
+        return {"status": "event_log_disabled", "msg": "the event log is disabled"}, 404
+    return None
+
+
+@blueprint.route("", methods=["GET"])
+def events() -> ResponseReturnValue:
+    """Returns the most recent deploys, renewals, stops and expirations, newest first.
+
+    `challenge_id` and `team_id` only include events of one challenge or team, and
+    `limit` sets how many events are included."""
+    chall_id = request.args.get("challenge_id")
+    team_id = request.args.get("team_id")
+    if team_id is not None:
+        try:
+            UUID(team_id)
+        except ValueError:
+            return {"status": "invalid_team_id", "msg": "team_id must be a UUID"}, 400
+    try:
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return {"status": "invalid_limit", "msg": "limit must be an integer"}, 400
+    if limit < 1 or limit > 1000:
+        return {"status": "invalid_limit", "msg": "limit must be from 1 to 1000"}, 400
+    return {"status": "ok", "events": recent_events(chall_id, team_id, limit)}
+
+
+@blueprint.route("/stats", methods=["GET"])
+def stats() -> ResponseReturnValue:
+    """Returns the number of events, failures and rejections and the mean and maximum
+    duration of every action of every challenge, plus the mean uptime of stopped and
+    expired instances. `challenge_id` only includes one challenge.
+
+    Durations are in seconds; ready durations are the time from an instance being
+    created to all of its pods being ready."""
+    return {
+        "status": "ok",
+        "stats": challenge_stats(request.args.get("challenge_id")),
+    }
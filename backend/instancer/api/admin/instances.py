@@ -0,0 +1,112 @@
+from dataclasses import asdict
+
+from flask import Blueprint, request
+from flask.typing import ResponseReturnValue
+
+from instancer.inventory import list_instances
+from instancer.teardown import (
+    InvalidSelectorError,
+    bulk_stop_progress,
+    cancel_bulk_stop,
+    start_bulk_stop,
+)
+
+blueprint = Blueprint("admin_instances", __name__, url_prefix="/instances")
+
+
+@blueprint.route("/stop", methods=["POST"])
+def bulk_stop() -> ResponseReturnValue:
+    """Stop every running instance of a challenge, of a team, or of a team's challenge.
+
+    The JSON body takes a `challenge_id`, a `team_id` or both. Instances are stopped in
+    the background by the worker; the response contains a `job` with the progress, which
+    can be polled with GET and cancelled with DELETE on /instances/stop/<job_id>.
+    """
+
+    body = request.json
+    if not isinstance(body, dict):
+        return {"status": "bad_request", "msg": "expected a JSON object"}, 400
+    chall_id = body.get("challenge_id")
+    team_id = body.get("team_id")
+    if chall_id is None and team_id is None:
+        return {
+            "status": "bad_request",
+            "msg": "challenge_id or team_id is required",
+        }, 400
+    if not isinstance(chall_id, str | None) or not isinstance(team_id, str | None):
+        return {
+            "status": "bad_request",
+            "msg": "challenge_id and team_id must be strings",
+        }, 400
+    try:
+        job_id = start_bulk_stop(chall_id, team_id)
+    except InvalidSelectorError as e:
+        return {"status": "bad_request", "msg": str(e)}, 400
+    return {"status": "ok", "job": bulk_stop_progress(job_id)}, 202
+
+
+@blueprint.route("/stop/<job_id>", methods=["GET"])
+def bulk_stop_get(job_id: str) -> ResponseReturnValue:
+    """Return the progress of a bulk stop."""
+
+    job = bulk_stop_progress(job_id)
+    if job is None:
+        return {"status": "invalid_job_id", "msg": "invalid job ID"}, 404
+    return {"status": "ok", "job": job}
+
+
+@blueprint.route("/stop/<job_id>", methods=["DELETE"])
+def bulk_stop_cancel(job_id: str) -> ResponseReturnValue:
+    """Cancel a queued or running bulk stop. Instances that are already being stopped are not restored."""
+
+    if not cancel_bulk_stop(job_id):
+        return {
+            "status": "invalid_job_id",
+            "msg": "no queued or running job with this ID",
+        }, 404
+    return {"status": "ok", "job": bulk_stop_progress(job_id)}
+
+
+@blueprint.route("", methods=["GET"])
+def inventory() -> ResponseReturnValue:
+    """List running instances sorted by age.
+
+    Query parameters (all optional):
+    - `challenge_id`, `team_id`: only list instances of this challenge or team
+    - `expires_after`, `expires_before`: only list instances expiring in this window (unix time)
+    - `order`: `oldest` (default) or `newest` first
+    - `limit`: page size, at most 1000 (default 100)
+    - `cursor`: the `next_cursor` of the previous page; the other parameters are ignored
+
+    Instances are read from Redis indexes only, so Kubernetes is never queried.
+    """
+
+    try:
+        expires_after = request.args.get("expires_after", type=int)
+        expires_before = request.args.get("expires_before", type=int)
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return {"status": "bad_request", "msg": "invalid number"}, 400
+    if not 1 <= limit <= 1000:
+        return {"status": "bad_request", "msg": "limit must be from 1 to 1000"}, 400
+    order = request.args.get("order", "oldest")
+    if order not in ["oldest", "newest"]:
+        return {"status": "bad_request", "msg": "order must be oldest or newest"}, 400
+
+    page = list_instances(
+        chall_id=request.args.get("challenge_id"),
+        team_id=request.args.get("team_id"),
+        expires_after=expires_after,
+        expires_before=expires_before,
+        newest_first=order == "newest",
+        limit=limit,
+        cursor=request.args.get("cursor"),
+    )
+    if page is None:
+        return {"status": "invalid_cursor", "msg": "invalid or expired cursor"}, 400
+    return {
+        "status": "ok",
+        "instances": [asdict(instance) for instance in page.instances],
+        "total": page.total,
+        "next_cursor": page.next_cursor,
+    }
@@ -5,6 +5,10 @@ from typing import Any, cast
 import requests
 
 from instancer.config import config, rclient
+from instancer.metrics import count_cache
+
+_captcha_session = requests.Session()
+"HTTP session for captcha verification so the connection to Google is kept alive."
 
 
 def new_session(team_id: str) -> str:
@@ -27,6 +31,7 @@ def get_session(token: str) -> dict[str, Any] | None:
     """
 
     data = rclient.get(f"session:{token}")
+    count_cache("session", [data is not None])
     if data is None:
         return None
     return cast(dict[str, Any], json.loads(data))
@@ -56,11 +61,11 @@ def verify_captcha_token(token: str | None) -> bool:
 
     try:
         payload = {"secret": config.recaptcha_secret, "response": token}
-        res = requests.post(
-            f"https://www.google.com/recaptcha/api/siteverify", data=payload
+        res = _captcha_session.post(
+            f"https://www.google.com/recaptcha/api/siteverify", data=payload, timeout=10
         ).json()
 
         success: bool = res["success"]
         return success
-    except (KeyError, requests.JSONDecodeError):
+    except (KeyError, requests.JSONDecodeError, requests.RequestException):
         return False
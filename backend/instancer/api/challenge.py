@@ -1,24 +1,56 @@
+import json
+import os
 from time import time
-from typing import Any
+from typing import Any, Iterator
 
-from flask import Blueprint, g, request
+from flask import Blueprint, Response, g, request
 from flask.typing import ResponseReturnValue
 
-from instancer.backend import Challenge, ChallengeTag, ResourceUnavailableError
+from instancer.backend import (
+    Challenge,
+    ChallengeTag,
+    DeploymentInfo,
+    ResourceUnavailableError,
+)
+from instancer.capacity import CapacityExceededError
+from instancer.catalog import catalog_version
+from instancer.coalesce import coalesce, replay_response, save_response
 from instancer.config import config
+from instancer.deploy_queue import (
+    QueueFullError,
+    QueuePosition,
+    enqueue_deploy,
+    queue_position,
+)
+from instancer.events import (
+    StreamLimit,
+    last_event,
+    listen,
+    publish_event,
+    status_versions,
+)
+from instancer.ratelimit import RateLimitException, check_deploy_rate, start_slot
+from instancer.tracing import trace
 
 from .authentication import verify_captcha_token
+from .conditional import conditional, make_etag
 
 
 def deployment_status(chall: Challenge) -> dict[str, Any] | None:
     """Return a dict with the challenge deployment status or None if the challenge is not deployed."""
 
-    status = chall.deployment_status()
+    return deployment_info(chall.deployment_status())
+
+
+def deployment_info(status: DeploymentInfo | None) -> dict[str, Any] | None:
+    """Return a dict with the given deployment info, or None if there is no deployment."""
+
     if status is None:
         return None
     return {
         "expiration": status.expiration,
         "start_delay": status.start_timestamp,
+        "ready": status.ready_timestamp,
         "port_mappings": {
             f"{container}:{internal}": external
             for (
@@ -69,25 +101,65 @@ def check_challenge() -> ResponseReturnValue | None:
     return None
 
 
-@blueprint.route("/deploy", methods=["POST"])
-def challenge_deploy() -> ResponseReturnValue:
-    """
-    Starts or renews a team's challenge deployment.
+def check_captcha() -> ResponseReturnValue | None:
+    """Verify the CAPTCHA token in the request body if reCAPTCHA is configured.
+
+    Returns an error response if the token is missing or invalid and None otherwise.
     """
-    body = request.json
+
     # Only require captcha token if recaptcha is configured
-    if config.recaptcha_secret is not None:
-        if not body or "captcha_token" not in body:
-            return {"status": "bad_request", "msg": "CAPTCHA token is required"}, 400
+    if config.recaptcha_secret is None:
+        return None
+    body = request.json
+    if not body or "captcha_token" not in body:
+        return {"status": "bad_request", "msg": "CAPTCHA token is required"}, 400
 
-        if not verify_captcha_token(body["captcha_token"]):
-            return {
-                "status": "invalid_captcha_token",
-                "msg": "Invalid CAPTCHA token",
-            }, 498
+    if not verify_captcha_token(body["captcha_token"]):
+        return {
+            "status": "invalid_captcha_token",
+            "msg": "Invalid CAPTCHA token",
+        }, 498
+    return None
+
+
+def start_challenge(chall: Challenge, team_id: str) -> tuple[dict[str, Any], int]:
+    """Start or renew a challenge deployment for a team, subject to the deploy rate limits.
+
+    Concurrent starts of the same deployment are coalesced, so they all get the result
+    of a single start. Returns the response body and status code.
+    """
+
+    with trace("deploy", challenge=chall.id, namespace=chall.namespace):
+        # the rate limits are per team, and teams can share a deployment, so every
+        # request is checked on its own before joining a start in progress
+        try:
+            check_deploy_rate(team_id, chall.id)
+        except RateLimitException as e:
+            return rate_limited(e)
+        return coalesce(
+            f"deploy:{chall.namespace}", lambda: _start_challenge(chall, team_id)
+        )
+
+
+def rate_limited(e: RateLimitException) -> tuple[dict[str, Any], int]:
+    """Return the response body and status code of a rate limited deploy."""
+
+    return {
+        "status": "rate_limited",
+        "msg": f"Too many deploy requests. Try again in {e.retry_after} seconds.",
+        "retry_after": e.retry_after,
+    }, 429
+
+
+def _start_challenge(chall: Challenge, team_id: str) -> tuple[dict[str, Any], int]:
+    """Start or renew a challenge deployment without coalescing or rate limiting."""
 
     try:
-        g.chall.start()
+        chall.start(slot=start_slot())
+    except RateLimitException as e:
+        return rate_limited(e)
+    except CapacityExceededError:
+        return queue_challenge(chall, team_id)
     except ResourceUnavailableError:
         return {
             "status": "temporarily_unavailable",
@@ -102,36 +174,199 @@ def challenge_deploy() -> ResponseReturnValue:
 
     return {
         "status": "ok",
-        "deployment": deployment_status(g.chall),
-    }
+        "deployment": deployment_status(chall),
+    }, 200
 
 
-@blueprint.route("/deployment", methods=["DELETE"])
-def cd_terminate() -> ResponseReturnValue:
+def queue_challenge(chall: Challenge, team_id: str) -> tuple[dict[str, Any], int]:
+    """Queue a challenge deployment that doesn't fit in the cluster right now.
+
+    Returns the response body and status code.
     """
-    Terminates a team's challenge deployment.
+
+    try:
+        position = enqueue_deploy(chall.namespace, chall.id, team_id)
+    except QueueFullError:
+        return {
+            "status": "capacity_exceeded",
+            "msg": "There is no room for another instance right now. Try again in a few minutes.",
+        }, 503
+    publish_event(
+        chall.namespace, "queued", position=position.position, eta=position.eta
+    )
+    return {
+        "status": "queued",
+        "msg": "The cluster is full, so the challenge will be deployed once there is room for it.",
+        "queue": queue_info(position),
+    }, 202
+
+
+def queue_info(position: QueuePosition | None) -> dict[str, Any] | None:
+    """Return a dict with the place of a deployment in the queue, or None if it isn't queued."""
+
+    if position is None:
+        return None
+    return {"position": position.position, "eta": position.eta}
+
+
+def stop_challenge(chall: Challenge) -> tuple[dict[str, Any], int]:
+    """Stop a team's challenge deployment.
+
+    Returns the response body and status code.
     """
-    if g.chall.is_shared():
+
+    if chall.is_shared():
         return {
             "status": "cannot_terminate_shared_deployment",
             "msg": "You do not have permission to terminate a shared challenge deployment",
         }, 405
-    g.chall.stop()
+    chall.stop()
     return {
         "status": "ok",
         "msg": "Successfully terminated challenge",
-    }
+    }, 200
+
+
+@blueprint.route("/deploy", methods=["POST"])
+def challenge_deploy() -> ResponseReturnValue:
+    """
+    Starts or renews a team's challenge deployment.
+
+    If the request has an `Idempotency-Key` header, a final response (a success or a
+    client error that a retry wouldn't change) is saved for a short while and returned
+    again for requests with the same key, without a new deploy.
+    """
+    idempotency_key = request.headers.get("Idempotency-Key")
+    scope = f"{g.session['team_id']}:{g.chall.id}"
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= 255:
+        return {
+            "status": "bad_request",
+            "msg": "Idempotency-Key must be between 1 and 255 characters",
+        }, 400
+    # replayed before the CAPTCHA check since retries can't reuse a token
+    replayed = (
+        None if idempotency_key is None else replay_response(scope, idempotency_key)
+    )
+    if replayed is not None:
+        body, status = replayed
+    else:
+        if (captcha_error := check_captcha()) is not None:
+            return captcha_error
+        body, status = start_challenge(g.chall, g.session["team_id"])
+        if idempotency_key is not None:
+            save_response(scope, idempotency_key, (body, status))
+    if status == 429:
+        return body, status, {"Retry-After": str(body["retry_after"])}
+    return body, status
+
+
+@blueprint.route("/deployment", methods=["DELETE"])
+def cd_terminate() -> ResponseReturnValue:
+    """
+    Terminates a team's challenge deployment.
+    """
+    return stop_challenge(g.chall)
+
+
+@blueprint.route("/deployment/queue", methods=["GET"])
+def cd_queue() -> ResponseReturnValue:
+    """
+    Return the place of a team's challenge deployment in the deploy queue.
+
+    `queue` is null if the deployment isn't queued.
+    """
+    return {"status": "ok", "queue": queue_info(queue_position(g.chall.namespace))}
 
 
 @blueprint.route("/deployment", methods=["GET"])
 def cd_get() -> ResponseReturnValue:
     """
     Return a team's challenge deployment info
+
+    Supports conditional requests with the ETag derived from the deployment's status version.
     """
-    return {
-        "status": "ok",
-        "deployment": deployment_status(g.chall),
-    }
+    chall = g.chall
+    return conditional(
+        make_etag("deployment", chall.namespace, *status_versions([chall.namespace])),
+        lambda: {
+            "status": "ok",
+            "deployment": deployment_status(chall),
+        },
+    )
+
+
+streams = StreamLimit(
+    0
+    if os.environ.get("INSTANCER_SERVING_MODE") == "sync"
+    else config.event_stream_max_threaded
+)
+"""Event streams served by this process. Every stream holds a thread, or a whole process
+in sync mode, where gunicorn's worker timeout would also cut it off."""
+
+
+def too_many_streams() -> tuple[dict[str, Any], int, dict[str, str]]:
+    """Return the response to an event stream that can't be served right now."""
+
+    return (
+        {
+            "status": "too_many_streams",
+            "msg": "Too many open event streams. Poll the deployment instead.",
+        },
+        503,
+        {"Retry-After": "30"},
+    )
+
+
+def server_sent_event(event: str, data: Any) -> str:
+    """Format a server-sent event."""
+
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@blueprint.route("/deployment/events", methods=["GET"])
+def cd_events() -> ResponseReturnValue:
+    """
+    Stream a team's challenge deployment progress as server-sent events.
+
+    The stream starts with a `status` event containing the last published event and the
+    deployment info, then sends an event named after each phase the deployment goes through.
+    Every event includes the current deployment info. The stream ends after the configured
+    duration and clients are expected to reconnect. Once this process serves as many
+    streams as it may, new ones get a 503 and clients are expected to poll instead.
+    """
+    chall = g.chall
+    if not streams.acquire():
+        return too_many_streams()
+
+    def stream() -> Iterator[str]:
+        events = listen(
+            chall.namespace, keepalive=15, duration=config.event_stream_duration
+        )
+        # wait for the subscription before taking a snapshot so no event is missed
+        next(events)
+        yield "retry: 3000\n\n"
+        yield server_sent_event(
+            "status",
+            {
+                "last_event": last_event(chall.namespace),
+                "deployment": deployment_status(chall),
+            },
+        )
+        for event in events:
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield server_sent_event(
+                    event["phase"], {**event, "deployment": deployment_status(chall)}
+                )
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(streams.release)
+    return response
 
 
 @blueprint.route("", methods=["GET"])
@@ -141,7 +376,11 @@ def challenge_get() -> ResponseReturnValue:
     If there is no error, response contains a `challenge_info` object with the ID, name, author, description, and tags.
     """
 
-    return {
-        "status": "ok",
-        "challenge_info": challenge_info(g.chall, g.chall.tags()),
-    }
+    chall = g.chall
+    return conditional(
+        make_etag("challenge", chall.id, catalog_version()),
+        lambda: {
+            "status": "ok",
+            "challenge_info": challenge_info(chall, chall.tags()),
+        },
+    )
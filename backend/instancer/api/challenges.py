@@ -1,26 +1,237 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import flask
-from flask import Blueprint, g
+from flask import Blueprint, g, request
 from flask.typing import ResponseReturnValue
 
 from instancer.backend import Challenge
+from instancer.catalog import CatalogFilter, catalog_version
 from instancer.config import config
+from instancer.events import status_versions, team_status_scope
+
+from .challenge import (
+    challenge_info,
+    check_captcha,
+    deployment_info,
+    start_challenge,
+    stop_challenge,
+)
+from .conditional import conditional, make_etag
 
-from .challenge import challenge_info, deployment_status
+BATCH_MAX_SIZE = 50
+"Maximum number of challenges in a single batch request."
+BATCH_CONCURRENCY = 8
+"Number of challenges started or stopped at the same time by a batch request."
+PAGE_MAX_SIZE = 200
+"Maximum page size of the challenge listing."
 
 blueprint = Blueprint("challenges", __name__, url_prefix="/challenges")
 
 
 @blueprint.route("", methods=["GET"])
 def challenges() -> ResponseReturnValue:
+    """List challenges, optionally filtered and paginated.
+
+    Query parameters (all optional):
+    - `category`, `tag`: only list challenges with any of these categories or tags, may be repeated
+    - `exclude_category`, `exclude_tag`: leave out challenges with these categories or tags
+    - `q`: only list challenges whose name or author contains this text
+    - `status`: `active` or `inactive` to only list deployed or undeployed challenges
+    - `page`, `page_size`: return only this page (1-indexed) of the results
+
+    Challenges are sorted by name. The response also contains the number of matching
+    challenges in `total` and all `categories` and `tags` in the catalog.
+    """
+
     if config.rctf_mode and g.session["team_id"] != str(config.admin_team_id):
         return {"status": "not_admin", "msg": "Challenge listing API is disabled."}, 403
+    status_filter = request.args.get("status")
+    if status_filter not in [None, "active", "inactive"]:
+        return {
+            "status": "bad_request",
+            "msg": "status must be active or inactive",
+        }, 400
+    try:
+        page = int(request.args.get("page", 1))
+        page_size = request.args.get("page_size", type=int)
+    except ValueError:
+        return {"status": "bad_request", "msg": "page must be a number"}, 400
+    if page < 1 or (page_size is not None and not 1 <= page_size <= PAGE_MAX_SIZE):
+        return {
+            "status": "bad_request",
+            "msg": f"page must be positive and page_size from 1 to {PAGE_MAX_SIZE}",
+        }, 400
+
+    team_id = g.session["team_id"]
+    return conditional(
+        make_etag(
+            "challenges",
+            team_id,
+            request.query_string.decode(),
+            catalog_version(),
+            *status_versions([f"scope:{team_status_scope(team_id)}", "scope:shared"]),
+        ),
+        lambda: list_challenges(team_id, status_filter, page, page_size),
+    )
+
+
+def list_challenges(
+    team_id: str, status_filter: str | None, page: int, page_size: int | None
+) -> ResponseReturnValue:
+    """Build the challenge listing response for a team."""
+
+    result = Challenge.search(
+        CatalogFilter(
+            categories=request.args.getlist("category"),
+            tags=request.args.getlist("tag"),
+            exclude_categories=request.args.getlist("exclude_category"),
+            exclude_tags=request.args.getlist("exclude_tag"),
+            query=request.args.get("q", ""),
+        )
+    )
+    chall_ids = result.ids
+    if status_filter is None and page_size is not None:
+        chall_ids = chall_ids[(page - 1) * page_size : page * page_size]
+    challs = list(Challenge.fetch_many(chall_ids, team_id).values())
+    statuses = Challenge.deployment_statuses(challs)
+    total = len(result.ids)
+    if status_filter is not None:
+        matches = [
+            (chall, status)
+            for chall, status in zip(challs, statuses)
+            if (status is not None) == (status_filter == "active")
+        ]
+        total = len(matches)
+        if page_size is not None:
+            matches = matches[(page - 1) * page_size : page * page_size]
+        challs = [chall for chall, _ in matches]
+        statuses = [status for _, status in matches]
+
     return {
         "status": "ok",
         "challenges": [
             {
                 "challenge_info": challenge_info(chall, tags),
-                "deployment": deployment_status(chall),
+                "deployment": deployment_info(status),
             }
-            for chall, tags in Challenge.fetchall(g.session["team_id"])
+            for chall, tags, status in zip(
+                challs, Challenge.fetch_tags(challs), statuses
+            )
         ],
+        "total": total,
+        "categories": result.categories,
+        "tags": result.tags,
     }
+
+
+@blueprint.before_request
+def fetch_batch() -> ResponseReturnValue | None:
+    """Fetch the challenges listed in a batch request.
+
+    The IDs are read from the comma separated `ids` query parameter for GET requests and
+    from the `ids` list in the JSON body otherwise. Sets g.challs to the challenges that
+    exist and g.invalid_ids to the IDs that don't. Returns 400 if the list is missing or
+    too long.
+    """
+
+    if request.endpoint == "api.challenges.challenges":
+        return None
+    if request.method == "GET":
+        ids = [i for i in request.args.get("ids", "").split(",") if i]
+    else:
+        body = request.json
+        if (
+            not isinstance(body, dict)
+            or not isinstance(body.get("ids"), list)
+            or not all(isinstance(i, str) for i in body["ids"])
+        ):
+            return {
+                "status": "bad_request",
+                "msg": "ids must be a list of challenge IDs",
+            }, 400
+        ids = body["ids"]
+    # drop duplicates while keeping the order
+    ids = list(dict.fromkeys(ids))
+    if len(ids) == 0:
+        return {"status": "bad_request", "msg": "no challenge IDs given"}, 400
+    if len(ids) > BATCH_MAX_SIZE:
+        return {
+            "status": "too_many_challenges",
+            "msg": f"at most {BATCH_MAX_SIZE} challenges can be requested at once",
+        }, 400
+    g.challs = Challenge.fetch_many(ids, g.session["team_id"])
+    g.invalid_ids = [i for i in ids if i not in g.challs]
+    return None
+
+
+@blueprint.route("/deployments", methods=["GET"])
+def deployments() -> ResponseReturnValue:
+    """Return the deployment info of several challenges.
+
+    The response contains a `deployments` object from challenge ID to deployment info
+    (null if not deployed) and an `invalid_ids` list with the IDs that don't exist.
+    """
+
+    challs: dict[str, Challenge] = g.challs
+    invalid_ids = g.invalid_ids
+
+    def respond() -> ResponseReturnValue:
+        statuses = Challenge.deployment_statuses(list(challs.values()))
+        return {
+            "status": "ok",
+            "deployments": {
+                chall_id: deployment_info(status)
+                for chall_id, status in zip(challs, statuses)
+            },
+            "invalid_ids": invalid_ids,
+        }
+
+    namespaces = [chall.namespace for chall in challs.values()]
+    return conditional(
+        make_etag(
+            "deployments", *namespaces, *invalid_ids, *status_versions(namespaces)
+        ),
+        respond,
+    )
+
+
+@blueprint.route("/deploy", methods=["POST"])
+def deploy() -> ResponseReturnValue:
+    """Start or renew several challenge deployments concurrently.
+
+    The response contains a `results` object from challenge ID to the response the
+    single challenge deploy endpoint would have returned, and an `invalid_ids` list.
+    Each challenge is subject to the usual deploy rate limits.
+    """
+
+    if (captcha_error := check_captcha()) is not None:
+        return captcha_error
+    challs: dict[str, Challenge] = g.challs
+    team_id = g.session["team_id"]
+    with ThreadPoolExecutor(BATCH_CONCURRENCY) as executor:
+        results = executor.map(
+            lambda chall: start_challenge(chall, team_id)[0], challs.values()
+        )
+        return {
+            "status": "ok",
+            "results": dict(zip(challs, results)),
+            "invalid_ids": g.invalid_ids,
+        }
+
+
+@blueprint.route("/stop", methods=["POST"])
+def stop() -> ResponseReturnValue:
+    """Terminate several challenge deployments concurrently.
+
+    The response contains a `results` object from challenge ID to the response the
+    single challenge terminate endpoint would have returned, and an `invalid_ids` list.
+    """
+
+    challs: dict[str, Challenge] = g.challs
+    with ThreadPoolExecutor(BATCH_CONCURRENCY) as executor:
+        results = executor.map(lambda chall: stop_challenge(chall)[0], challs.values())
+        return {
+            "status": "ok",
+            "results": dict(zip(challs, results)),
+            "invalid_ids": g.invalid_ids,
+        }
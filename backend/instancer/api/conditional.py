@@ -0,0 +1,33 @@
+from hashlib import sha256
+from typing import Any, Callable
+
+from flask import make_response, request
+from flask.typing import ResponseReturnValue
+
+
+def make_etag(*parts: Any) -> str:
+    """Return a strong ETag derived from the given parts."""
+
+    return sha256("\0".join(str(part) for part in parts).encode()).hexdigest()[:32]
+
+
+def conditional(
+    etag: str, respond: Callable[[], ResponseReturnValue]
+) -> ResponseReturnValue:
+    """Handle a conditional GET.
+
+    Returns 304 without calling `respond` if the client's If-None-Match has the ETag,
+    otherwise the response from `respond`. Successful responses get the ETag and a
+    Cache-Control header that makes clients revalidate before reusing them.
+    """
+
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(respond())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    # every endpoint needs a session token, so shared caches must not store responses
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
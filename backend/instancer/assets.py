@@ -0,0 +1,112 @@
+import gzip
+import json
+import mimetypes
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from hashlib import sha256
+from typing import Any
+
+from flask import (
+    Flask,
+    Response,
+    make_response,
+    render_template,
+    request,
+    send_from_directory,
+)
+
+IMMUTABLE_PREFIX = "assets/"
+"Static files under this path have content hashes in their names and never change."
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+"Max age in seconds of immutable static files."
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+"Precompressed variants of static files, in order of preference."
+
+
+@dataclass(frozen=True)
+class Shell:
+    """The rendered index.html of the frontend."""
+
+    html: bytes
+    "The rendered page."
+    gzipped: bytes
+    "The gzip compressed page."
+    etag: str
+    "The ETag of the page."
+
+
+@lru_cache(maxsize=8)
+def _render_shell(client_conf: str) -> Shell:
+    html = render_template("index.html", client_conf=json.loads(client_conf)).encode()
+    return Shell(
+        html=html,
+        gzipped=gzip.compress(html, 9),
+        etag=sha256(html).hexdigest()[:32],
+    )
+
+
+def serve_shell(client_conf: dict[str, Any]) -> Response:
+    """Serve the frontend's index.html with the given client config.
+
+    The page is rendered and compressed once per config value and served from memory
+    afterwards."""
+
+    shell = _render_shell(json.dumps(client_conf, sort_keys=True))
+    if request.if_none_match.contains(shell.etag):
+        response = make_response("", 304)
+    elif request.accept_encodings.quality("gzip") > 0:
+        response = make_response(shell.gzipped)
+        response.content_encoding = "gzip"
+    else:
+        response = make_response(shell.html)
+    response.mimetype = "text/html"
+    response.set_etag(shell.etag)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = True
+    return response
+
+
+class InstancerFlask(Flask):
+    """Flask app that serves precompressed variants of static files when the client
+    accepts them, and lets hashed asset files be cached forever."""
+
+    static_files: set[str]
+    "Paths of all files in the static folder, relative to it."
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.static_files = set()
+        if self.static_folder is not None and os.path.isdir(self.static_folder):
+            for root, _, files in os.walk(self.static_folder):
+                for name in files:
+                    self.static_files.add(
+                        os.path.relpath(os.path.join(root, name), self.static_folder)
+                    )
+
+    def send_static_file(self, filename: str) -> Response:
+        assert self.static_folder is not None
+        immutable = filename.startswith(IMMUTABLE_PREFIX)
+        variants = [
+            (encoding, filename + ext)
+            for encoding, ext in ENCODINGS
+            if os.path.normpath(filename + ext) in self.static_files
+        ]
+        served, content_encoding = filename, None
+        for encoding, variant in variants:
+            if request.accept_encodings.quality(encoding) > 0:
+                served, content_encoding = variant, encoding
+                break
+        response = send_from_directory(
+            self.static_folder,
+            served,
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            max_age=IMMUTABLE_MAX_AGE if immutable else None,
+        )
+        if content_encoding is not None:
+            response.content_encoding = content_encoding
+        if len(variants) > 0:
+            response.vary.add("Accept-Encoding")
+        if immutable:
+            response.cache_control.immutable = True
+        return response
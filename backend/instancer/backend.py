@@ -5,9 +5,11 @@ import random
 import re
 from abc import ABC, abstractmethod
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
 from dataclasses import dataclass
 from hashlib import sha256
-from time import time
+from time import perf_counter, time
 from typing import Any, Self
 
 from kubernetes import client as kclient
@@ -15,10 +17,41 @@ from kubernetes import config as kconfig
 from kubernetes.client.exceptions import ApiException
 from psycopg.types.json import Jsonb
 
+from instancer.capacity import (
+    CapacityExceededError,
+    drain,
+    release,
+    reserve,
+    resource_amounts,
+)
+from instancer.catalog import (
+    CatalogEntry,
+    CatalogFilter,
+    CatalogResult,
+    bump_catalog_version,
+    search_catalog,
+    write_catalog_index,
+)
 from instancer.config import config, connect_pg, rclient
+from instancer.deploy_queue import remove_deploys
+from instancer.event_log import record_event
+from instancer.events import publish_event, publish_events
+from instancer.inventory import index_instance, unindex_instances
 from instancer.lock import Lock, LockException
+from instancer.metrics import count_cache, kube_call
+from instancer.ratelimit import RateLimitException
+from instancer.tracing import propagate, span, trace
 
 CHALL_CACHE_TIME = 3600
+DEFAULT_RESOURCES = {
+    "limits": {"cpu": "500m", "memory": "512Mi"},
+    "requests": {"cpu": "50m", "memory": "64Mi"},
+}
+"Resources of challenge containers that don't specify any."
+STOP_CONCURRENCY = 16
+"Maximum number of namespaces deleted at the same time when stopping several challenges."
+START_LOCK_WAIT = 30
+"Seconds a start waits for another start or renewal of the same instance to finish."
 
 if config.in_cluster:
     kconfig.load_incluster_config()
@@ -26,8 +59,40 @@ else:
     kconfig.load_kube_config()
 
 
-def snake_to_camel(snake: str) -> str:
-    return "".join(x.capitalize() for x in snake.lower().split("_"))
+class _MeteredApiClient(kclient.ApiClient):  # type: ignore[misc]
+    """Kubernetes API client that records the latency and errors of every call."""
+
+    def call_api(
+        self, resource_path: str, method: str, *args: Any, **kwargs: Any
+    ) -> Any:
+        with kube_call(method, resource_path):
+            return super().call_api(resource_path, method, *args, **kwargs)
+
+
+_kconf = kclient.Configuration.get_default_copy()
+_kconf.connection_pool_maxsize = config.kube_connection_pool_size
+kapi = _MeteredApiClient(_kconf)
+"Kubernetes API client shared by all requests so connections to the API server are reused."
+
+
+CONTAINER_OPTIONS = {
+    "args": "args",
+    "command": "command",
+    "imagePullPolicy": "image_pull_policy",
+    "stdin": "stdin",
+    "stdinOnce": "stdin_once",
+    "terminationMessagePath": "termination_message_path",
+    "terminationMessagePolicy": "termination_message_policy",
+    "tty": "tty",
+    "workingDir": "working_dir",
+}
+"Container config keys copied as is to the V1Container argument they map to."
+CONTAINER_PROBES = {
+    "livenessProbe": "liveness_probe",
+    "readinessProbe": "readiness_probe",
+    "startupProbe": "startup_probe",
+}
+"Container config keys of probes and the V1Container argument they map to."
 
 
 def camel_to_snake(camel: str) -> str:
@@ -38,24 +103,40 @@ def keys_to_snake(d: dict[str, Any]) -> dict[str, Any]:
     return {camel_to_snake(k): v for (k, v) in d.items()}
 
 
+def config_to_probe(cfg: dict[str, Any]) -> kclient.V1Probe:
+    kwargs = keys_to_snake(
+        {
+            k: v
+            for (k, v) in cfg.items()
+            if k not in ["exec", "httpGet", "tcpSocket", "grpc"]
+        }
+    )
+    if "exec" in cfg:
+        kwargs["_exec"] = kclient.V1ExecAction(**keys_to_snake(cfg["exec"]))
+    if "httpGet" in cfg:
+        http_get = keys_to_snake(cfg["httpGet"])
+        if "http_headers" in http_get:
+            http_get["http_headers"] = [
+                kclient.V1HTTPHeader(name=x["name"], value=x["value"])
+                for x in http_get["http_headers"]
+            ]
+        kwargs["http_get"] = kclient.V1HTTPGetAction(**http_get)
+    if "tcpSocket" in cfg:
+        kwargs["tcp_socket"] = kclient.V1TCPSocketAction(
+            **keys_to_snake(cfg["tcpSocket"])
+        )
+    if "grpc" in cfg:
+        kwargs["grpc"] = kclient.V1GRPCAction(**keys_to_snake(cfg["grpc"]))
+    return kclient.V1Probe(**kwargs)
+
+
 def config_to_container(
     cont_name: str, cfg: dict[str, Any], env_metadata: Any = None
 ) -> kclient.V1Container:
     kwargs: dict[str, Any] = {}
     kwargs["name"] = cont_name
     kwargs["image"] = cfg["image"]
-    for prop in [
-        "args",
-        "command",
-        "image_pull_policy",
-        "stdin",
-        "stdin_once",
-        "termination_message_path",
-        "termination_message_policy",
-        "tty",
-        "working_dir",
-    ]:
-        cprop = snake_to_camel(prop)
+    for cprop, prop in CONTAINER_OPTIONS.items():
         if cprop in cfg:
             kwargs[prop] = cfg[cprop]
     env = [
@@ -71,19 +152,9 @@ def config_to_container(
             kclient.V1EnvVar(name="INSTANCER_METADATA", value=json.dumps(env_metadata))
         )
     kwargs["env"] = env
-    for prop in [
-        "env_from",
-        "lifecycle",
-        "liveness_probe",
-        "readiness_probe",
-        "startup_probe",
-        "volume_devices",
-        "volume_mounts",
-    ]:
-        if snake_to_camel(prop) in cfg:
-            raise NotImplementedError(
-                f"{prop} container config currently not supported"
-            )
+    for cprop, prop in CONTAINER_PROBES.items():
+        if cprop in cfg:
+            kwargs[prop] = config_to_probe(cfg[cprop])
     ports: list[kclient.V1ContainerPort] = []
     if "kubePorts" in cfg:
         ports.extend(
@@ -101,13 +172,188 @@ def config_to_container(
             **keys_to_snake(cfg["resources"])
         )
     else:
-        kwargs["resources"] = kclient.V1ResourceRequirements(
-            limits={"cpu": "500m", "memory": "512Mi"},
-            requests={"cpu": "50m", "memory": "64Mi"},
-        )
+        kwargs["resources"] = kclient.V1ResourceRequirements(**DEFAULT_RESOURCES)
     return kclient.V1Container(**kwargs)
 
 
+def container_replicas(cfg: dict[str, Any]) -> int:
+    """Return the number of replicas a container config starts with."""
+
+    return int(
+        max(cfg.get("replicas", 1), cfg.get("autoscaling", {}).get("minReplicas", 1))
+    )
+
+
+def container_max_replicas(cfg: dict[str, Any]) -> int:
+    """Return the most replicas a container config can run, which for an autoscaled
+    container is its autoscaler's maximum."""
+
+    return max(
+        container_replicas(cfg), int(cfg.get("autoscaling", {}).get("maxReplicas", 1))
+    )
+
+
+def container_requests(cfg: dict[str, Any]) -> dict[str, int]:
+    """Return the CPU (millicores) and memory (bytes) requested by the most replicas a
+    container config can run, so autoscaling never grows an instance past its
+    reservation.
+
+    Like Kubernetes, limits are used for resources that have no request."""
+
+    resources = cfg.get("resources", DEFAULT_RESOURCES)
+    replicas = container_max_replicas(cfg)
+    return {
+        name: amount * replicas
+        for name, amount in resource_amounts(
+            {**resources.get("limits", {}), **resources.get("requests", {})}
+        ).items()
+    }
+
+
+def config_to_autoscaler(
+    name: str, cfg: dict[str, Any], labels: dict[str, str]
+) -> kclient.V2HorizontalPodAutoscaler | None:
+    """Convert the autoscaling settings of a container config to a HorizontalPodAutoscaler
+    for its deployment, or return None if the container doesn't autoscale."""
+
+    autoscaling = cfg.get("autoscaling")
+    if autoscaling is None:
+        return None
+    # like kubectl autoscale, target 80% CPU utilization unless told otherwise
+    targets = {
+        resource: autoscaling[key]
+        for resource, key in [
+            ("cpu", "targetCPUUtilizationPercentage"),
+            ("memory", "targetMemoryUtilizationPercentage"),
+        ]
+        if key in autoscaling
+    } or {"cpu": 80}
+    return kclient.V2HorizontalPodAutoscaler(
+        metadata=kclient.V1ObjectMeta(name=name, labels=labels),
+        spec=kclient.V2HorizontalPodAutoscalerSpec(
+            scale_target_ref=kclient.V2CrossVersionObjectReference(
+                api_version="apps/v1", kind="Deployment", name=name
+            ),
+            min_replicas=container_replicas(cfg),
+            max_replicas=autoscaling["maxReplicas"],
+            metrics=[
+                kclient.V2MetricSpec(
+                    type="Resource",
+                    resource=kclient.V2ResourceMetricSource(
+                        name=resource,
+                        target=kclient.V2MetricTarget(
+                            type="Utilization", average_utilization=utilization
+                        ),
+                    ),
+                )
+                for resource, utilization in targets.items()
+            ],
+        ),
+    )
+
+
+def instance_suffix(namespace: str) -> str:
+    """Return the suffix added to the object names of a label-scoped instance, which
+    keeps them apart from the other instances in the same Kubernetes namespace."""
+
+    return sha256(namespace.encode()).hexdigest()[:8]
+
+
+def random_subdomain(domain: str) -> str:
+    """Add a random suffix to the first label of a domain, so every instance of a
+    per-team challenge gets its own."""
+
+    chunks = domain.split(".")
+    chunks[0] += "-" + "".join(
+        random.choices("abcdefghijklmnopqrstuvwxyz0123456789", k=5)
+    )
+    return ".".join(chunks)
+
+
+def tcp_domain(chall_id: str, cont_name: str, port: int) -> str:
+    """Return the domain Traefik routes an exposed TCP port of a challenge container by
+    when TCP ports are exposed through SNI."""
+
+    label = f"{chall_id}-{cont_name}-{port}"
+    # leave room for the random suffix of per-team instances
+    if len(label) > 57:
+        label = "tcp-" + sha256(label.encode()).hexdigest()[:53]
+    return f"{label}.{config.challenge_host}"
+
+
+def tcp_routes(
+    chall_id: str, exposed_ports: dict[str, list[int]], randomize: bool
+) -> dict[str, list[tuple[int, str]]]:
+    """Return the port, domain pairs Traefik routes the exposed TCP ports of a challenge
+    by, or nothing if TCP ports are exposed through NodePorts."""
+
+    if config.tcp_exposure != "sni":
+        return {}
+    return {
+        cont_name: [
+            (
+                port,
+                random_subdomain(tcp_domain(chall_id, cont_name, port))
+                if randomize
+                else tcp_domain(chall_id, cont_name, port),
+            )
+            for port in ports
+        ]
+        for cont_name, ports in exposed_ports.items()
+    }
+
+
+def _delete_custom_objects(plural: str, kube_namespace: str, selector: str) -> None:
+    """Delete the Traefik objects matching a label selector one by one, since the
+    client's deletecollection for custom objects doesn't take a selector."""
+
+    crdapi = kclient.CustomObjectsApi(kapi)
+    for obj in crdapi.list_namespaced_custom_object(
+        "traefik.io", "v1alpha1", kube_namespace, plural, label_selector=selector
+    )["items"]:
+        try:
+            crdapi.delete_namespaced_custom_object(
+                "traefik.io",
+                "v1alpha1",
+                kube_namespace,
+                plural,
+                obj["metadata"]["name"],
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise e
+
+
+def delete_label_scoped(namespace: str, kube_namespace: str) -> None:
+    """Delete the objects of a label-scoped instance from the Kubernetes namespace it
+    shares with other instances, with one deletecollection request per kind of object.
+
+    The network policies go last so the pods stay isolated while they terminate."""
+
+    selector = f"instancer.acmcyber.com/instance-key={namespace}"
+    kclient.AppsV1Api(kapi).delete_collection_namespaced_deployment(
+        kube_namespace, label_selector=selector, grace_period_seconds=0
+    )
+    kclient.AutoscalingV2Api(
+        kapi
+    ).delete_collection_namespaced_horizontal_pod_autoscaler(
+        kube_namespace, label_selector=selector
+    )
+    kclient.CoreV1Api(kapi).delete_collection_namespaced_service(
+        kube_namespace, label_selector=selector
+    )
+    _delete_custom_objects("ingressroutes", kube_namespace, selector)
+    try:
+        _delete_custom_objects("ingressroutetcps", kube_namespace, selector)
+    except ApiException as e:
+        # clusters that never exposed TCP ports through SNI may not have the CRD
+        if e.status != 404:
+            raise e
+    kclient.NetworkingV1Api(kapi).delete_collection_namespaced_network_policy(
+        kube_namespace, label_selector=selector
+    )
+
+
 class ResourceUnavailableError(Exception):
     """Error thrown when a resource is temporarily unavailable.
 
@@ -146,6 +392,8 @@ class DeploymentInfo:
     "The expiration time."
     start_timestamp: int
     "Time to first display challenge connection details"
+    ready_timestamp: int | None
+    "Time all containers of the deployment became ready, or None if that hasn't been observed."
     port_mappings: dict[tuple[str, int], int | str]
     "Mapping from a tuple of the container name and internal port to the external port or HTTPS domain."
 
@@ -208,9 +456,21 @@ def _cache_chall_info(chall_id: str, info: _ChallengeInfo) -> None:
 
 def _cached_chall_info(chall_id: str) -> _ChallengeInfo | None:
     cached = rclient.get(f"chall:{chall_id}")
+    count_cache("chall", [cached is not None])
     return None if cached is None else _ChallengeInfo.from_json(cached)
 
 
+def _cached_chall_infos(chall_ids: list[str]) -> list[_ChallengeInfo | None]:
+    if len(chall_ids) == 0:
+        return []
+    results = rclient.mget([f"chall:{chall_id}" for chall_id in chall_ids])
+    count_cache("chall", (cached is not None for cached in results))
+    return [
+        None if cached is None else _ChallengeInfo.from_json(cached)
+        for cached in results
+    ]
+
+
 def _cache_chall_tags(chall_id: str, tags: list[ChallengeTag]) -> None:
     rclient.set(
         f"chall_tags:{chall_id}",
@@ -221,6 +481,7 @@ def _cache_chall_tags(chall_id: str, tags: list[ChallengeTag]) -> None:
 
 def _cached_chall_tags(chall_id: str) -> list[ChallengeTag] | None:
     cached = rclient.get(f"chall_tags:{chall_id}")
+    count_cache("chall_tags", [cached is not None])
     return (
         None
         if cached is None
@@ -230,6 +491,24 @@ def _cached_chall_tags(chall_id: str) -> list[ChallengeTag] | None:
     )
 
 
+def _cached_chall_tags_many(chall_ids: list[str]) -> list[list[ChallengeTag] | None]:
+    if len(chall_ids) == 0:
+        return []
+    results = rclient.mget([f"chall_tags:{chall_id}" for chall_id in chall_ids])
+    count_cache("chall_tags", (cached is not None for cached in results))
+    return [
+        (
+            None
+            if cached is None
+            else [
+                ChallengeTag(name, is_category)
+                for name, is_category in json.loads(cached)
+            ]
+        )
+        for cached in results
+    ]
+
+
 def _make_challenge(chall_id: str, info: _ChallengeInfo, team_id: str) -> Challenge:
     metadata = ChallengeMetadata(info.name, info.description, info.author)
     if info.per_team:
@@ -259,8 +538,16 @@ class Challenge(ABC):
     "Mapping from container name to list of container ports to expose"
     http_ports: dict[str, list[tuple[int, str]]]
     "Mapping from container name to list of port, subdomain pairs to expose to an HTTP proxy"
+    tcp_routes: dict[str, list[tuple[int, str]]]
+    """Mapping from container name to list of exposed port, domain pairs Traefik routes by
+    SNI, empty if exposed ports get NodePorts."""
     namespace: str
-    "The kubernetes namespace the challenge is running in."
+    """The kubernetes namespace the challenge is running in. Label-scoped instances
+    have no namespace of their own, but still use this name as their key."""
+    kube_namespace: str
+    "The kubernetes namespace the objects of the challenge are created in."
+    label_scoped: bool
+    "Whether the instance shares its kubernetes namespace with other instances."
     additional_labels: dict[str, Any]
     "Additional labels for the challenge deployments."
     additional_env_metadata: dict[str, Any]
@@ -277,8 +564,10 @@ class Challenge(ABC):
         namespace: str,
         exposed_ports: dict[str, list[int]],
         http_ports: dict[str, list[tuple[int, str]]],
+        tcp_routes: dict[str, list[tuple[int, str]]] = {},
         additional_labels: dict[str, Any] = {},
         additional_env_metadata: dict[str, Any] = {},
+        kube_namespace: str | None = None,
     ):
         self.id = chall_id
         self.lifetime = lifetime
@@ -287,19 +576,37 @@ class Challenge(ABC):
         if len(namespace) > 63:
             namespace = "ci-" + sha256(namespace.encode()).hexdigest()[:60]
         self.namespace = namespace
+        if kube_namespace is not None and len(kube_namespace) > 63:
+            kube_namespace = "ci-" + sha256(kube_namespace.encode()).hexdigest()[:60]
+        self.kube_namespace = kube_namespace or namespace
+        self.label_scoped = kube_namespace is not None
         self.containers = cfg["containers"]
         self.exposed_ports = exposed_ports
         self.http_ports = http_ports
+        self.tcp_routes = tcp_routes
         self.additional_labels = additional_labels
         self.additional_env_metadata = additional_env_metadata
 
     def is_running(self) -> bool:
         return self.expiration() is not None
 
+    def object_name(self, name: str) -> str:
+        """Return the name of a Kubernetes object of the instance."""
+        if not self.label_scoped:
+            return name
+        return f"{name}-{instance_suffix(self.namespace)}"
+
+    def _base_name(self, name: str) -> str:
+        """Return the name an object of the instance was created for."""
+        if not self.label_scoped:
+            return name
+        return name.removesuffix(f"-{instance_suffix(self.namespace)}")
+
     @staticmethod
     def flush_cache(chall_id: str) -> None:
         """Forcibly flushes the cache of a challenge."""
         rclient.delete("all_challs", f"chall:{chall_id}", f"chall_tags:{chall_id}")
+        bump_catalog_version()
 
         # Delete any per-team cached challenges
         pattern = f"ports:ci-{chall_id}*"
@@ -388,63 +695,95 @@ class Challenge(ABC):
         """Fetch all challenges, including categories and tags.
 
         Returns a list where each element is a tuple of a Challenge and its tags.
-        Challenges are returned in an unspecified order.
+        Challenges are sorted by name.
         """
 
-        cache_key = "all_challs"
-        cached = rclient.get(cache_key)
+        cached = rclient.get("all_challs")
+        count_cache("all_challs", [cached is not None])
         if cached is not None:
             chall_ids = json.loads(cached)
+            challs = list(cls.fetch_many(chall_ids, team_id).values())
+            return list(zip(challs, cls.fetch_tags(challs)))
+        else:
             return [
-                (chall, chall.tags())
-                for chall_id in chall_ids
-                if (chall := cls.fetch(chall_id, team_id)) is not None
+                (_make_challenge(chall_id, chall_info, team_id), chall_tags)
+                for chall_id, chall_info, chall_tags in cls._load_catalog()
             ]
-        else:
-            with connect_pg() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "SELECT id, cfg, per_team, lifetime, boot_time, name, description, author FROM challenges"
-                    )
-                    all_challs = [
-                        (
-                            chall_id,
-                            _ChallengeInfo(
-                                cfg=cfg,
-                                per_team=per_team,
-                                lifetime=lifetime,
-                                boot_time=boot_time,
-                                name=name,
-                                description=description,
-                                author=author,
-                            ),
-                        )
-                        for chall_id, cfg, per_team, lifetime, boot_time, name, description, author in cur.fetchall()
-                    ]
-                    cur.execute(
-                        "SELECT challenge_id, name, is_category FROM tags ORDER BY is_category DESC, name"
+
+    @staticmethod
+    def _load_catalog() -> list[tuple[str, _ChallengeInfo, list[ChallengeTag]]]:
+        """Load every challenge and its tags from the database.
+
+        The challenge and tag caches and the catalog index are refreshed with the result.
+        Returns a list of tuples of the challenge ID, info and tags, sorted by name.
+        """
+
+        with connect_pg() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, cfg, per_team, lifetime, boot_time, name, description, author FROM challenges"
+                )
+                all_challs = [
+                    (
+                        chall_id,
+                        _ChallengeInfo(
+                            cfg=cfg,
+                            per_team=per_team,
+                            lifetime=lifetime,
+                            boot_time=boot_time,
+                            name=name,
+                            description=description,
+                            author=author,
+                        ),
                     )
-                    all_tags = [
-                        (chall_id, ChallengeTag(name, is_category))
-                        for chall_id, name, is_category in cur.fetchall()
-                    ]
-            rclient.set(
-                cache_key,
-                json.dumps([chall_id for chall_id, chall_info in all_challs]),
-                ex=CHALL_CACHE_TIME,
-            )
-            for chall_id, chall_info in all_challs:
-                _cache_chall_info(chall_id, chall_info)
-            tags: dict[str, list[ChallengeTag]] = defaultdict(list)
-            for chall_id, tag in all_tags:
-                tags[chall_id].append(tag)
-            result = [
-                (_make_challenge(chall_id, chall_info, team_id), tags.get(chall_id, []))
+                    for chall_id, cfg, per_team, lifetime, boot_time, name, description, author in cur.fetchall()
+                ]
+                cur.execute(
+                    "SELECT challenge_id, name, is_category FROM tags ORDER BY is_category DESC, name"
+                )
+                all_tags = [
+                    (chall_id, ChallengeTag(name, is_category))
+                    for chall_id, name, is_category in cur.fetchall()
+                ]
+        tags: dict[str, list[ChallengeTag]] = defaultdict(list)
+        for chall_id, tag in all_tags:
+            tags[chall_id].append(tag)
+        all_challs.sort(key=lambda chall: (chall[1].name.lower(), chall[0]))
+        for chall_id, chall_info in all_challs:
+            _cache_chall_info(chall_id, chall_info)
+            _cache_chall_tags(chall_id, tags.get(chall_id, []))
+        write_catalog_index(
+            [
+                CatalogEntry(
+                    id=chall_id,
+                    name=chall_info.name,
+                    author=chall_info.author,
+                    tags=[
+                        (tag.name, tag.is_category) for tag in tags.get(chall_id, [])
+                    ],
+                )
                 for chall_id, chall_info in all_challs
-            ]
-            for chall, chall_tags in result:
-                _cache_chall_tags(chall.id, chall_tags)
-            return result
+            ],
+            CHALL_CACHE_TIME,
+        )
+        return [
+            (chall_id, chall_info, tags.get(chall_id, []))
+            for chall_id, chall_info in all_challs
+        ]
+
+    @classmethod
+    def search(cls, flt: CatalogFilter) -> CatalogResult:
+        """Return the IDs of the challenges matching a filter, sorted by name, and the
+        categories and tags of the whole catalog.
+
+        The catalog index is rebuilt from the database if it isn't cached."""
+
+        for _ in range(3):
+            result = search_catalog(flt)
+            if result is not None:
+                return result
+            cls._load_catalog()
+        raise RuntimeError("catalog index could not be built")
 
     @staticmethod
     def fetch(challenge_id: str, team_id: str) -> Challenge | None:
@@ -455,7 +794,7 @@ class Challenge(ABC):
         info = _cached_chall_info(challenge_id)
         if info is None:
             with connect_pg() as conn:
-                with conn.cursor() as cur:
+                with conn.cursor() as cur, span("postgres.fetch_challenge"):
                     cur.execute(
                         "SELECT cfg, per_team, lifetime, boot_time, name, description, author FROM challenges WHERE id=%s",
                         (challenge_id,),
@@ -477,6 +816,50 @@ class Challenge(ABC):
 
         return _make_challenge(challenge_id, info, team_id)
 
+    @staticmethod
+    def fetch_many(challenge_ids: list[str], team_id: str) -> dict[str, Challenge]:
+        """Fetches the appropriate Challenge instances given several challenge IDs and a team ID.
+
+        Returns a dict from challenge ID to Challenge in the order of challenge_ids.
+        Challenges that don't exist are left out."""
+
+        infos = dict(zip(challenge_ids, _cached_chall_infos(challenge_ids)))
+        missing = [chall_id for chall_id, info in infos.items() if info is None]
+        if len(missing) > 0:
+            with connect_pg() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT id, cfg, per_team, lifetime, boot_time, name, description, author FROM challenges WHERE id = ANY(%s)",
+                        (missing,),
+                    )
+                    for (
+                        chall_id,
+                        cfg,
+                        per_team,
+                        lifetime,
+                        boot_time,
+                        name,
+                        description,
+                        author,
+                    ) in cur.fetchall():
+                        info = _ChallengeInfo(
+                            cfg=cfg,
+                            per_team=per_team,
+                            lifetime=lifetime,
+                            name=name,
+                            description=description,
+                            author=author,
+                            boot_time=boot_time,
+                        )
+                        _cache_chall_info(chall_id, info)
+                        infos[chall_id] = info
+
+        return {
+            chall_id: _make_challenge(chall_id, info, team_id)
+            for chall_id, info in infos.items()
+            if info is not None
+        }
+
     @staticmethod
     def fetch_info(challenge_id: str) -> _ChallengeInfo | None:
         """Fetches information on a given challenge by ID
@@ -486,7 +869,7 @@ class Challenge(ABC):
         info = _cached_chall_info(challenge_id)
         if info is None:
             with connect_pg() as conn:
-                with conn.cursor() as cur:
+                with conn.cursor() as cur, span("postgres.fetch_challenge"):
                     cur.execute(
                         "SELECT cfg, per_team, lifetime, boot_time, name, description, author FROM challenges WHERE id=%s",
                         (challenge_id,),
@@ -528,6 +911,17 @@ class Challenge(ABC):
 
         return result
 
+    @staticmethod
+    def fetch_tags(challs: list[Challenge]) -> list[list[ChallengeTag]]:
+        """Return the tags of several challenges, reading the cached tags in one round trip."""
+
+        return [
+            tags if tags is not None else chall.tags()
+            for chall, tags in zip(
+                challs, _cached_chall_tags_many([chall.id for chall in challs])
+            )
+        ]
+
     def replace_tags(self, new_tags: list[ChallengeTag]) -> None:
         """Replace tags with a new list of ChallengeTags"""
 
@@ -557,8 +951,21 @@ class Challenge(ABC):
             return None
         return int(st)
 
+    def ready_timestamp(self) -> int | None:
+        """Returns the time all containers of a challenge became ready as a UNIX timestamp, or None if that hasn't been observed."""
+        rt = rclient.zscore("ready_time", self.namespace)
+        if rt is None:
+            return None
+        return int(rt)
+
     def start_timestamp(self) -> int | None:
-        """Returns the time a challenge details should be displayed to the user as a UNIX timestamp, or None if it isn't running."""
+        """Returns the time a challenge details should be displayed to the user as a UNIX timestamp, or None if it isn't running.
+
+        This is the time the challenge became ready if the worker observed it, or boot_time seconds after it was started otherwise.
+        """
+        ready_time_stamp = self.ready_timestamp()
+        if ready_time_stamp is not None:
+            return ready_time_stamp
         boot_time_stamp = self.boot_timestamp()
         return boot_time_stamp + self.boot_time if boot_time_stamp is not None else None
 
@@ -567,18 +974,97 @@ class Challenge(ABC):
         """Returns True if challenge is shared, e.g. should not be terminatable"""
         raise NotImplementedError
 
-    def start(self) -> None:
-        """Starts a challenge, or renews it if it was already running."""
-        api = kclient.AppsV1Api()
-        capi = kclient.CoreV1Api()
-        crdapi = kclient.CustomObjectsApi()
-        napi = kclient.NetworkingV1Api()
+    def resource_requests(self) -> dict[str, int]:
+        """Return the CPU (millicores) and memory (bytes) requested by one instance of the challenge."""
+
+        total: dict[str, int] = defaultdict(int)
+        for container in self.containers.values():
+            for name, amount in container_requests(container).items():
+                total[name] += amount
+        return dict(total)
+
+    def _make_kube_namespace(self, capi: kclient.CoreV1Api) -> None:
+        """Create the namespace shared by the label-scoped instances of the challenge if
+        it doesn't exist yet.
+
+        It isn't labeled with the instance ID, so it isn't mistaken for an instance."""
+        try:
+            capi.create_namespace(
+                kclient.V1Namespace(
+                    metadata=kclient.V1ObjectMeta(
+                        name=self.kube_namespace,
+                        labels={"instancer.acmcyber.com/instance-pool": self.id},
+                    )
+                )
+            )
+            print(f"[*] Made shared namespace {self.kube_namespace}...")
+        except ApiException as e:
+            if e.status != 409:
+                raise e
+
+    def start(
+        self,
+        skip_queue: bool = False,
+        slot: AbstractContextManager[None] | None = None,
+    ) -> None:
+        """Starts a challenge, or renews it if it was already running.
+
+        Raises CapacityExceededError if starting a new instance would overcommit the cluster,
+        or if other deploys are queued and `skip_queue` isn't set. If `slot` is given, it is
+        held from when the instance's lock is taken until the start is done, so waiting
+        on the lock doesn't hold it.
+        """
+        team_id = self.additional_labels.get("instancer.acmcyber.com/team-id")
+        started = perf_counter()
+        renewed = False
+        try:
+            with trace("start", challenge=self.id, namespace=self.namespace):
+                renewed = self._start(skip_queue, slot or nullcontext())
+        except (
+            CapacityExceededError,
+            ResourceUnavailableError,
+            RateLimitException,
+        ) as e:
+            record_event(
+                self.id,
+                team_id,
+                "deploy",
+                "rejected",
+                perf_counter() - started,
+                error=type(e).__name__,
+            )
+            raise
+        except Exception as e:
+            record_event(
+                self.id,
+                team_id,
+                "deploy",
+                "failed",
+                perf_counter() - started,
+                error=type(e).__name__,
+            )
+            raise
+        record_event(
+            self.id,
+            team_id,
+            "renew" if renewed else "deploy",
+            "ok",
+            perf_counter() - started,
+        )
+
+    def _start(self, skip_queue: bool, slot: AbstractContextManager[None]) -> bool:
+        """Start or renew the challenge. Returns whether it was renewed."""
+        api = kclient.AppsV1Api(kapi)
+        capi = kclient.CoreV1Api(kapi)
+        crdapi = kclient.CustomObjectsApi(kapi)
+        napi = kclient.NetworkingV1Api(kapi)
+        hpaapi = kclient.AutoscalingV2Api(kapi)
 
         curtime = int(time())
         expiration = curtime + self.lifetime
 
         env_metadata = {
-            "namespace": self.namespace,
+            "namespace": self.kube_namespace,
             "instance_id": self.id,
             "http": {
                 contname: {
@@ -597,52 +1083,102 @@ class Challenge(ABC):
             "instancer.acmcyber.com/instance-id": self.id,
             **self.additional_labels,
         }
+        # pods of other instances in the namespace aren't selected by the policies
+        scope_labels = {}
+        if self.label_scoped:
+            scope_labels = {
+                "instancer.acmcyber.com/instance-key": self.namespace,
+                "instancer.acmcyber.com/instance-pool": self.kube_namespace,
+            }
+            common_labels.update(scope_labels)
+        # label-scoped instances keep their state on the deployment of their only container
+        anchor = self.object_name(next(iter(self.containers)))
 
         namespace_made = False
+        reserved = False
 
         try:
-            with Lock(self.namespace):
+            with Lock(self.namespace, wait=START_LOCK_WAIT) as lock, slot:
                 try:
-                    curns = capi.read_namespace(self.namespace)
-                    if curns.status.phase == "Terminating":
+                    with span("kube.read_instance"):
+                        if self.label_scoped:
+                            curobj = api.read_namespaced_deployment(
+                                anchor, self.kube_namespace
+                            )
+                        else:
+                            curobj = capi.read_namespace(self.namespace)
+                    if self.label_scoped:
+                        terminating = curobj.metadata.deletion_timestamp is not None
+                    else:
+                        terminating = curobj.status.phase == "Terminating"
+                    if terminating:
                         raise ResourceUnavailableError(
                             f"namespace {self.namespace} is still terminating"
                         )
                     print(f"[*] Renewing namespace {self.namespace}...")
-                    curns.metadata.annotations[
+                    curobj.metadata.annotations[
                         "instancer.acmcyber.com/chall-expires"
                     ] = str(expiration)
-                    curns.metadata.annotations[
+                    curobj.metadata.annotations[
                         "instancer.acmcyber.com/chall-start-time"
                     ] = str(curtime)
-                    capi.replace_namespace(self.namespace, curns)
-                    rclient.zadd("expiration", {self.namespace: expiration})
-                    return
+                    with span("kube.renew"):
+                        if self.label_scoped:
+                            api.replace_namespaced_deployment(
+                                anchor, self.kube_namespace, curobj
+                            )
+                        else:
+                            capi.replace_namespace(self.namespace, curobj)
+                    pipe = rclient.pipeline()
+                    pipe.zadd("expiration", {self.namespace: expiration})
+                    pipe.zadd("renew_time", {self.namespace: curtime})
+                    with span("redis.renew"):
+                        pipe.execute()
+                    publish_event(self.namespace, "renewed", expiration=expiration)
+                    return True
                 except ApiException as e:
                     if e.status != 404:
                         raise e
-                    print(f"[*] Making namespace {self.namespace}...")
-                    capi.create_namespace(
-                        kclient.V1Namespace(
-                            metadata=kclient.V1ObjectMeta(
-                                name=self.namespace,
-                                annotations={
-                                    "instancer.acmcyber.com/chall-expires": str(
-                                        expiration
-                                    ),
-                                    "instancer.acmcyber.com/chall-start-time": str(
-                                        curtime
-                                    ),
-                                },
-                                labels=common_labels,
-                            )
+                    with span("redis.reserve"):
+                        reserve(
+                            self.namespace, self.resource_requests(), skip_queue, lock
                         )
-                    )
+                    reserved = True
+                    # index the instance right away so its events bump its team's
+                    # status version
+                    pipe = rclient.pipeline(transaction=False)
+                    index_instance(pipe, self.namespace, common_labels)
+                    with span("redis.index"):
+                        pipe.execute()
+                    publish_event(self.namespace, "queued")
+                    # clear the ready time of a previous instance in case its cleanup failed
+                    with span("redis.clear_ready_time"):
+                        rclient.zrem("ready_time", self.namespace)
+                    annotations = {
+                        "instancer.acmcyber.com/chall-expires": str(expiration),
+                        "instancer.acmcyber.com/chall-start-time": str(curtime),
+                        "instancer.acmcyber.com/chall-boot-time": str(curtime),
+                    }
+                    with span("kube.create_namespace"):
+                        if self.label_scoped:
+                            self._make_kube_namespace(capi)
+                        else:
+                            print(f"[*] Making namespace {self.namespace}...")
+                            capi.create_namespace(
+                                kclient.V1Namespace(
+                                    metadata=kclient.V1ObjectMeta(
+                                        name=self.namespace,
+                                        annotations=annotations,
+                                        labels=common_labels,
+                                    )
+                                )
+                            )
 
                 namespace_made = True
+                publish_event(self.namespace, "namespace_created")
                 for depname, container in self.containers.items():
                     print(
-                        f"[*] Making deployment {depname} under namespace {self.namespace}..."
+                        f"[*] Making deployment {depname} under namespace {self.kube_namespace}..."
                     )
                     labels = {
                         **common_labels,
@@ -662,19 +1198,26 @@ class Challenge(ABC):
                     }
                     dep = kclient.V1Deployment(
                         metadata=kclient.V1ObjectMeta(
-                            name=depname,
+                            name=self.object_name(depname),
                             labels=labels,
+                            annotations=annotations if self.label_scoped else None,
                         ),
                         spec=kclient.V1DeploymentSpec(
                             selector=kclient.V1LabelSelector(match_labels=pod_labels),
-                            replicas=1,
+                            replicas=container_replicas(container),
                             template=kclient.V1PodTemplateSpec(
                                 metadata=kclient.V1ObjectMeta(
                                     labels=pod_labels,
                                     annotations={
                                         "instancer.acmcyber.com/chall-started": str(
                                             curtime
-                                        )
+                                        ),
+                                        "instancer.acmcyber.com/instance-pods": str(
+                                            sum(
+                                                container_replicas(cont)
+                                                for cont in self.containers.values()
+                                            )
+                                        ),
                                     },
                                 ),
                                 spec=kclient.V1PodSpec(
@@ -695,7 +1238,16 @@ class Challenge(ABC):
                             ),
                         ),
                     )
-                    api.create_namespaced_deployment(self.namespace, dep)
+                    with span("kube.create_deployment", container=depname):
+                        api.create_namespaced_deployment(self.kube_namespace, dep)
+                    hpa = config_to_autoscaler(
+                        self.object_name(depname), container, labels
+                    )
+                    if hpa is not None:
+                        with span("kube.create_autoscaler", container=depname):
+                            hpaapi.create_namespaced_horizontal_pod_autoscaler(
+                                self.kube_namespace, hpa
+                            )
 
                 for servname, container in self.containers.items():
                     exposed_ports = self.exposed_ports.get(servname, [])
@@ -709,40 +1261,55 @@ class Challenge(ABC):
                         **common_labels,
                         "instancer.acmcyber.com/container-name": servname,
                     }
+                    external_name = (
+                        servname + "-instancer-external" if multiservice else servname
+                    )
                     serv_specs = []
                     if len(exposed_ports) > 0:
                         serv_specs.append(
-                            kclient.V1ServiceSpec(
-                                selector=selector,
-                                ports=[
-                                    kclient.V1ServicePort(port=port, target_port=port)
-                                    for port in exposed_ports
-                                ],
-                                type="NodePort",
+                            (
+                                external_name,
+                                kclient.V1ServiceSpec(
+                                    selector=selector,
+                                    ports=[
+                                        kclient.V1ServicePort(
+                                            port=port, target_port=port
+                                        )
+                                        for port in exposed_ports
+                                    ],
+                                    # Traefik reaches ports routed by SNI from inside
+                                    # the cluster
+                                    type=(
+                                        "ClusterIP"
+                                        if servname in self.tcp_routes
+                                        else "NodePort"
+                                    ),
+                                ),
                             )
                         )
                     if len(private_ports) > 0:
                         serv_specs.append(
-                            kclient.V1ServiceSpec(
-                                selector=selector,
-                                ports=[
-                                    kclient.V1ServicePort(port=port, target_port=port)
-                                    for port in private_ports
-                                ],
-                                type="ClusterIP",
+                            (
+                                servname,
+                                kclient.V1ServiceSpec(
+                                    selector=selector,
+                                    ports=[
+                                        kclient.V1ServicePort(
+                                            port=port, target_port=port
+                                        )
+                                        for port in private_ports
+                                    ],
+                                    type="ClusterIP",
+                                ),
                             )
                         )
-                    for serv_spec in serv_specs:
+                    for name, serv_spec in serv_specs:
                         print(
-                            f"[*] Making service {servname} under namespace {self.namespace}..."
+                            f"[*] Making service {servname} under namespace {self.kube_namespace}..."
                         )
                         serv = kclient.V1Service(
                             metadata=kclient.V1ObjectMeta(
-                                name=(
-                                    servname + "-instancer-external"
-                                    if multiservice and serv_spec.type == "NodePort"
-                                    else servname
-                                ),
+                                name=self.object_name(name),
                                 labels={
                                     **common_labels,
                                     "instancer.acmcyber.com/container-name": servname,
@@ -750,19 +1317,68 @@ class Challenge(ABC):
                             ),
                             spec=serv_spec,
                         )
-                        capi.create_namespaced_service(self.namespace, serv)
+                        with span("kube.create_service", service=name):
+                            capi.create_namespaced_service(self.kube_namespace, serv)
+
+                    routes = self.tcp_routes.get(servname, [])
+                    if len(routes) > 0:
+                        print(
+                            f"[*] Making TCP ingress {servname} under namespace {self.kube_namespace}..."
+                        )
+                        ing = {
+                            "apiVersion": "traefik.io/v1alpha1",
+                            "kind": "IngressRouteTCP",
+                            "metadata": {
+                                "name": self.object_name(servname),
+                                "annotations": {
+                                    "instancer.acmcyber.com/raw-routes": json.dumps(
+                                        routes
+                                    )
+                                },
+                                "labels": {
+                                    **common_labels,
+                                    "instancer.acmcyber.com/container-name": servname,
+                                },
+                            },
+                            "spec": {
+                                "entryPoints": [config.tcp_sni_entrypoint],
+                                "routes": [
+                                    {
+                                        "match": f"HostSNI(`{host}`)",
+                                        "services": [
+                                            {
+                                                "name": self.object_name(external_name),
+                                                "port": port,
+                                            }
+                                        ],
+                                    }
+                                    for (port, host) in routes
+                                ],
+                                # terminate TLS with Traefik's default certificate,
+                                # clients need TLS for SNI but challenges get plain TCP
+                                "tls": {},
+                            },
+                        }
+                        with span("kube.create_ingressroutetcp", container=servname):
+                            crdapi.create_namespaced_custom_object(
+                                "traefik.io",
+                                "v1alpha1",
+                                self.kube_namespace,
+                                "ingressroutetcps",
+                                ing,
+                            )
 
                 for ingname, container in self.containers.items():
                     http_ports = self.http_ports.get(ingname, [])
                     if len(http_ports) > 0:
                         print(
-                            f"[*] Making ingress {ingname} under namespace {self.namespace}..."
+                            f"[*] Making ingress {ingname} under namespace {self.kube_namespace}..."
                         )
                         ing = {
                             "apiVersion": "traefik.io/v1alpha1",
                             "kind": "IngressRoute",
                             "metadata": {
-                                "name": ingname,
+                                "name": self.object_name(ingname),
                                 "annotations": {
                                     "instancer.acmcyber.com/raw-routes": json.dumps(
                                         http_ports
@@ -779,48 +1395,55 @@ class Challenge(ABC):
                                     {
                                         "match": f"Host(`{sub}`)",
                                         "kind": "Rule",
-                                        "services": [{"name": ingname, "port": port}],
+                                        "services": [
+                                            {
+                                                "name": self.object_name(ingname),
+                                                "port": port,
+                                            }
+                                        ],
                                     }
                                     for (port, sub) in http_ports
                                 ],
                             },
                         }
-                        crdapi.create_namespaced_custom_object(
-                            "traefik.io",
-                            "v1alpha1",
-                            self.namespace,
-                            "ingressroutes",
-                            ing,
-                        )
+                        with span("kube.create_ingressroute", container=ingname):
+                            crdapi.create_namespaced_custom_object(
+                                "traefik.io",
+                                "v1alpha1",
+                                self.kube_namespace,
+                                "ingressroutes",
+                                ing,
+                            )
 
+                # label-scoped instances only trust their own pods, namespaced
+                # instances every pod in their namespace
+                instance_peer = (
+                    kclient.V1NetworkPolicyPeer(
+                        pod_selector=kclient.V1LabelSelector(match_labels=scope_labels)
+                    )
+                    if self.label_scoped
+                    else kclient.V1NetworkPolicyPeer(
+                        namespace_selector=kclient.V1LabelSelector(
+                            match_labels=common_labels
+                        )
+                    )
+                )
                 pol_intrans = kclient.V1NetworkPolicy(
-                    metadata=kclient.V1ObjectMeta(name="intrans", labels=common_labels),
+                    metadata=kclient.V1ObjectMeta(
+                        name=self.object_name("intrans"), labels=common_labels
+                    ),
                     spec=kclient.V1NetworkPolicySpec(
-                        pod_selector=kclient.V1LabelSelector(),
+                        pod_selector=kclient.V1LabelSelector(
+                            match_labels=scope_labels or None
+                        ),
                         policy_types=["Ingress", "Egress"],
                         ingress=[
-                            # allow ingress from other pods in the namespace
-                            kclient.V1NetworkPolicyIngressRule(
-                                _from=[
-                                    kclient.V1NetworkPolicyPeer(
-                                        namespace_selector=kclient.V1LabelSelector(
-                                            match_labels=common_labels
-                                        )
-                                    )
-                                ]
-                            )
+                            # allow ingress from other pods of the instance
+                            kclient.V1NetworkPolicyIngressRule(_from=[instance_peer])
                         ],
                         egress=[
-                            # allow egress to other pods in the namespace
-                            kclient.V1NetworkPolicyEgressRule(
-                                to=[
-                                    kclient.V1NetworkPolicyPeer(
-                                        namespace_selector=kclient.V1LabelSelector(
-                                            match_labels=common_labels
-                                        )
-                                    )
-                                ]
-                            ),
+                            # allow egress to other pods of the instance
+                            kclient.V1NetworkPolicyEgressRule(to=[instance_peer]),
                             # allow egress to the cluster's dns server
                             kclient.V1NetworkPolicyEgressRule(
                                 to=[
@@ -861,10 +1484,15 @@ class Challenge(ABC):
                     ),
                 )
                 pol_ingress = kclient.V1NetworkPolicy(
-                    metadata=kclient.V1ObjectMeta(name="ingress", labels=common_labels),
+                    metadata=kclient.V1ObjectMeta(
+                        name=self.object_name("ingress"), labels=common_labels
+                    ),
                     spec=kclient.V1NetworkPolicySpec(
                         pod_selector=kclient.V1LabelSelector(
-                            match_labels={"instancer.acmcyber.com/has-ingress": "true"}
+                            match_labels={
+                                **scope_labels,
+                                "instancer.acmcyber.com/has-ingress": "true",
+                            }
                         ),
                         policy_types=["Ingress"],
                         ingress=[
@@ -885,10 +1513,15 @@ class Challenge(ABC):
                     ),
                 )
                 pol_egress = kclient.V1NetworkPolicy(
-                    metadata=kclient.V1ObjectMeta(name="egress", labels=common_labels),
+                    metadata=kclient.V1ObjectMeta(
+                        name=self.object_name("egress"), labels=common_labels
+                    ),
                     spec=kclient.V1NetworkPolicySpec(
                         pod_selector=kclient.V1LabelSelector(
-                            match_labels={"instancer.acmcyber.com/has-egress": "true"}
+                            match_labels={
+                                **scope_labels,
+                                "instancer.acmcyber.com/has-egress": "true",
+                            }
                         ),
                         policy_types=["Egress"],
                         egress=[
@@ -912,22 +1545,50 @@ class Challenge(ABC):
                     ),
                 )
                 print(
-                    f"[*] Making network policies under namespace {self.namespace}..."
+                    f"[*] Making network policies under namespace {self.kube_namespace}..."
                 )
-                napi.create_namespaced_network_policy(self.namespace, pol_intrans)
-                napi.create_namespaced_network_policy(self.namespace, pol_ingress)
-                napi.create_namespaced_network_policy(self.namespace, pol_egress)
-                rclient.zadd("expiration", {self.namespace: expiration})
-                rclient.zadd("boot_time", {self.namespace: curtime})
+                with span("kube.create_network_policies"):
+                    for pol in (pol_intrans, pol_ingress, pol_egress):
+                        napi.create_namespaced_network_policy(self.kube_namespace, pol)
+                pipe = rclient.pipeline()
+                pipe.zadd("expiration", {self.namespace: expiration})
+                pipe.zadd("boot_time", {self.namespace: curtime})
+                pipe.zadd("renew_time", {self.namespace: curtime})
+                index_instance(pipe, self.namespace, common_labels)
+                with span("redis.index"):
+                    pipe.execute()
+                return False
         except LockException:
             raise ResourceUnavailableError(f"namespace {self.namespace} is locked")
         except Exception:
+            if reserved and not namespace_made:
+                with span("redis.release"):
+                    release([self.namespace])
+                pipe = rclient.pipeline(transaction=False)
+                unindex_instances(pipe, [self.namespace])
+                pipe.execute()
+            if reserved and namespace_made:
+                # the capacity is released by the worker once the pods are gone
+                with span("redis.drain"):
+                    drain([self.namespace])
             if namespace_made:
+                publish_event(self.namespace, "failed")
                 print(f"[*] Got error, cleaning up namespace {self.namespace}...")
                 try:
-                    capi.delete_namespace(self.namespace, grace_period_seconds=0)
-                    rclient.zrem("expiration", self.namespace)
-                    rclient.zrem("boot_time", self.namespace)
+                    with span("kube.cleanup"):
+                        if self.label_scoped:
+                            delete_label_scoped(self.namespace, self.kube_namespace)
+                        else:
+                            capi.delete_namespace(
+                                self.namespace, grace_period_seconds=0
+                            )
+                    pipe = rclient.pipeline()
+                    pipe.zrem("expiration", self.namespace)
+                    pipe.zrem("boot_time", self.namespace)
+                    pipe.zrem("renew_time", self.namespace)
+                    pipe.zrem("ready_time", self.namespace)
+                    unindex_instances(pipe, [self.namespace])
+                    pipe.execute()
                 except ApiException:
                     print(f"[*] Could not clean up namespace {self.namespace}...")
             raise
@@ -935,21 +1596,222 @@ class Challenge(ABC):
     @staticmethod
     def stop_namespace(namespace: str) -> None:
         """Stops a challenge given the namespace of the challenge."""
-        capi = kclient.CoreV1Api()
+        Challenge.stop_namespaces([namespace])
 
-        print(f"[*] Deleting namespace {namespace}...")
-        try:
-            rclient.zrem("expiration", namespace)
-            rclient.zrem("boot_time", namespace)
-            rclient.delete(f"ports:{namespace}")
-            capi.delete_namespace(namespace, grace_period_seconds=0)
-        except ApiException as e:
-            if e.status == 404:
+    @staticmethod
+    def stop_namespaces(
+        namespaces: list[str], action: str = "stop", **event_data: Any
+    ) -> int:
+        """Stops several challenges given their namespaces.
+
+        The cached state of every namespace is cleared in one Redis round trip, then the
+        namespaces are deleted concurrently. `action` is what the event log records,
+        such as expire for instances the worker stops, and `event_data` is added to the
+        terminated event. Returns the number of namespaces that could not be deleted."""
+        if len(namespaces) == 0:
+            return 0
+        with trace("stop", namespaces=len(namespaces)):
+            return Challenge._stop_namespaces(namespaces, action, event_data)
+
+    @staticmethod
+    def _stop_namespaces(
+        namespaces: list[str], action: str, event_data: dict[str, Any]
+    ) -> int:
+        capi = kclient.CoreV1Api(kapi)
+        curtime = time()
+
+        # label-scoped instances are indexed with the namespace they share
+        read = rclient.pipeline(transaction=False)
+        for namespace in namespaces:
+            read.hmget(
+                f"instance:{namespace}", "kube_namespace", "challenge_id", "team_id"
+            )
+            read.zscore("boot_time", namespace)
+        with span("redis.read_instances"):
+            results = read.execute()
+        kube_namespaces = {}
+        # namespace -> challenge ID, team ID, uptime of indexed instances
+        logged: dict[str, tuple[str, str | None, int | None]] = {}
+        for namespace, (kube_namespace, chall_id, team_id), boot_time in zip(
+            namespaces, results[::2], results[1::2]
+        ):
+            if kube_namespace:
+                kube_namespaces[namespace] = kube_namespace.decode()
+            if chall_id:
+                logged[namespace] = (
+                    chall_id.decode(),
+                    team_id.decode() or None,
+                    None if boot_time is None else int(curtime - boot_time),
+                )
+
+        def log(namespace: str, started: float, ok: bool) -> None:
+            if namespace in logged:
+                chall_id, team_id, uptime = logged[namespace]
+                record_event(
+                    chall_id,
+                    team_id,
+                    action,
+                    "ok" if ok else "failed",
+                    perf_counter() - started,
+                    uptime=uptime,
+                )
+
+        pipe = rclient.pipeline(transaction=False)
+        pipe.zrem("expiration", *namespaces)
+        pipe.zrem("boot_time", *namespaces)
+        pipe.zrem("renew_time", *namespaces)
+        pipe.zrem("ready_time", *namespaces)
+        pipe.delete(*(f"ports:{namespace}" for namespace in namespaces))
+        unindex_instances(pipe, namespaces)
+        with span("redis.unindex"):
+            pipe.execute()
+        with span("redis.remove_deploys"):
+            remove_deploys(namespaces)
+        # the capacity is released by the worker once the pods are gone
+        with span("redis.drain"):
+            drain(namespaces)
+        # the instances were just unindexed, so their teams are passed along
+        publish_events(
+            namespaces,
+            "terminated",
+            teams={namespace: team_id for namespace, (_, team_id, _) in logged.items()},
+            **event_data,
+        )
+
+        def delete(namespace: str) -> bool:
+            started = perf_counter()
+            ok = _delete(namespace)
+            log(namespace, started, ok)
+            return ok
+
+        def _delete(namespace: str) -> bool:
+            if namespace in kube_namespaces:
                 print(
-                    f"[*] Could not delete namespace {namespace} because namespace does not exist..."
+                    f"[*] Deleting instance {namespace} from namespace {kube_namespaces[namespace]}..."
                 )
-            else:
+                try:
+                    with span("kube.delete_instance", namespace=namespace):
+                        delete_label_scoped(namespace, kube_namespaces[namespace])
+                except ApiException as e:
+                    print(
+                        f"[*] Could not delete instance {namespace} due to error {e}..."
+                    )
+                    return False
+                return True
+            print(f"[*] Deleting namespace {namespace}...")
+            try:
+                with span("kube.delete_namespace", namespace=namespace):
+                    capi.delete_namespace(namespace, grace_period_seconds=0)
+            except ApiException as e:
+                if e.status == 404:
+                    print(
+                        f"[*] Could not delete namespace {namespace} because namespace does not exist..."
+                    )
+                    return True
                 print(f"[*] Could not delete namespace {namespace} due to error {e}...")
+                return False
+            return True
+
+        if len(namespaces) == 1:
+            return 0 if delete(namespaces[0]) else 1
+        with ThreadPoolExecutor(min(len(namespaces), STOP_CONCURRENCY)) as executor:
+            return sum(not ok for ok in executor.map(propagate(delete), namespaces))
+
+    def update_scaling(self, scaling: dict[str, dict[str, Any]]) -> int:
+        """Change the replicas and autoscaling settings of containers and apply them to
+        the running instances.
+
+        `scaling` maps container names to a dict with `replicas`, `autoscaling` or both;
+        an `autoscaling` of None turns autoscaling off. The challenge config is updated
+        so new instances use the settings too. Returns the number of running instances
+        that could not be updated."""
+
+        for name, change in scaling.items():
+            container = self.containers[name]
+            if "replicas" in change:
+                container["replicas"] = change["replicas"]
+            if "autoscaling" in change:
+                if change["autoscaling"] is None:
+                    container.pop("autoscaling", None)
+                else:
+                    container["autoscaling"] = change["autoscaling"]
+
+        with connect_pg() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE challenges SET cfg=jsonb_set(cfg, '{containers}', %s) WHERE id=%s",
+                    (Jsonb(self.containers), self.id),
+                )
+        self.flush_cache(self.id)
+
+        namespaces = [
+            namespace.decode()
+            for namespace in rclient.smembers(f"instances:chall:{self.id}")
+        ]
+        if len(namespaces) == 0:
+            return 0
+        with ThreadPoolExecutor(min(len(namespaces), STOP_CONCURRENCY)) as executor:
+            return sum(
+                not ok
+                for ok in executor.map(
+                    lambda namespace: self._apply_scaling(namespace, list(scaling)),
+                    namespaces,
+                )
+            )
+
+    def _apply_scaling(self, namespace: str, names: list[str]) -> bool:
+        """Apply the scaling settings of containers to an instance. Returns whether it worked."""
+
+        api = kclient.AppsV1Api(kapi)
+        hpaapi = kclient.AutoscalingV2Api(kapi)
+        labels = {"instancer.acmcyber.com/instance-id": self.id}
+        kube_namespace = namespace
+        suffix = ""
+        pool = rclient.hget(f"instance:{namespace}", "kube_namespace")
+        if pool:
+            # label-scoped instance, its HPAs need the labels teardown selects on
+            kube_namespace = pool.decode()
+            suffix = f"-{instance_suffix(namespace)}"
+            labels["instancer.acmcyber.com/instance-key"] = namespace
+            labels["instancer.acmcyber.com/instance-pool"] = kube_namespace
+        try:
+            for name in names:
+                container = self.containers[name]
+                hpa = config_to_autoscaler(
+                    name + suffix,
+                    container,
+                    {**labels, "instancer.acmcyber.com/container-name": name},
+                )
+                if hpa is not None:
+                    # the autoscaler owns the replica count, so the deployment is left alone
+                    try:
+                        hpaapi.replace_namespaced_horizontal_pod_autoscaler(
+                            name + suffix, kube_namespace, hpa
+                        )
+                    except ApiException as e:
+                        if e.status != 404:
+                            raise e
+                        hpaapi.create_namespaced_horizontal_pod_autoscaler(
+                            kube_namespace, hpa
+                        )
+                    continue
+                # remove the autoscaler first so it doesn't undo the new replica count
+                try:
+                    hpaapi.delete_namespaced_horizontal_pod_autoscaler(
+                        name + suffix, kube_namespace
+                    )
+                except ApiException as e:
+                    if e.status != 404:
+                        raise e
+                api.patch_namespaced_deployment(
+                    name + suffix,
+                    kube_namespace,
+                    {"spec": {"replicas": container_replicas(container)}},
+                )
+        except ApiException as e:
+            print(f"[*] Could not scale namespace {namespace} due to error {e}...")
+            return False
+        return True
 
     def stop(self) -> None:
         """Stops a challenge if it's running."""
@@ -957,20 +1819,48 @@ class Challenge(ABC):
 
     def deployment_status(self) -> DeploymentInfo | None:
         """Return the challenge deployment info, or None if the challenge isn't deployed."""
+        return self.deployment_statuses([self])[0]
+
+    @staticmethod
+    def deployment_statuses(challs: list[Challenge]) -> list[DeploymentInfo | None]:
+        """Return the deployment info of each challenge, or None for challenges that aren't deployed.
+
+        The cached state of every challenge is fetched in a single Redis round trip."""
+        pipe = rclient.pipeline(transaction=False)
+        for chall in challs:
+            pipe.zscore("expiration", chall.namespace)
+            pipe.zscore("ready_time", chall.namespace)
+            pipe.zscore("boot_time", chall.namespace)
+            pipe.get(f"ports:{chall.namespace}")
+        results = pipe.execute()
+        return [
+            chall._deployment_status(*results[4 * i : 4 * i + 4])
+            for i, chall in enumerate(challs)
+        ]
+
+    def _deployment_status(
+        self,
+        exp_score: float | None,
+        ready_score: float | None,
+        boot_score: float | None,
+        cached: bytes | None,
+    ) -> DeploymentInfo | None:
+        """Build the deployment info from the cached expiration, ready and boot times and port mappings."""
         # Exit early if the container isn't running
-        # This check is cached so it should be pretty quick
-        exp = self.expiration()
-        if exp is None:
+        if exp_score is None:
             return None
+        exp = int(exp_score)
         cache_key = f"ports:{self.namespace}"
-        cached = rclient.get(cache_key)
+        count_cache("ports", [cached is not None])
 
         port_mappings = {}
 
-        start_time_stamp = self.start_timestamp()
-        if (
-            start_time_stamp is None
-        ):  # start time stamp was lost, probably due to others using same kube cluster on older versions
+        ready_time_stamp = None if ready_score is None else int(ready_score)
+        if ready_time_stamp is not None:
+            start_time_stamp = ready_time_stamp
+        elif boot_score is not None:
+            start_time_stamp = int(boot_score) + self.boot_time
+        else:  # start time stamp was lost, probably due to others using same kube cluster on older versions
             start_time_stamp = 1
 
         if cached is not None:
@@ -980,27 +1870,59 @@ class Challenge(ABC):
                 if isinstance(port, float):
                     port = int(port)
                 port_mappings[cont, int(cport)] = port
-            return DeploymentInfo(exp, start_time_stamp, port_mappings)
+            return DeploymentInfo(
+                exp, start_time_stamp, ready_time_stamp, port_mappings
+            )
 
-        capi = kclient.CoreV1Api()
-        crdapi = kclient.CustomObjectsApi()
+        capi = kclient.CoreV1Api(kapi)
+        crdapi = kclient.CustomObjectsApi(kapi)
 
-        services = capi.list_namespaced_service(self.namespace).items
+        selector = (
+            f"instancer.acmcyber.com/instance-key={self.namespace}"
+            if self.label_scoped
+            else None
+        )
+        services = capi.list_namespaced_service(
+            self.kube_namespace, label_selector=selector
+        ).items
         for serv in services:
             if serv.spec.type != "NodePort":
                 continue
             for port in serv.spec.ports:
-                port_mappings[serv.metadata.name, port.port] = port.node_port
+                port_mappings[
+                    self._base_name(serv.metadata.name), port.port
+                ] = port.node_port
 
         ingresses = crdapi.list_namespaced_custom_object(
-            "traefik.io", "v1alpha1", self.namespace, "ingressroutes"
+            "traefik.io",
+            "v1alpha1",
+            self.kube_namespace,
+            "ingressroutes",
+            label_selector=selector,
         )["items"]
         for ing in ingresses:
             http_ports = json.loads(
                 ing["metadata"]["annotations"]["instancer.acmcyber.com/raw-routes"]
             )
             for port, sub in http_ports:
-                port_mappings[ing["metadata"]["name"], port] = sub
+                port_mappings[self._base_name(ing["metadata"]["name"]), port] = sub
+
+        if len(self.tcp_routes) > 0:
+            tcp_ingresses = crdapi.list_namespaced_custom_object(
+                "traefik.io",
+                "v1alpha1",
+                self.kube_namespace,
+                "ingressroutetcps",
+                label_selector=selector,
+            )["items"]
+            for ing in tcp_ingresses:
+                routes = json.loads(
+                    ing["metadata"]["annotations"]["instancer.acmcyber.com/raw-routes"]
+                )
+                for port, host in routes:
+                    port_mappings[
+                        self._base_name(ing["metadata"]["name"]), port
+                    ] = f"{host}:{config.tcp_sni_port}"
 
         cache_entry = {}
         for (cont, cport), port in port_mappings.items():
@@ -1009,7 +1931,7 @@ class Challenge(ABC):
         if cache_entry and exp > t:
             rclient.set(cache_key, json.dumps(cache_entry), ex=exp - t)
 
-        return DeploymentInfo(exp, start_time_stamp, port_mappings)
+        return DeploymentInfo(exp, start_time_stamp, ready_time_stamp, port_mappings)
 
     def __repr__(self) -> str:
         return f"{type(self).__name__}(namespace={self.namespace!r}, expiration={self.expiration()!r})"
@@ -1040,6 +1962,7 @@ class SharedChallenge(Challenge):
             namespace=f"ci-{id}",
             exposed_ports=cfg.get("tcp", {}),
             http_ports=cfg.get("http", {}),
+            tcp_routes=tcp_routes(id, cfg.get("tcp", {}), randomize=False),
         )
 
     def is_shared(self) -> bool:
@@ -1066,16 +1989,10 @@ class PerTeamChallenge(Challenge):
         Do not call this constructor directly; use Challenge.fetch instead.
         """
 
-        http_ports = {}
-        for cont_name, ports in cfg.get("http", {}).items():
-            l = []
-            for port, domain in ports:
-                chunks = domain.split(".")
-                chunks[0] += "-" + "".join(
-                    random.choices("abcdefghijklmnopqrstuvwxyz0123456789", k=5)
-                )
-                l.append((port, ".".join(chunks)))
-            http_ports[cont_name] = l
+        http_ports = {
+            cont_name: [(port, random_subdomain(domain)) for port, domain in ports]
+            for cont_name, ports in cfg.get("http", {}).items()
+        }
 
         super().__init__(
             id,
@@ -1086,8 +2003,12 @@ class PerTeamChallenge(Challenge):
             namespace=f"ci-{id}-t-{team_id.replace('-', '')}",
             exposed_ports=cfg.get("tcp", {}),
             http_ports=http_ports,
+            tcp_routes=tcp_routes(id, cfg.get("tcp", {}), randomize=True),
             additional_labels={"instancer.acmcyber.com/team-id": team_id},
             additional_env_metadata={"team_id": team_id},
+            kube_namespace=(
+                f"ci-{id}-instances" if cfg.get("isolation") == "labels" else None
+            ),
         )
 
         self.team_id = team_id
@@ -0,0 +1,363 @@
+from typing import Any
+
+from kubernetes.utils.quantity import parse_quantity
+
+from instancer.config import config, rclient
+from instancer.lock import FENCE_CHECK, Lock, run_fenced
+
+RESOURCES = ["cpu", "memory"]
+"Resources that are accounted for, in the order they're stored in reservations."
+RESERVATION_GRACE = 300
+"Seconds a reservation is kept by reconcile even if its namespace wasn't listed."
+
+
+class CapacityExceededError(Exception):
+    """Exception thrown when starting an instance would overcommit the cluster."""
+
+    resource: str
+    "The resource that would be overcommitted, or queue if other deploys are waiting."
+
+    def __init__(self, resource: str):
+        super().__init__(f"not enough {resource} capacity")
+        self.resource = resource
+
+
+def resource_amounts(resources: dict[str, Any]) -> dict[str, int]:
+    """Convert Kubernetes resource quantities to millicores of CPU and bytes of memory.
+
+    Resources other than CPU and memory are ignored."""
+
+    amounts = {}
+    if "cpu" in resources:
+        amounts["cpu"] = int(parse_quantity(resources["cpu"]) * 1000)
+    if "memory" in resources:
+        amounts["memory"] = int(parse_quantity(resources["memory"]))
+    return amounts
+
+
+# Reserve capacity for a namespace unless it would exceed the usable capacity.
+# KEYS[1]: used capacity hash, KEYS[2]: reservations hash, KEYS[3]: total capacity hash,
+# KEYS[4]: pending hash of the deploy queue
+# ARGV: namespace, max utilization, whether to skip the deploy queue, then the amount of
+# each resource in RESOURCES order
+# Returns an empty string if the capacity was reserved (or the namespace already has a
+# reservation), "queue" if other deploys are queued, otherwise the name of the resource
+# that would be overcommitted. Resources without a known total are not limited.
+# Fenced by the instance's lock.
+_reserve = rclient.register_script(
+    FENCE_CHECK
+    + """
+if redis.call("HEXISTS", KEYS[2], ARGV[1]) == 1 then
+    return ""
+end
+if ARGV[3] == "0" and redis.call("HLEN", KEYS[4]) > 0 then
+    return "queue"
+end
+local names = {"cpu", "memory"}
+for i, name in ipairs(names) do
+    local total = tonumber(redis.call("HGET", KEYS[3], name))
+    if total ~= nil then
+        local used = tonumber(redis.call("HGET", KEYS[1], name) or "0")
+        if used + tonumber(ARGV[3 + i]) > total * tonumber(ARGV[2]) then
+            return name
+        end
+    end
+end
+local t = redis.call("TIME")
+local amounts = {}
+for i, name in ipairs(names) do
+    redis.call("HINCRBY", KEYS[1], name, ARGV[3 + i])
+    amounts[i] = ARGV[3 + i]
+end
+redis.call("HSET", KEYS[2], ARGV[1], table.concat(amounts, ",") .. "," .. t[1])
+return ""
+"""
+)
+
+# Release the reservations of namespaces.
+# KEYS[1]: used capacity hash, KEYS[2]: reservations or draining hash
+# ARGV: namespaces
+# Fenced by the deploy queue lock when releasing drained capacity.
+_release = rclient.register_script(
+    FENCE_CHECK
+    + """
+local names = {"cpu", "memory"}
+for i = 1, #ARGV - 1 do
+    local ns = ARGV[i]
+    local reservation = redis.call("HGET", KEYS[2], ns)
+    if reservation then
+        local i = 1
+        for amount in string.gmatch(reservation, "[^,]+") do
+            if names[i] then
+                redis.call("HINCRBY", KEYS[1], names[i], -tonumber(amount))
+            end
+            i = i + 1
+        end
+        redis.call("HDEL", KEYS[2], ns)
+    end
+end
+return 0
+"""
+)
+
+# Move the reservations of stopped namespaces to the draining hash, where they keep
+# counting as used until their pods are gone. A namespace that is stopped again before
+# its earlier pods are gone drains the sum of both reservations.
+# KEYS[1]: reservations hash, KEYS[2]: draining hash
+# ARGV: namespaces
+_drain = rclient.register_script(
+    """
+for _, ns in ipairs(ARGV) do
+    local reservation = redis.call("HGET", KEYS[1], ns)
+    if reservation then
+        local draining = redis.call("HGET", KEYS[2], ns)
+        if draining then
+            local fields = {}
+            for field in string.gmatch(draining, "[^,]+") do
+                fields[#fields + 1] = tonumber(field)
+            end
+            local i = 1
+            local summed = {}
+            for field in string.gmatch(reservation, "[^,]+") do
+                summed[i] = tonumber(field) + (i < #fields and fields[i] or 0)
+                i = i + 1
+            end
+            reservation = table.concat(summed, ",")
+        end
+        redis.call("HSET", KEYS[2], ns, reservation)
+        redis.call("HDEL", KEYS[1], ns)
+    end
+end
+return 0
+"""
+)
+
+# Make reservations match the namespaces that exist and recompute the used capacity.
+# KEYS[1]: used capacity hash, KEYS[2]: reservations hash, KEYS[3]: draining hash
+# ARGV: grace period, then the namespace and amount of each resource for every live namespace
+# Reservations of namespaces that aren't live are dropped once they're older than the
+# grace period, and live namespaces without a reservation get one. Draining reservations
+# are left to release_drained but still count as used.
+_reconcile = rclient.register_script(
+    """
+local names = {"cpu", "memory"}
+local now = tonumber(redis.call("TIME")[1])
+local live = {}
+for i = 2, #ARGV, 1 + #names do
+    live[ARGV[i]] = true
+    if redis.call("HEXISTS", KEYS[2], ARGV[i]) == 0 then
+        local amounts = {}
+        for j = 1, #names do
+            amounts[j] = ARGV[i + j]
+        end
+        redis.call("HSET", KEYS[2], ARGV[i], table.concat(amounts, ",") .. "," .. now)
+    end
+end
+local used = {}
+for j = 1, #names do
+    used[j] = 0
+end
+local draining = redis.call("HGETALL", KEYS[3])
+for i = 2, #draining, 2 do
+    local j = 1
+    for field in string.gmatch(draining[i], "[^,]+") do
+        if j <= #names then
+            used[j] = used[j] + tonumber(field)
+        end
+        j = j + 1
+    end
+end
+local reservations = redis.call("HGETALL", KEYS[2])
+for i = 1, #reservations, 2 do
+    local fields = {}
+    for field in string.gmatch(reservations[i + 1], "[^,]+") do
+        fields[#fields + 1] = tonumber(field)
+    end
+    if not live[reservations[i]] and now - fields[#names + 1] > tonumber(ARGV[1]) then
+        redis.call("HDEL", KEYS[2], reservations[i])
+    else
+        for j = 1, #names do
+            used[j] = used[j] + fields[j]
+        end
+    end
+end
+for j, name in ipairs(names) do
+    redis.call("HSET", KEYS[1], name, used[j])
+end
+return 0
+"""
+)
+
+
+def reserve(
+    namespace: str,
+    requests: dict[str, int],
+    skip_queue: bool = False,
+    lock: Lock | None = None,
+) -> None:
+    """Reserve capacity for a new instance, holding `lock` if it is given.
+
+    Raises CapacityExceededError if the instance would push the cluster past its usable
+    capacity, or if other deploys are queued for capacity and `skip_queue` isn't set,
+    and FencedException if `lock` was taken by someone else since it was acquired.
+    Does nothing if admission control is disabled."""
+
+    if not config.capacity_enabled:
+        return
+    denied = run_fenced(
+        _reserve,
+        lock,
+        keys=[
+            "capacity:used",
+            "capacity:reservations",
+            "capacity:total",
+            "deploy_queue:pending",
+        ],
+        args=[
+            namespace,
+            config.capacity_max_utilization,
+            int(skip_queue),
+            *(requests.get(name, 0) for name in RESOURCES),
+        ],
+    )
+    if denied:
+        raise CapacityExceededError(denied.decode())
+
+
+def release(namespaces: list[str]) -> None:
+    """Release the capacity reserved for instances that never got running pods.
+
+    Workers waiting to start queued deploys are notified on the capacity:released channel.
+    """
+
+    if len(namespaces) == 0:
+        return
+    run_fenced(
+        _release, None, keys=["capacity:used", "capacity:reservations"], args=namespaces
+    )
+    rclient.publish("capacity:released", str(len(namespaces)))
+
+
+def drain(namespaces: list[str]) -> None:
+    """Mark the reservations of stopped instances as draining.
+
+    Their pods keep using the nodes until they have terminated, so the capacity stays
+    reserved until the worker sees them gone and calls release_drained."""
+
+    if len(namespaces) == 0:
+        return
+    _drain(keys=["capacity:reservations", "capacity:draining"], args=namespaces)
+
+
+def draining() -> list[str]:
+    """Return the namespaces of stopped instances whose capacity is still draining."""
+
+    return [ns.decode() for ns in rclient.hkeys("capacity:draining")]
+
+
+def release_drained(namespaces: list[str], lock: Lock | None = None) -> None:
+    """Release the capacity of stopped instances whose pods are gone, holding `lock` if
+    it is given.
+
+    Workers waiting to start queued deploys are notified on the capacity:released channel.
+    Raises FencedException if `lock` was taken by someone else since it was acquired.
+    """
+
+    if len(namespaces) == 0:
+        return
+    run_fenced(
+        _release, lock, keys=["capacity:used", "capacity:draining"], args=namespaces
+    )
+    rclient.publish("capacity:released", str(len(namespaces)))
+
+
+def reconcile(live: dict[str, dict[str, int]]) -> None:
+    """Make the reservations match the live instances and their resource requests."""
+
+    args: list[Any] = [RESERVATION_GRACE]
+    for namespace, requests in live.items():
+        args.append(namespace)
+        args.extend(requests.get(name, 0) for name in RESOURCES)
+    _reconcile(
+        keys=["capacity:used", "capacity:reservations", "capacity:draining"], args=args
+    )
+
+
+def reservations(namespaces: list[str]) -> dict[str, dict[str, int]]:
+    """Return the capacity reserved by each of the given namespaces that has a reservation."""
+
+    if len(namespaces) == 0:
+        return {}
+    reserved = {}
+    for namespace, reservation in zip(
+        namespaces, rclient.hmget("capacity:reservations", namespaces)
+    ):
+        if reservation is not None:
+            amounts = reservation.decode().split(",")
+            reserved[namespace] = {
+                name: int(amount) for name, amount in zip(RESOURCES, amounts)
+            }
+    return reserved
+
+
+def set_total(total: dict[str, int]) -> None:
+    """Set the allocatable capacity of the cluster."""
+
+    pipe = rclient.pipeline()
+    pipe.delete("capacity:total")
+    if len(total) > 0:
+        pipe.hset("capacity:total", mapping={k: v for k, v in total.items()})
+    pipe.execute()
+
+
+def configured_total() -> dict[str, int]:
+    """Return the capacity set in the config, which overrides the discovered capacity."""
+
+    configured = {}
+    if config.capacity_cpu is not None:
+        configured["cpu"] = config.capacity_cpu
+    if config.capacity_memory is not None:
+        configured["memory"] = config.capacity_memory
+    return resource_amounts(configured)
+
+
+def capacity_status() -> dict[str, Any]:
+    """Return the total, reserved and available capacity of each resource, and how much
+    of the reserved capacity is draining from stopped instances."""
+
+    pipe = rclient.pipeline(transaction=False)
+    pipe.hgetall("capacity:total")
+    pipe.hgetall("capacity:used")
+    pipe.hlen("capacity:reservations")
+    pipe.hvals("capacity:draining")
+    total_raw, used_raw, instances, draining_raw = pipe.execute()
+    total = {k.decode(): int(v) for k, v in total_raw.items()}
+    used = {k.decode(): int(v) for k, v in used_raw.items()}
+    draining = {name: 0 for name in RESOURCES}
+    for reservation in draining_raw:
+        for name, amount in zip(RESOURCES, reservation.decode().split(",")):
+            draining[name] += int(amount)
+    resources = {}
+    for name in RESOURCES:
+        usable = (
+            int(total[name] * config.capacity_max_utilization)
+            if name in total
+            else None
+        )
+        resources[name] = {
+            "total": total.get(name),
+            "usable": usable,
+            "reserved": used.get(name, 0),
+            "draining": draining[name],
+            "available": None if usable is None else usable - used.get(name, 0),
+            "utilization": None
+            if name not in total or total[name] == 0
+            else used.get(name, 0) / total[name],
+        }
+    return {
+        "enabled": config.capacity_enabled,
+        "max_utilization": config.capacity_max_utilization,
+        "instances": instances,
+        "draining": len(draining_raw),
+        "resources": resources,
+    }
@@ -0,0 +1,205 @@
+import json
+from dataclasses import dataclass, field
+
+from instancer.config import rclient
+
+NGRAM_LENGTH = 3
+"Length of the longest substrings of challenge names and authors that are indexed."
+
+# Find the challenges whose search text contains a query among the challenges having
+# every n-gram of the query, since an n-gram can appear elsewhere in the text.
+# KEYS: the n-gram sets of the query, then the search text hash
+# ARGV: the lowercase query
+# Returns the IDs of the matching challenges.
+_search_text = rclient.register_script(
+    """
+local ids = redis.call("SINTER", unpack(KEYS, 1, #KEYS - 1))
+if #ids == 0 then
+    return {}
+end
+local texts = redis.call("HMGET", KEYS[#KEYS], unpack(ids))
+local matches = {}
+for i, id in ipairs(ids) do
+    if texts[i] and string.find(texts[i], ARGV[1], 1, true) then
+        matches[#matches + 1] = id
+    end
+end
+return matches
+"""
+)
+
+
+@dataclass
+class CatalogEntry:
+    """The searchable parts of a challenge."""
+
+    id: str
+    "The challenge ID."
+    name: str
+    "The challenge name."
+    author: str
+    "The challenge author."
+    tags: list[tuple[str, bool]]
+    "The tags of the challenge as tuples of the tag name and whether it's a category."
+
+
+@dataclass
+class CatalogFilter:
+    """A filter for the challenge listing.
+
+    A challenge matches if it has any of the included categories or tags (or none are
+    given), none of the excluded categories or tags, and the query is part of its name
+    or author."""
+
+    categories: list[str] = field(default_factory=list)
+    "Categories to include."
+    tags: list[str] = field(default_factory=list)
+    "Tags to include."
+    exclude_categories: list[str] = field(default_factory=list)
+    "Categories to exclude."
+    exclude_tags: list[str] = field(default_factory=list)
+    "Tags to exclude."
+    query: str = ""
+    "Case insensitive text to search for in the challenge name and author."
+
+
+@dataclass
+class CatalogResult:
+    """The challenges matching a filter and the categories and tags of the whole catalog."""
+
+    ids: list[str]
+    "IDs of the matching challenges, sorted by name."
+    categories: list[str]
+    "All categories in the catalog, sorted."
+    tags: list[str]
+    "All non-category tags in the catalog, sorted."
+
+
+def _tag_key(name: str, is_category: bool) -> str:
+    return f"catalog:{'category' if is_category else 'tag'}:{name}"
+
+
+def _text_key(ngram: str) -> str:
+    return f"catalog:text:{ngram}"
+
+
+def _ngrams(text: str, length: int) -> set[str]:
+    """Return the substrings of a text with the given length, or the text itself if it
+    is shorter."""
+
+    return {text[i : i + length] for i in range(max(len(text) - length + 1, 1))}
+
+
+def write_catalog_index(entries: list[CatalogEntry], ttl: int) -> None:
+    """Replace the catalog index with the given challenges.
+
+    The all_challs list, an inverted index from each category and tag and from every
+    substring of up to NGRAM_LENGTH characters of the lowercase names and authors to
+    their challenges, and the search text of every challenge are written in one
+    transaction.
+    """
+
+    entries = sorted(entries, key=lambda entry: (entry.name.lower(), entry.id))
+    index_keys: dict[str, set[str]] = {}
+    categories: set[str] = set()
+    tags: set[str] = set()
+    for entry in entries:
+        for name, is_category in entry.tags:
+            index_keys.setdefault(_tag_key(name, is_category), set()).add(entry.id)
+            (categories if is_category else tags).add(name)
+        for text in (entry.name.lower(), entry.author.lower()):
+            for length in range(1, NGRAM_LENGTH + 1):
+                for ngram in _ngrams(text, length):
+                    index_keys.setdefault(_text_key(ngram), set()).add(entry.id)
+
+    old_keys = rclient.smembers("catalog:keys")
+    pipe = rclient.pipeline()
+    pipe.delete("catalog:keys", "catalog:search", *old_keys)
+    for key, chall_ids in index_keys.items():
+        pipe.sadd(key, *chall_ids)
+        pipe.expire(key, ttl)
+    if len(index_keys) > 0:
+        pipe.sadd("catalog:keys", *index_keys)
+        pipe.expire("catalog:keys", ttl)
+    if len(entries) > 0:
+        pipe.hset(
+            "catalog:search",
+            mapping={
+                entry.id: f"{entry.name}\n{entry.author}".lower() for entry in entries
+            },
+        )
+        pipe.expire("catalog:search", ttl)
+    pipe.set(
+        "catalog:facets",
+        json.dumps({"categories": sorted(categories), "tags": sorted(tags)}),
+        ex=ttl,
+    )
+    pipe.set("all_challs", json.dumps([entry.id for entry in entries]), ex=ttl)
+    pipe.execute()
+
+
+def search_catalog(flt: CatalogFilter) -> CatalogResult | None:
+    """Return the challenges matching a filter using one Redis round trip.
+
+    Queries of up to NGRAM_LENGTH characters are looked up in the n-gram index, and
+    longer ones are only compared to the challenges having every n-gram of the query.
+    Returns None if the catalog index isn't built."""
+
+    include = [_tag_key(name, True) for name in flt.categories] + [
+        _tag_key(name, False) for name in flt.tags
+    ]
+    exclude = [_tag_key(name, True) for name in flt.exclude_categories] + [
+        _tag_key(name, False) for name in flt.exclude_tags
+    ]
+    pipe = rclient.pipeline(transaction=False)
+    pipe.get("all_challs")
+    pipe.get("catalog:facets")
+    if len(include) > 0:
+        pipe.sunion(include)
+    if len(exclude) > 0:
+        pipe.sunion(exclude)
+    query = flt.query.lower()
+    if 0 < len(query) <= NGRAM_LENGTH:
+        pipe.smembers(_text_key(query))
+    elif len(query) > NGRAM_LENGTH:
+        _search_text(
+            keys=[
+                *map(_text_key, _ngrams(query, NGRAM_LENGTH)),
+                "catalog:search",
+            ],
+            args=[query],
+            client=pipe,
+        )
+    results = iter(pipe.execute())
+
+    all_challs = next(results)
+    facets = next(results)
+    if all_challs is None or facets is None:
+        return None
+    ids: list[str] = json.loads(all_challs)
+    if len(include) > 0:
+        included = {chall_id.decode() for chall_id in next(results)}
+        ids = [chall_id for chall_id in ids if chall_id in included]
+    if len(exclude) > 0:
+        excluded = {chall_id.decode() for chall_id in next(results)}
+        ids = [chall_id for chall_id in ids if chall_id not in excluded]
+    if query:
+        matches = {chall_id.decode() for chall_id in next(results)}
+        ids = [chall_id for chall_id in ids if chall_id in matches]
+    facets_dict = json.loads(facets)
+    return CatalogResult(
+        ids=ids, categories=facets_dict["categories"], tags=facets_dict["tags"]
+    )
+
+
+def catalog_version() -> int:
+    """Return the catalog version, which changes whenever a challenge or its tags change."""
+
+    version = rclient.get("catalog_version")
+    return 0 if version is None else int(version)
+
+
+def bump_catalog_version() -> None:
+    """Mark the catalog as changed."""
+
+    rclient.incr("catalog_version")
@@ -0,0 +1,91 @@
+import json
+from time import monotonic
+from typing import Any, Callable
+
+from instancer.config import config, rclient
+from instancer.lock import Lock, LockException
+from instancer.tracing import span
+
+Result = tuple[dict[str, Any], int]
+"A response body and status code."
+
+
+def coalesce(key: str, run: Callable[[], Result]) -> Result:
+    """Run `run` once for all concurrent callers with the same key, across processes.
+
+    The first caller becomes the leader and runs it while holding a lock, whose lease is
+    renewed for as long as it runs, and every caller that arrives meanwhile waits for the
+    leader's result instead of running it again. If the leader disappears without
+    publishing a result, its lock expires and a waiter takes over."""
+
+    channel = f"coalesce:{key}"
+    inflight = Lock(f"inflight:{key}")
+    deadline = monotonic() + config.deploy_coalesce_wait
+    pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+    try:
+        # subscribe first so a leader finishing right after our check isn't missed
+        pubsub.subscribe(channel)
+        while True:
+            try:
+                inflight.lock()
+                break
+            except LockException:
+                pass
+            with span("coalesce.wait", key=key):
+                while (left := deadline - monotonic()) > 0:
+                    message = pubsub.get_message(timeout=min(left, 1))
+                    if message is not None:
+                        body, status = json.loads(message["data"])
+                        return body, status
+                    if not inflight.held():
+                        break
+                else:
+                    return {
+                        "status": "temporarily_unavailable",
+                        "msg": "This challenge is temporarily unavailable. Try again in a few moments.",
+                    }, 503
+    finally:
+        pubsub.close()
+
+    try:
+        result = run()
+        rclient.publish(channel, json.dumps(result))
+    finally:
+        # waiters of a leader that failed see this and take over
+        inflight.unlock()
+    return result
+
+
+def is_final(status: int) -> bool:
+    """Return whether a response with this status is worth replaying to a retry: any
+    success, and client errors that retrying won't change."""
+
+    return 200 <= status < 300 or (
+        400 <= status < 500 and status not in (408, 409, 429)
+    )
+
+
+def replay_response(scope: str, idempotency_key: str) -> Result | None:
+    """Return the response saved for an idempotency key, or None if there is none."""
+
+    saved = rclient.get(f"idempotency:{scope}:{idempotency_key}")
+    if saved is None:
+        return None
+    body, status = json.loads(saved)
+    return body, status
+
+
+def save_response(scope: str, idempotency_key: str, result: Result) -> None:
+    """Save a final response so requests with the same idempotency key replay it.
+
+    Responses that may change on a retry, such as rate limits and server errors, aren't
+    saved, so the retry runs again."""
+
+    if not is_final(result[1]):
+        return
+
+    rclient.set(
+        f"idempotency:{scope}:{idempotency_key}",
+        json.dumps(result),
+        ex=config.deploy_idempotency_window,
+    )
@@ -1,14 +1,17 @@
 import os
 import sys
 from base64 import b64decode
+from contextlib import AbstractContextManager, asynccontextmanager
 from dataclasses import asdict, dataclass
-from typing import Any, Callable, TextIO
+from typing import Any, AsyncIterator, Callable, TextIO
 from uuid import UUID
 
 import jsonschema
 import psycopg
 import redis
+import redis.asyncio
 import yaml
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
 VALID_ID_CHARS: set[str] = set("abcdefghijklmnopqrstuvwxyz0123456789-")
 
@@ -60,6 +63,8 @@ class PartialConfig:
     postgres_user: str = "postgres"
     postgres_password: str | None = None
     postgres_database: str = "postgres"
+    postgres_pool_size: int = 20
+    kube_connection_pool_size: int = 32
     redis_resync_interval: int = 60
     dev: bool = False
     url: str = "http://localhost:8080"
@@ -69,6 +74,58 @@ class PartialConfig:
     recaptcha_site_key: str | None = None
     recaptcha_secret: str | None = None
     session_length: int = 24 * 3600
+    team_deploy_burst: int = 10
+    team_deploy_per_minute: float = 6
+    challenge_deploy_burst: int = 3
+    challenge_deploy_per_minute: float = 2
+    max_concurrent_starts: int = 20
+    start_slot_lease: int = 120
+    event_stream_duration: int = 600
+    event_stream_max: int = 1000
+    event_stream_max_threaded: int = 4
+    event_retention: int = 24 * 3600
+    expiry_warning: int = 300
+    capacity_enabled: bool = False
+    capacity_cpu: str | None = None
+    capacity_memory: str | None = None
+    capacity_max_utilization: float = 0.9
+    deploy_queue_max_length: int = 500
+    deploy_queue_max_per_team: int = 3
+    deploy_queue_max_wait: int = 1800
+    preemption_enabled: bool = False
+    preemption_policy: str = "oldest_boot"
+    preemption_min_age: int = 900
+    prepull_enabled: bool = False
+    prepull_namespace: str = "cyber-instancer"
+    prepull_helper_image: str = "busybox:1.36"
+    prepull_pause_image: str = "registry.k8s.io/pause:3.9"
+    tcp_exposure: str = "nodeport"
+    tcp_sni_port: int = 443
+    tcp_sni_entrypoint: str = "websecure"
+    deploy_coalesce_wait: int = 60
+    deploy_idempotency_window: int = 300
+    tracing_enabled: bool = False
+    tracing_exporter: str = "none"
+    tracing_file: str = "traces.jsonl"
+    tracing_retention: int = 200
+    metrics_enabled: bool = True
+    metrics_token: str | None = None
+    metrics_worker_port: int = 9100
+    profiling_enabled: bool = True
+    profiling_max_duration: int = 60
+    profiling_max_stacks: int = 5000
+    profiling_retention: int = 86400
+    event_log_enabled: bool = True
+    event_log_batch_size: int = 500
+    event_log_flush_interval: float = 1
+
+
+PREEMPTION_POLICIES = ["oldest_boot", "furthest_from_expiry", "least_recently_renewed"]
+"Names of the eviction policies used to pick instances to preempt."
+TCP_EXPOSURES = ["nodeport", "sni"]
+"Ways exposed TCP ports of challenges can be reached from outside the cluster."
+TRACING_EXPORTERS = ["none", "log", "otlp_file", "memory"]
+"Names of the exporters finished traces can be sent to."
 
 
 @dataclass
@@ -84,6 +141,16 @@ class Config(PartialConfig):
             raise ValueError(
                 "Invalid secret login key. Secret login key must be exactly 32 bytes long, base64 encoded"
             )
+        if partial_config.preemption_policy not in PREEMPTION_POLICIES:
+            raise ValueError(
+                f"Invalid preemption policy {partial_config.preemption_policy!r}"
+            )
+        if partial_config.tcp_exposure not in TCP_EXPOSURES:
+            raise ValueError(f"Invalid TCP exposure {partial_config.tcp_exposure!r}")
+        if partial_config.tracing_exporter not in TRACING_EXPORTERS:
+            raise ValueError(
+                f"Invalid tracing exporter {partial_config.tracing_exporter!r}"
+            )
         super().__init__(**asdict(partial_config))
 
 
@@ -141,6 +208,101 @@ def apply_config(c: dict[str, Any]) -> None:
                         "user": {"type": "string"},
                         "database": {"type": "string"},
                         "password": {"type": "string"},
+                        "pool_size": {"type": "integer", "minimum": 1},
+                    },
+                },
+                "kube_connection_pool_size": {"type": "integer", "minimum": 1},
+                "events": {
+                    "type": "object",
+                    "properties": {
+                        "stream_duration": {"type": "integer", "minimum": 1},
+                        "max_streams": {"type": "integer", "minimum": 0},
+                        "max_threaded_streams": {"type": "integer", "minimum": 0},
+                        "retention": {"type": "integer", "minimum": 1},
+                        "expiry_warning": {"type": "integer", "minimum": 0},
+                    },
+                },
+                "capacity": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "cpu": {"type": ["string", "number"]},
+                        "memory": {"type": ["string", "number"]},
+                        "max_utilization": {"type": "number", "exclusiveMinimum": 0},
+                    },
+                },
+                "deploy_queue": {
+                    "type": "object",
+                    "properties": {
+                        "max_length": {"type": "integer", "minimum": 0},
+                        "max_per_team": {"type": "integer", "minimum": 1},
+                        "max_wait": {"type": "integer", "minimum": 1},
+                    },
+                },
+                "preemption": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "policy": {"enum": PREEMPTION_POLICIES},
+                        "min_age": {"type": "integer", "minimum": 0},
+                    },
+                },
+                "prepull": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "namespace": {"type": "string"},
+                        "helper_image": {"type": "string"},
+                        "pause_image": {"type": "string"},
+                    },
+                },
+                "tracing": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "exporter": {"enum": TRACING_EXPORTERS},
+                        "file": {"type": "string"},
+                        "retention": {"type": "integer", "minimum": 1},
+                    },
+                },
+                "metrics": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "token": {"type": "string"},
+                        "worker_port": {"type": "integer", "minimum": 0},
+                    },
+                },
+                "profiling": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "max_duration": {"type": "integer", "minimum": 1},
+                        "max_stacks": {"type": "integer", "minimum": 1},
+                        "retention": {"type": "integer", "minimum": 1},
+                    },
+                },
+                "event_log": {
+                    "type": "object",
+                    "properties": {
+                        "enabled": {"type": "boolean"},
+                        "batch_size": {"type": "integer", "minimum": 1},
+                        "flush_interval": {"type": "number", "exclusiveMinimum": 0},
+                    },
+                },
+                "deploy": {
+                    "type": "object",
+                    "properties": {
+                        "coalesce_wait": {"type": "integer", "minimum": 1},
+                        "idempotency_window": {"type": "integer", "minimum": 1},
+                    },
+                },
+                "tcp": {
+                    "type": "object",
+                    "properties": {
+                        "exposure": {"enum": TCP_EXPOSURES},
+                        "sni_port": {"type": "integer", "minimum": 1, "maximum": 65535},
+                        "sni_entrypoint": {"type": "string"},
                     },
                 },
                 "redis_resync_interval": {"type": "number"},
@@ -152,6 +314,17 @@ def apply_config(c: dict[str, Any]) -> None:
                 "session_length": {"type": "integer"},
                 "recaptcha_site_key": {"type": "string"},
                 "recaptcha_secret": {"type": "string"},
+                "rate_limit": {
+                    "type": "object",
+                    "properties": {
+                        "team_burst": {"type": "integer", "minimum": 0},
+                        "team_per_minute": {"type": "number", "minimum": 0},
+                        "challenge_burst": {"type": "integer", "minimum": 0},
+                        "challenge_per_minute": {"type": "number", "minimum": 0},
+                        "max_concurrent_starts": {"type": "integer", "minimum": 0},
+                        "start_slot_lease": {"type": "integer", "minimum": 1},
+                    },
+                },
             },
         },
     )
@@ -167,6 +340,8 @@ def apply_config(c: dict[str, Any]) -> None:
     apply_dict(c, "postgres_user", "postgres", "user")
     apply_dict(c, "postgres_database", "postgres", "database")
     apply_dict(c, "postgres_password", "postgres", "password")
+    apply_dict(c, "postgres_pool_size", "postgres", "pool_size")
+    apply_dict(c, "kube_connection_pool_size", "kube_connection_pool_size")
     apply_dict(c, "redis_resync_interval", "redis_resync_interval")
     apply_dict(c, "dev", "dev")
     apply_dict(c, "url", "url")
@@ -176,6 +351,50 @@ def apply_config(c: dict[str, Any]) -> None:
     apply_dict(c, "rctf_url", "rctf_url")
     apply_dict(c, "recaptcha_site_key", "recaptcha_site_key")
     apply_dict(c, "recaptcha_secret", "recaptcha_secret")
+    apply_dict(c, "team_deploy_burst", "rate_limit", "team_burst")
+    apply_dict(c, "team_deploy_per_minute", "rate_limit", "team_per_minute")
+    apply_dict(c, "challenge_deploy_burst", "rate_limit", "challenge_burst")
+    apply_dict(c, "challenge_deploy_per_minute", "rate_limit", "challenge_per_minute")
+    apply_dict(c, "max_concurrent_starts", "rate_limit", "max_concurrent_starts")
+    apply_dict(c, "start_slot_lease", "rate_limit", "start_slot_lease")
+    apply_dict(c, "event_stream_duration", "events", "stream_duration")
+    apply_dict(c, "event_stream_max", "events", "max_streams")
+    apply_dict(c, "event_stream_max_threaded", "events", "max_threaded_streams")
+    apply_dict(c, "event_retention", "events", "retention")
+    apply_dict(c, "expiry_warning", "events", "expiry_warning")
+    apply_dict(c, "capacity_enabled", "capacity", "enabled")
+    apply_dict(c, "capacity_cpu", "capacity", "cpu", func=str)
+    apply_dict(c, "capacity_memory", "capacity", "memory", func=str)
+    apply_dict(c, "capacity_max_utilization", "capacity", "max_utilization")
+    apply_dict(c, "deploy_queue_max_length", "deploy_queue", "max_length")
+    apply_dict(c, "deploy_queue_max_per_team", "deploy_queue", "max_per_team")
+    apply_dict(c, "deploy_queue_max_wait", "deploy_queue", "max_wait")
+    apply_dict(c, "preemption_enabled", "preemption", "enabled")
+    apply_dict(c, "preemption_policy", "preemption", "policy")
+    apply_dict(c, "preemption_min_age", "preemption", "min_age")
+    apply_dict(c, "prepull_enabled", "prepull", "enabled")
+    apply_dict(c, "prepull_namespace", "prepull", "namespace")
+    apply_dict(c, "prepull_helper_image", "prepull", "helper_image")
+    apply_dict(c, "prepull_pause_image", "prepull", "pause_image")
+    apply_dict(c, "tracing_enabled", "tracing", "enabled")
+    apply_dict(c, "tracing_exporter", "tracing", "exporter")
+    apply_dict(c, "tracing_file", "tracing", "file")
+    apply_dict(c, "tracing_retention", "tracing", "retention")
+    apply_dict(c, "metrics_enabled", "metrics", "enabled")
+    apply_dict(c, "metrics_token", "metrics", "token")
+    apply_dict(c, "metrics_worker_port", "metrics", "worker_port")
+    apply_dict(c, "profiling_enabled", "profiling", "enabled")
+    apply_dict(c, "profiling_max_duration", "profiling", "max_duration")
+    apply_dict(c, "profiling_max_stacks", "profiling", "max_stacks")
+    apply_dict(c, "profiling_retention", "profiling", "retention")
+    apply_dict(c, "event_log_enabled", "event_log", "enabled")
+    apply_dict(c, "event_log_batch_size", "event_log", "batch_size")
+    apply_dict(c, "event_log_flush_interval", "event_log", "flush_interval")
+    apply_dict(c, "deploy_coalesce_wait", "deploy", "coalesce_wait")
+    apply_dict(c, "deploy_idempotency_window", "deploy", "idempotency_window")
+    apply_dict(c, "tcp_exposure", "tcp", "exposure")
+    apply_dict(c, "tcp_sni_port", "tcp", "sni_port")
+    apply_dict(c, "tcp_sni_entrypoint", "tcp", "sni_entrypoint")
 
 
 try:
@@ -195,6 +414,8 @@ apply_env("INSTANCER_POSTGRES_PORT", "postgres_port", func=int)
 apply_env("INSTANCER_POSTGRES_USER", "postgres_user")
 apply_env("INSTANCER_POSTGRES_DATABASE", "postgres_database")
 apply_env("INSTANCER_POSTGRES_PASSWORD", "postgres_password")
+apply_env("INSTANCER_POSTGRES_POOL_SIZE", "postgres_pool_size", func=int)
+apply_env("INSTANCER_KUBE_CONNECTION_POOL_SIZE", "kube_connection_pool_size", func=int)
 apply_env("INSTANCER_REDIS_RESYNC_INTERVAL", "redis_resync_interval", func=int)
 apply_env("INSTANCER_DEV", "dev", func=parse_bool)
 apply_env("INSTANCER_URL", "url")
@@ -204,6 +425,52 @@ apply_env("INSTANCER_SESSION_LENGTH", "session_length", func=int)
 apply_env("INSTANCER_RCTF_URL", "rctf_url")
 apply_env("INSTANCER_RECAPTCHA_SITE_KEY", "recaptcha_site_key")
 apply_env("INSTANCER_RECAPTCHA_SECRET", "recaptcha_secret")
+apply_env("INSTANCER_TEAM_DEPLOY_BURST", "team_deploy_burst", func=int)
+apply_env("INSTANCER_TEAM_DEPLOY_PER_MINUTE", "team_deploy_per_minute", func=float)
+apply_env("INSTANCER_CHALLENGE_DEPLOY_BURST", "challenge_deploy_burst", func=int)
+apply_env(
+    "INSTANCER_CHALLENGE_DEPLOY_PER_MINUTE", "challenge_deploy_per_minute", func=float
+)
+apply_env("INSTANCER_MAX_CONCURRENT_STARTS", "max_concurrent_starts", func=int)
+apply_env("INSTANCER_START_SLOT_LEASE", "start_slot_lease", func=int)
+apply_env("INSTANCER_EVENT_STREAM_DURATION", "event_stream_duration", func=int)
+apply_env("INSTANCER_EVENT_STREAM_MAX", "event_stream_max", func=int)
+apply_env("INSTANCER_EVENT_STREAM_MAX_THREADED", "event_stream_max_threaded", func=int)
+apply_env("INSTANCER_EVENT_RETENTION", "event_retention", func=int)
+apply_env("INSTANCER_EXPIRY_WARNING", "expiry_warning", func=int)
+apply_env("INSTANCER_CAPACITY_ENABLED", "capacity_enabled", func=parse_bool)
+apply_env("INSTANCER_CAPACITY_CPU", "capacity_cpu")
+apply_env("INSTANCER_CAPACITY_MEMORY", "capacity_memory")
+apply_env("INSTANCER_CAPACITY_MAX_UTILIZATION", "capacity_max_utilization", func=float)
+apply_env("INSTANCER_DEPLOY_QUEUE_MAX_LENGTH", "deploy_queue_max_length", func=int)
+apply_env("INSTANCER_DEPLOY_QUEUE_MAX_PER_TEAM", "deploy_queue_max_per_team", func=int)
+apply_env("INSTANCER_DEPLOY_QUEUE_MAX_WAIT", "deploy_queue_max_wait", func=int)
+apply_env("INSTANCER_PREEMPTION_ENABLED", "preemption_enabled", func=parse_bool)
+apply_env("INSTANCER_PREEMPTION_POLICY", "preemption_policy")
+apply_env("INSTANCER_PREEMPTION_MIN_AGE", "preemption_min_age", func=int)
+apply_env("INSTANCER_PREPULL_ENABLED", "prepull_enabled", func=parse_bool)
+apply_env("INSTANCER_PREPULL_NAMESPACE", "prepull_namespace")
+apply_env("INSTANCER_PREPULL_HELPER_IMAGE", "prepull_helper_image")
+apply_env("INSTANCER_PREPULL_PAUSE_IMAGE", "prepull_pause_image")
+apply_env("INSTANCER_TRACING_ENABLED", "tracing_enabled", func=parse_bool)
+apply_env("INSTANCER_TRACING_EXPORTER", "tracing_exporter")
+apply_env("INSTANCER_TRACING_FILE", "tracing_file")
+apply_env("INSTANCER_TRACING_RETENTION", "tracing_retention", func=int)
+apply_env("INSTANCER_METRICS_ENABLED", "metrics_enabled", func=parse_bool)
+apply_env("INSTANCER_METRICS_TOKEN", "metrics_token")
+apply_env("INSTANCER_METRICS_WORKER_PORT", "metrics_worker_port", func=int)
+apply_env("INSTANCER_PROFILING_ENABLED", "profiling_enabled", func=parse_bool)
+apply_env("INSTANCER_PROFILING_MAX_DURATION", "profiling_max_duration", func=int)
+apply_env("INSTANCER_PROFILING_MAX_STACKS", "profiling_max_stacks", func=int)
+apply_env("INSTANCER_PROFILING_RETENTION", "profiling_retention", func=int)
+apply_env("INSTANCER_EVENT_LOG_ENABLED", "event_log_enabled", func=parse_bool)
+apply_env("INSTANCER_EVENT_LOG_BATCH_SIZE", "event_log_batch_size", func=int)
+apply_env("INSTANCER_EVENT_LOG_FLUSH_INTERVAL", "event_log_flush_interval", func=float)
+apply_env("INSTANCER_DEPLOY_COALESCE_WAIT", "deploy_coalesce_wait", func=int)
+apply_env("INSTANCER_DEPLOY_IDEMPOTENCY_WINDOW", "deploy_idempotency_window", func=int)
+apply_env("INSTANCER_TCP_EXPOSURE", "tcp_exposure")
+apply_env("INSTANCER_TCP_SNI_PORT", "tcp_sni_port", func=int)
+apply_env("INSTANCER_TCP_SNI_ENTRYPOINT", "tcp_sni_entrypoint")
 
 config = Config(partial_config)
 
@@ -212,16 +479,52 @@ rclient = redis.Redis(
 )
 "Redis client"
 
+arclient: "redis.asyncio.Redis[bytes]" = redis.asyncio.Redis(
+    host=config.redis_host, port=config.redis_port, password=config.redis_password
+)
+"Async Redis client, used by the async serving mode"
+
+_pg_kwargs = {
+    "host": config.postgres_host,
+    "dbname": config.postgres_database,
+    "user": config.postgres_user,
+    "port": config.postgres_port,
+    "password": config.postgres_password,
+}
+
+pg_pool = ConnectionPool(
+    kwargs=_pg_kwargs,
+    min_size=1,
+    max_size=config.postgres_pool_size,
+    open=False,
+)
+"Postgres connection pool, opened on first use"
 
-def connect_pg() -> psycopg.Connection[Any]:
-    """Spawn a postgres connection."""
-    return psycopg.connect(
-        host=config.postgres_host,
-        dbname=config.postgres_database,
-        user=config.postgres_user,
-        port=config.postgres_port,
-        password=config.postgres_password,
-    )
+apg_pool = AsyncConnectionPool(
+    kwargs=_pg_kwargs,
+    min_size=1,
+    max_size=config.postgres_pool_size,
+    open=False,
+)
+"Async Postgres connection pool used by the async serving mode, opened on first use"
+
+
+def connect_pg() -> AbstractContextManager[psycopg.Connection[Any]]:
+    """Borrow a postgres connection from the pool.
+
+    Like a plain connection, the transaction is committed when the context exits
+    (or rolled back on error), but the connection is returned to the pool instead
+    of being closed."""
+    pg_pool.open()
+    return pg_pool.connection()
+
+
+@asynccontextmanager
+async def connect_pg_async() -> AsyncIterator[psycopg.AsyncConnection[Any]]:
+    """Borrow a postgres connection from the async pool, like connect_pg."""
+    await apg_pool.open()
+    async with apg_pool.connection() as conn:
+        yield conn
 
 
 # If boot_time challenge column is missing, add the column
@@ -250,3 +553,48 @@ if rclient.set("migration:db_boot_time", "done", nx=True):
                     file=sys.stdout,
                     flush=True,
                 )
+
+# Add the instance event log tables to databases created before they existed
+if rclient.set("migration:instance_events", "done", nx=True):
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            print(
+                "[*] Migrating database - instance_events update",
+                file=sys.stdout,
+                flush=True,
+            )
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS public.instance_events (
+                    id bigserial PRIMARY KEY,
+                    time timestamp with time zone NOT NULL,
+                    challenge_id character varying(256) NOT NULL,
+                    team_id UUID,
+                    action character varying(16) NOT NULL,
+                    outcome character varying(16) NOT NULL,
+                    duration double precision NOT NULL,
+                    uptime integer,
+                    error text
+                )"""
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS instance_events_challenge_id_time_idx ON public.instance_events (challenge_id, time)"
+            )
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS public.instance_event_stats (
+                    challenge_id character varying(256) NOT NULL,
+                    action character varying(16) NOT NULL,
+                    events bigint NOT NULL,
+                    failures bigint NOT NULL,
+                    rejections bigint NOT NULL,
+                    total_duration double precision NOT NULL,
+                    max_duration double precision NOT NULL,
+                    total_uptime bigint NOT NULL,
+                    last_event timestamp with time zone NOT NULL,
+                    PRIMARY KEY (challenge_id, action)
+                )"""
+            )
+            print(
+                "[*] Migration finished - instance_events update",
+                file=sys.stdout,
+                flush=True,
+            )
@@ -0,0 +1,271 @@
+import json
+from dataclasses import asdict, dataclass
+from time import time
+
+from instancer.config import config, rclient
+from instancer.lock import FENCE_CHECK, Lock, run_fenced
+
+_KEYS = ["deploy_queue:pending", "deploy_queue:entries", "deploy_queue:teams"]
+_TEAM_PREFIX = "deploy_queue:team:"
+
+
+class QueueFullError(Exception):
+    """Exception thrown when a deploy can't be queued because the queue is full."""
+
+    reason: str
+    "Either queue_full or team_queue_full."
+
+    def __init__(self, reason: str):
+        super().__init__(reason.replace("_", " "))
+        self.reason = reason
+
+
+@dataclass
+class QueuedDeploy:
+    """A deploy waiting for cluster capacity."""
+
+    namespace: str
+    "The namespace the instance will run in."
+    challenge_id: str
+    "The ID of the challenge."
+    team_id: str
+    "The ID of the team that requested the deploy."
+    enqueued: int
+    "The time the deploy was queued."
+
+
+@dataclass
+class QueuePosition:
+    """The place of a deploy in the queue."""
+
+    position: int
+    "The number of deploys that will start before this one."
+    eta: int | None
+    "Estimated seconds until the deploy starts, or None if it can't be estimated."
+
+
+# The queue is a list of namespaces per team plus a ring of the teams with queued
+# deploys. Deploys are taken from the team at the head of the ring, which then moves to
+# the tail, so every team gets one deploy started per round no matter how many it queued.
+# The pending hash maps queued namespaces to their team and the entries hash maps them
+# to the JSON of their QueuedDeploy.
+
+# Queue a deploy at the tail of its team's queue.
+# KEYS[1]: pending hash, KEYS[2]: entries hash, KEYS[3]: team ring, KEYS[4]: team queue
+# ARGV: namespace, team, entry, max length, max length per team
+# Returns an empty string if the deploy was queued or was already queued, otherwise the
+# reason it was rejected.
+_enqueue = rclient.register_script(
+    """
+if redis.call("HEXISTS", KEYS[1], ARGV[1]) == 1 then
+    return ""
+end
+if redis.call("HLEN", KEYS[1]) >= tonumber(ARGV[4]) then
+    return "queue_full"
+end
+if redis.call("LLEN", KEYS[4]) >= tonumber(ARGV[5]) then
+    return "team_queue_full"
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[3])
+if redis.call("RPUSH", KEYS[4], ARGV[1]) == 1 then
+    redis.call("RPUSH", KEYS[3], ARGV[2])
+end
+return ""
+"""
+)
+
+# Take the next deploy in round-robin order.
+# KEYS[1]: pending hash, KEYS[2]: entries hash, KEYS[3]: team ring
+# ARGV[1]: team queue key prefix
+# Returns the entry of the deploy, or nil if the queue is empty.
+# Fenced by the deploy queue lock.
+_pop = rclient.register_script(
+    FENCE_CHECK
+    + """
+while true do
+    local team = redis.call("LPOP", KEYS[3])
+    if not team then
+        return false
+    end
+    local key = ARGV[1] .. team
+    local namespace = redis.call("LPOP", key)
+    if redis.call("LLEN", key) > 0 then
+        redis.call("RPUSH", KEYS[3], team)
+    end
+    if namespace then
+        local entry = redis.call("HGET", KEYS[2], namespace)
+        redis.call("HDEL", KEYS[1], namespace)
+        redis.call("HDEL", KEYS[2], namespace)
+        return entry
+    end
+end
+"""
+)
+
+# Put a deploy back at the head of the queue, keeping its team's turn.
+# KEYS[1]: pending hash, KEYS[2]: entries hash, KEYS[3]: team ring, KEYS[4]: team queue
+# ARGV: namespace, team, entry
+# Fenced by the deploy queue lock.
+_requeue = rclient.register_script(
+    FENCE_CHECK
+    + """
+if redis.call("HEXISTS", KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[3])
+redis.call("LPUSH", KEYS[4], ARGV[1])
+redis.call("LREM", KEYS[3], 0, ARGV[2])
+redis.call("LPUSH", KEYS[3], ARGV[2])
+return 1
+"""
+)
+
+# Remove deploys from the queue.
+# KEYS[1]: pending hash, KEYS[2]: entries hash, KEYS[3]: team ring
+# ARGV: team queue key prefix, then the namespaces
+# Returns the number of deploys removed.
+_remove = rclient.register_script(
+    """
+local removed = 0
+for i = 2, #ARGV do
+    local team = redis.call("HGET", KEYS[1], ARGV[i])
+    if team then
+        local key = ARGV[1] .. team
+        redis.call("LREM", key, 0, ARGV[i])
+        if redis.call("LLEN", key) == 0 then
+            redis.call("LREM", KEYS[3], 0, team)
+        end
+        redis.call("HDEL", KEYS[1], ARGV[i])
+        redis.call("HDEL", KEYS[2], ARGV[i])
+        removed = removed + 1
+    end
+end
+return removed
+"""
+)
+
+# Find the position of a deploy and the expiration that should free room for it.
+# KEYS[1]: pending hash, KEYS[2]: team ring, KEYS[3]: expiration zset
+# ARGV: team queue key prefix, namespace
+# Returns nil if the deploy isn't queued, otherwise the number of deploys ahead of it
+# and the time the instance expiring at that position in the expiration zset expires.
+_position = rclient.register_script(
+    """
+local team = redis.call("HGET", KEYS[1], ARGV[2])
+if not team then
+    return false
+end
+local index = redis.call("LPOS", ARGV[1] .. team, ARGV[2])
+local position = 0
+local ahead = true
+for _, other in ipairs(redis.call("LRANGE", KEYS[2], 0, -1)) do
+    if other == team then
+        ahead = false
+    end
+    local length = redis.call("LLEN", ARGV[1] .. other)
+    position = position + math.min(length, index)
+    if ahead and length > index then
+        position = position + 1
+    end
+end
+local expiring = redis.call("ZRANGE", KEYS[3], position, position, "WITHSCORES")
+return {position, expiring[2] or false}
+"""
+)
+
+
+def enqueue_deploy(namespace: str, challenge_id: str, team_id: str) -> QueuePosition:
+    """Queue a deploy until there is capacity for it.
+
+    Queueing a deploy that is already queued keeps its place. Raises QueueFullError if
+    the queue or the team's share of it is full."""
+
+    deploy = QueuedDeploy(namespace, challenge_id, team_id, int(time()))
+    rejected = _enqueue(
+        keys=[*_KEYS, _TEAM_PREFIX + team_id],
+        args=[
+            namespace,
+            team_id,
+            json.dumps(asdict(deploy)),
+            config.deploy_queue_max_length,
+            config.deploy_queue_max_per_team,
+        ],
+    )
+    if rejected:
+        raise QueueFullError(rejected.decode())
+    position = queue_position(namespace)
+    # only possible if a worker started the deploy in the meantime
+    return position if position is not None else QueuePosition(0, 0)
+
+
+def queue_position(namespace: str) -> QueuePosition | None:
+    """Return the place of a deploy in the queue, or None if it isn't queued.
+
+    The ETA assumes each deploy ahead waits for one running instance to expire."""
+
+    result = _position(
+        keys=["deploy_queue:pending", "deploy_queue:teams", "expiration"],
+        args=[_TEAM_PREFIX, namespace],
+    )
+    if result is None:
+        return None
+    position, expiring = result[0], result[1] if len(result) > 1 else None
+    return QueuePosition(
+        position=position,
+        eta=None if expiring is None else max(0, int(float(expiring)) - int(time())),
+    )
+
+
+def pop_deploy(lock: Lock | None = None) -> QueuedDeploy | None:
+    """Take the next deploy off the queue, or return None if it's empty.
+
+    Raises FencedException if `lock`, the deploy queue lock held by the caller, was taken
+    by someone else since it was acquired."""
+
+    entry = run_fenced(_pop, lock, keys=_KEYS, args=[_TEAM_PREFIX])
+    if entry is None:
+        return None
+    return QueuedDeploy(**json.loads(entry))
+
+
+def peek_deploy() -> QueuedDeploy | None:
+    """Return the next deploy without taking it off the queue, or None if it's empty."""
+
+    team = rclient.lindex("deploy_queue:teams", 0)
+    if team is None:
+        return None
+    namespace = rclient.lindex(_TEAM_PREFIX + team.decode(), 0)
+    if namespace is None:
+        return None
+    entry = rclient.hget("deploy_queue:entries", namespace)
+    if entry is None:
+        return None
+    return QueuedDeploy(**json.loads(entry))
+
+
+def requeue_deploy(deploy: QueuedDeploy, lock: Lock | None = None) -> None:
+    """Put a deploy that couldn't be started back at the head of the queue, fenced by
+    `lock` like pop_deploy."""
+
+    run_fenced(
+        _requeue,
+        lock,
+        keys=[*_KEYS, _TEAM_PREFIX + deploy.team_id],
+        args=[deploy.namespace, deploy.team_id, json.dumps(asdict(deploy))],
+    )
+
+
+def remove_deploys(namespaces: list[str]) -> int:
+    """Remove deploys from the queue. Returns the number of deploys removed."""
+
+    if len(namespaces) == 0:
+        return 0
+    return int(_remove(keys=_KEYS, args=[_TEAM_PREFIX, *namespaces]))
+
+
+def queue_length() -> int:
+    """Return the number of queued deploys."""
+
+    return int(rclient.hlen("deploy_queue:pending"))
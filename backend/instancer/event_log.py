@@ -0,0 +1,281 @@
+"""Append-only log of instance deploys, renewals, readiness, stops and expirations.
+
+Events are queued in memory and a background thread writes them to the instance_events
+table in batches, so recording an event never waits on Postgres. Each batch also adds
+its events to per-challenge totals in instance_event_stats, so stats can be read
+without scanning the log."""
+
+import atexit
+import os
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic, time
+from typing import Any
+
+import psycopg
+
+from instancer.config import config, connect_pg
+
+ACTIONS = ["deploy", "renew", "ready", "stop", "expire", "preempt"]
+"Actions recorded in the event log."
+TEARDOWN_ACTIONS = ["stop", "expire", "preempt"]
+"Actions that end an instance, which record its uptime."
+OUTCOMES = ["ok", "rejected", "failed"]
+"""Outcomes of recorded actions. Deploys turned away for lack of capacity or because
+the instance was busy are rejected rather than failed."""
+MAX_QUEUED = 10000
+"Number of events a process queues before dropping new ones."
+
+
+@dataclass
+class InstanceEvent:
+    """Something that happened to a challenge instance."""
+
+    challenge_id: str
+    "The ID of the challenge."
+    team_id: str | None
+    "The team of a per-team instance, or None for shared instances."
+    action: str
+    "What happened, one of ACTIONS."
+    outcome: str
+    "Whether it worked, one of OUTCOMES."
+    duration: float
+    """The number of seconds it took. For ready events, the time from the instance being
+    created to all of its pods being ready."""
+    uptime: int | None = None
+    "The number of seconds the instance had been running, for TEARDOWN_ACTIONS."
+    error: str | None = None
+    "The exception that failed or rejected the action."
+    time: float = field(default_factory=time)
+    "The time it happened."
+
+
+_queue: Queue[InstanceEvent] = Queue(MAX_QUEUED)
+_writing: int | None = None
+"PID of the process the writer thread was started in."
+_writing_lock = Lock()
+_dropped = 0
+
+
+def record_event(
+    challenge_id: str,
+    team_id: str | None,
+    action: str,
+    outcome: str,
+    duration: float,
+    uptime: int | None = None,
+    error: str | None = None,
+) -> None:
+    """Queue an event to be written to the event log. Never blocks; events are dropped
+    if the log is disabled or too far behind."""
+
+    global _dropped
+    if not config.event_log_enabled:
+        return
+    _start_writer()
+    try:
+        _queue.put_nowait(
+            InstanceEvent(
+                challenge_id, team_id, action, outcome, duration, uptime, error
+            )
+        )
+    except Full:
+        _dropped += 1
+        if _dropped % 1000 == 1:
+            print(f"[*] Event log is behind, dropped {_dropped} events", flush=True)
+
+
+def _start_writer() -> None:
+    global _writing
+    if _writing == os.getpid():
+        return
+    with _writing_lock:
+        if _writing != os.getpid():
+            _writing = os.getpid()
+            Thread(target=_write_batches, daemon=True).start()
+            atexit.register(_flush_at_exit)
+
+
+def _take_batch(wait: bool) -> list[InstanceEvent]:
+    """Take up to event_log_batch_size queued events. If `wait` is set, wait for the
+    first event and then up to event_log_flush_interval seconds for more."""
+
+    batch = []
+    if wait:
+        batch.append(_queue.get())
+    deadline = monotonic() + config.event_log_flush_interval
+    while len(batch) < config.event_log_batch_size:
+        try:
+            if wait:
+                batch.append(_queue.get(timeout=max(deadline - monotonic(), 0)))
+            else:
+                batch.append(_queue.get_nowait())
+        except Empty:
+            break
+    return batch
+
+
+def _write_batches() -> None:
+    while True:
+        batch = _take_batch(wait=True)
+        try:
+            write_events(batch)
+        except psycopg.Error as e:
+            print(
+                f"[*] Could not write {len(batch)} events due to error {e}", flush=True
+            )
+
+
+def flush() -> None:
+    """Write every queued event now."""
+
+    while len(batch := _take_batch(wait=False)) > 0:
+        write_events(batch)
+
+
+def _flush_at_exit() -> None:
+    try:
+        flush()
+    except psycopg.Error as e:
+        print(f"[*] Could not write queued events due to error {e}", flush=True)
+
+
+def write_events(events: list[InstanceEvent]) -> None:
+    """Append events to the log and add them to the per-challenge stats in one
+    transaction."""
+
+    # challenge ID, action -> events, failures, rejections, total and max duration,
+    # total uptime, last event
+    totals: dict[tuple[str, str], list[Any]] = defaultdict(
+        lambda: [0, 0, 0, 0.0, 0.0, 0, 0.0]
+    )
+    for event in events:
+        total = totals[event.challenge_id, event.action]
+        total[0] += 1
+        total[1] += event.outcome == "failed"
+        total[2] += event.outcome == "rejected"
+        total[3] += event.duration
+        total[4] = max(total[4], event.duration)
+        total[5] += event.uptime or 0
+        total[6] = max(total[6], event.time)
+
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            with cur.copy(
+                "COPY instance_events (time, challenge_id, team_id, action, outcome, duration, uptime, error) FROM STDIN"
+            ) as copy:
+                for event in events:
+                    copy.write_row(
+                        (
+                            datetime.fromtimestamp(event.time, timezone.utc),
+                            event.challenge_id,
+                            event.team_id,
+                            event.action,
+                            event.outcome,
+                            event.duration,
+                            event.uptime,
+                            event.error,
+                        )
+                    )
+            cur.executemany(
+                """INSERT INTO instance_event_stats AS s
+                (challenge_id, action, events, failures, rejections, total_duration, max_duration, total_uptime, last_event)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (challenge_id, action) DO UPDATE SET
+                events = s.events + EXCLUDED.events,
+                failures = s.failures + EXCLUDED.failures,
+                rejections = s.rejections + EXCLUDED.rejections,
+                total_duration = s.total_duration + EXCLUDED.total_duration,
+                max_duration = GREATEST(s.max_duration, EXCLUDED.max_duration),
+                total_uptime = s.total_uptime + EXCLUDED.total_uptime,
+                last_event = GREATEST(s.last_event, EXCLUDED.last_event)""",
+                [
+                    (
+                        chall_id,
+                        action,
+                        *total[:6],
+                        datetime.fromtimestamp(total[6], timezone.utc),
+                    )
+                    # sorted so concurrent writers lock rows in the same order
+                    for (chall_id, action), total in sorted(totals.items())
+                ],
+            )
+
+
+def challenge_stats(challenge_id: str | None = None) -> dict[str, dict[str, Any]]:
+    """Return the totals of every action of every challenge, or of one challenge, keyed
+    by challenge ID and then action."""
+
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT challenge_id, action, events, failures, rejections, total_duration, max_duration, total_uptime, last_event FROM instance_event_stats"
+                + (" WHERE challenge_id=%s" if challenge_id is not None else "")
+                + " ORDER BY challenge_id, action",
+                () if challenge_id is None else (challenge_id,),
+            )
+            rows = cur.fetchall()
+    stats: dict[str, dict[str, Any]] = defaultdict(dict)
+    for (
+        chall_id,
+        action,
+        events,
+        failures,
+        rejections,
+        total_duration,
+        max_duration,
+        total_uptime,
+        last_event,
+    ) in rows:
+        stats[chall_id][action] = {
+            "events": events,
+            "failures": failures,
+            "rejections": rejections,
+            "mean_duration": total_duration / events,
+            "max_duration": max_duration,
+            "mean_uptime": (
+                total_uptime / events if action in TEARDOWN_ACTIONS else None
+            ),
+            "last_event": int(last_event.timestamp()),
+        }
+    return stats
+
+
+def recent_events(
+    challenge_id: str | None, team_id: str | None, limit: int
+) -> list[dict[str, Any]]:
+    """Return the most recent events, newest first, optionally of one challenge, one
+    team or both."""
+
+    conditions = []
+    params: list[Any] = []
+    if challenge_id is not None:
+        conditions.append("challenge_id=%s")
+        params.append(challenge_id)
+    if team_id is not None:
+        conditions.append("team_id=%s")
+        params.append(team_id)
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT time, challenge_id, team_id, action, outcome, duration, uptime, error FROM instance_events"
+                + (" WHERE " + " AND ".join(conditions) if conditions else "")
+                + " ORDER BY time DESC LIMIT %s",
+                (*params, limit),
+            )
+            return [
+                {
+                    "time": event_time.timestamp(),
+                    "challenge_id": chall_id,
+                    "team_id": None if team is None else str(team),
+                    "action": action,
+                    "outcome": outcome,
+                    "duration": duration,
+                    "uptime": uptime,
+                    "error": error,
+                }
+                for event_time, chall_id, team, action, outcome, duration, uptime, error in cur.fetchall()
+            ]
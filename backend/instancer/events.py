@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import json
+import re
+from dataclasses import dataclass, field
+from threading import Lock
+from time import time, time_ns
+from typing import Any, Generator
+
+from redis.client import Pipeline
+
+from instancer.config import config, rclient
+from instancer.inventory import instance_teams
+from instancer.tracing import span
+
+PHASES = [
+    "queued",
+    "namespace_created",
+    "pods_scheduled",
+    "containers_ready",
+    "renewed",
+    "expiring_soon",
+    "terminated",
+    "failed",
+]
+"Deployment phases published for challenge instances."
+
+_per_team_namespace = re.compile(r"ci-.+-t-([0-9a-f]{32})")
+
+
+def publish_event(namespace: str, phase: str, **data: Any) -> None:
+    """Publish a deployment progress event for the instance running in a namespace.
+
+    The last event of each instance is also stored so new subscribers can catch up."""
+
+    publish_events([namespace], phase, **data)
+
+
+def publish_events(
+    namespaces: list[str],
+    phase: str,
+    teams: dict[str, str | None] | None = None,
+    **data: Any,
+) -> None:
+    """Publish the same deployment progress event for several instances in one round trip.
+
+    The status versions of the instances are bumped as well. See status_scopes for
+    `teams`."""
+
+    if len(namespaces) == 0:
+        return
+    event = json.dumps({"phase": phase, "time": int(time()), **data})
+    pipe = rclient.pipeline(transaction=False)
+    for namespace in namespaces:
+        pipe.set(f"last_event:{namespace}", event, ex=config.event_retention)
+        pipe.publish(f"events:{namespace}", event)
+    _touch_status(pipe, namespaces, teams)
+    with span("redis.publish_event", phase=phase):
+        pipe.execute()
+
+
+def status_scopes(
+    namespaces: list[str], teams: dict[str, str | None] | None = None
+) -> set[str]:
+    """Return the status version scopes of instances: the team ID without dashes for
+    per-team instances and "shared" for shared instances.
+
+    The team of each instance is taken from `teams`, which maps namespaces to their team
+    ID or None, and otherwise from the instance inventory. Instances in neither, such as
+    deploys that are only queued, fall back to the team in their namespace name, which
+    names shortened to fit Kubernetes don't have."""
+
+    known = dict(teams or {})
+    known.update(instance_teams([ns for ns in namespaces if ns not in known]))
+    scopes = set()
+    for namespace in namespaces:
+        if namespace in known:
+            team_id = known[namespace]
+            scopes.add("shared" if team_id is None else team_status_scope(team_id))
+        else:
+            match = _per_team_namespace.fullmatch(namespace)
+            scopes.add("shared" if match is None else match[1])
+    return scopes
+
+
+def team_status_scope(team_id: str) -> str:
+    """Return the status version scope of a team's per-team instances."""
+
+    return team_id.replace("-", "")
+
+
+def _touch_status(
+    pipe: Pipeline[bytes],
+    namespaces: list[str],
+    teams: dict[str, str | None] | None = None,
+) -> None:
+    scopes = status_scopes(namespaces, teams)
+    # time_ns never repeats a previous value, so a stamp can't match an old ETag
+    stamp = time_ns()
+    for namespace in namespaces:
+        pipe.set(f"status_version:{namespace}", stamp)
+    for scope in scopes:
+        pipe.set(f"status_version:scope:{scope}", stamp)
+
+
+def touch_status(namespace: str) -> None:
+    """Bump the status version of an instance whose deployment info changed without an event."""
+
+    touch_statuses([namespace])
+
+
+def touch_statuses(
+    namespaces: list[str], teams: dict[str, str | None] | None = None
+) -> None:
+    """Bump the status versions of instances whose deployment info changed without an
+    event. See status_scopes for `teams`."""
+
+    if len(namespaces) == 0:
+        return
+    pipe = rclient.pipeline(transaction=False)
+    _touch_status(pipe, namespaces, teams)
+    pipe.execute()
+
+
+def status_versions(keys: list[str]) -> list[str]:
+    """Return the status versions of namespaces or scopes ("scope:<scope>") in one round trip.
+
+    Namespaces or scopes that never changed have version 0."""
+
+    if len(keys) == 0:
+        return []
+    return [
+        "0" if version is None else version.decode()
+        for version in rclient.mget([f"status_version:{key}" for key in keys])
+    ]
+
+
+def last_event(namespace: str) -> dict[str, Any] | None:
+    """Return the last event published for a namespace, or None if there isn't one."""
+
+    data = rclient.get(f"last_event:{namespace}")
+    if data is None:
+        return None
+    event: dict[str, Any] = json.loads(data)
+    return event
+
+
+def listen(
+    namespace: str, keepalive: float, duration: float
+) -> Generator[Any, None, None]:
+    """Yield events published for a namespace for up to `duration` seconds.
+
+    None is yielded after `keepalive` seconds without an event so callers can
+    keep idle connections open. The subscription starts before the first value
+    is yielded, so no event published after that point is missed."""
+
+    pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(f"events:{namespace}")
+        deadline = time() + duration
+        last_yield = time()
+        yield None
+        while (remaining := deadline - time()) > 0:
+            msg = pubsub.get_message(timeout=min(keepalive, remaining))
+            if msg is not None and msg["type"] == "message":
+                last_yield = time()
+                yield json.loads(msg["data"])
+            elif time() - last_yield >= keepalive:
+                last_yield = time()
+                yield None
+    finally:
+        pubsub.close()
+
+
+@dataclass
+class StreamLimit:
+    """Counts the event streams a process is serving so it can turn away new ones once
+    it serves `limit` of them."""
+
+    limit: int
+    "The number of streams served at once."
+    open: int = 0
+    "The number of streams being served."
+    _lock: Lock = field(default_factory=Lock, repr=False)
+
+    def acquire(self) -> bool:
+        """Count a new stream and return True, or return False if the limit is reached."""
+        with self._lock:
+            if self.open >= self.limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self) -> None:
+        """Stop counting a stream that ended."""
+        with self._lock:
+            self.open -= 1
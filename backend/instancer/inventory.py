@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from random import randbytes
+
+from redis.client import Pipeline
+
+from instancer.config import rclient
+
+CURSOR_TTL = 300
+"Number of seconds a pagination cursor stays valid after the first page was requested."
+
+
+@dataclass
+class InstanceInfo:
+    """A running challenge instance in the inventory."""
+
+    namespace: str
+    "The namespace of the instance."
+    challenge_id: str
+    "The ID of the challenge."
+    team_id: str | None
+    "The ID of the team the instance belongs to, or None for shared challenges."
+    boot_time: int
+    "The time the instance was started."
+    expiration: int | None
+    "The time the instance expires."
+
+
+@dataclass
+class InventoryPage:
+    """A page of the instance inventory."""
+
+    instances: list[InstanceInfo]
+    "The instances on this page."
+    total: int
+    "The number of instances matching the query across all pages."
+    next_cursor: str | None
+    "The cursor for the next page, or None if this is the last page."
+
+
+def index_instance(
+    pipe: Pipeline[bytes], namespace: str, labels: dict[str, str]
+) -> None:
+    """Add an instance to the inventory indexes given the labels of its namespace, or of
+    its objects if it is label-scoped."""
+
+    chall_id = labels["instancer.acmcyber.com/instance-id"]
+    team_id = labels.get("instancer.acmcyber.com/team-id", "")
+    pipe.hset(
+        f"instance:{namespace}",
+        mapping={
+            "challenge_id": chall_id,
+            "team_id": team_id,
+            # empty for instances with a namespace of their own
+            "kube_namespace": labels.get("instancer.acmcyber.com/instance-pool", ""),
+        },
+    )
+    pipe.sadd(f"instances:chall:{chall_id}", namespace)
+    if team_id:
+        pipe.sadd(f"instances:team:{team_id}", namespace)
+
+
+def unindex_instances(pipe: Pipeline[bytes], namespaces: list[str]) -> None:
+    """Remove instances from the inventory indexes.
+
+    The index entries are read in one round trip and the removals are queued on `pipe`.
+    """
+
+    read = rclient.pipeline(transaction=False)
+    for namespace in namespaces:
+        read.hmget(f"instance:{namespace}", "challenge_id", "team_id")
+    for namespace, (chall_id, team_id) in zip(namespaces, read.execute()):
+        if chall_id:
+            pipe.srem(f"instances:chall:{chall_id.decode()}", namespace)
+        if team_id:
+            pipe.srem(f"instances:team:{team_id.decode()}", namespace)
+        pipe.delete(f"instance:{namespace}")
+
+
+def instance_teams(namespaces: list[str]) -> dict[str, str | None]:
+    """Return the team ID of each indexed instance, or None for shared instances.
+
+    Instances that aren't indexed are left out."""
+
+    if len(namespaces) == 0:
+        return {}
+    pipe = rclient.pipeline(transaction=False)
+    for namespace in namespaces:
+        pipe.hmget(f"instance:{namespace}", "challenge_id", "team_id")
+    teams = {}
+    for namespace, (chall_id, team_id) in zip(namespaces, pipe.execute()):
+        if chall_id:
+            teams[namespace] = team_id.decode() or None
+    return teams
+
+
+def list_instances(
+    chall_id: str | None = None,
+    team_id: str | None = None,
+    expires_after: int | None = None,
+    expires_before: int | None = None,
+    newest_first: bool = False,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> InventoryPage | None:
+    """Return a page of running instances sorted by boot time.
+
+    The first request builds a snapshot of the matching instances in Redis by
+    intersecting the boot_time zset with the challenge and team index sets and the
+    expiration window. Later pages are read from the snapshot with the returned cursor,
+    so instances don't move between pages while paging. Only Redis is queried.
+
+    Returns None if the cursor is invalid or has expired."""
+
+    if cursor is not None:
+        try:
+            snapshot_id, offset_str, order = cursor.split(":")
+            offset = int(offset_str)
+        except ValueError:
+            return None
+        newest_first = order == "newest"
+        key = f"inventory:{snapshot_id}"
+        total = rclient.zcard(key)
+        if total == 0:
+            return None
+    else:
+        snapshot_id = randbytes(8).hex()
+        offset = 0
+        key = f"inventory:{snapshot_id}"
+        window_key = f"inventory:{snapshot_id}:window"
+        # boot_time gives the score, the other sets only filter
+        sources = {"boot_time": 1}
+        if chall_id is not None:
+            sources[f"instances:chall:{chall_id}"] = 0
+        if team_id is not None:
+            sources[f"instances:team:{team_id}"] = 0
+        pipe = rclient.pipeline()
+        if expires_after is not None or expires_before is not None:
+            pipe.zrangestore(
+                window_key,
+                "expiration",
+                "-inf" if expires_after is None else expires_after,
+                "+inf" if expires_before is None else expires_before,
+                byscore=True,
+            )
+            sources[window_key] = 0
+        pipe.zinterstore(key, sources)
+        pipe.delete(window_key)
+        pipe.expire(key, CURSOR_TTL)
+        pipe.zcard(key)
+        total = pipe.execute()[-1]
+
+    page = rclient.zrange(
+        key, offset, offset + limit - 1, desc=newest_first, withscores=True
+    )
+    pipe = rclient.pipeline(transaction=False)
+    for namespace, _ in page:
+        pipe.hmget(f"instance:{namespace.decode()}", "challenge_id", "team_id")
+        pipe.zscore("expiration", namespace)
+    results = pipe.execute()
+    instances = []
+    for i, (namespace, boot_time) in enumerate(page):
+        chall, team = results[2 * i]
+        expiration = results[2 * i + 1]
+        instances.append(
+            InstanceInfo(
+                namespace=namespace.decode(),
+                challenge_id=chall.decode() if chall else "",
+                team_id=team.decode() if team else None,
+                boot_time=int(boot_time),
+                expiration=int(expiration) if expiration is not None else None,
+            )
+        )
+    next_offset = offset + len(page)
+    return InventoryPage(
+        instances=instances,
+        total=total,
+        next_cursor=f"{snapshot_id}:{next_offset}:{'newest' if newest_first else 'oldest'}"
+        if next_offset < total
+        else None,
+    )
@@ -1,8 +1,15 @@
 from dataclasses import dataclass, field
 from random import randbytes
-from typing import Any
+from threading import Event, Thread
+from time import monotonic
+from typing import Any, Self
+
+from redis.commands.core import Script
+from redis.exceptions import ResponseError
 
 from instancer.config import rclient
+from instancer.metrics import lock_contended, lock_failed
+from instancer.tracing import span
 
 
 class LockException(Exception):
@@ -11,30 +18,184 @@ class LockException(Exception):
     pass
 
 
+class FencedException(LockException):
+    """Exception thrown when a write protected by a lock is rejected because the lock
+    was taken again since the writer acquired it."""
+
+    pass
+
+
+# Prepended to scripts whose writes are protected by a lock.
+# KEYS[#KEYS]: fencing token counter of the lock
+# ARGV[#ARGV]: fencing token of the writer's acquisition, or "" if it doesn't hold a lock
+# Fails with "fenced" if the lock was acquired again after the writer's acquisition.
+FENCE_CHECK = """
+if ARGV[#ARGV] ~= "" and redis.call("GET", KEYS[#KEYS]) ~= ARGV[#ARGV] then
+    return redis.error_reply("fenced")
+end
+"""
+
+
+# Take the lock and a fencing token for it.
+# KEYS[1]: lock, KEYS[2]: fencing token counter
+# ARGV: lock value, lease in milliseconds
+# Returns 1 and the fencing token if the lock was taken, otherwise 0 and the milliseconds
+# left on the current holder's lease.
+_acquire = rclient.register_script(
+    """
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return {1, redis.call("INCR", KEYS[2])}
+end
+return {0, redis.call("PTTL", KEYS[1])}
+"""
+)
+
+# Extend the lease of the lock if it is still held with this value.
+# KEYS[1]: lock
+# ARGV: lock value, lease in milliseconds
+# Returns 1 if the lease was extended.
+_extend = rclient.register_script(
+    """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+)
+
+# Release the lock if it is still held with this value and wake up waiters.
+# KEYS[1]: lock
+# ARGV: lock value, release channel
+# Returns 1 if the lock was released.
+_release = rclient.register_script(
+    """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("DEL", KEYS[1])
+    redis.call("PUBLISH", ARGV[2], "released")
+    return 1
+end
+return 0
+"""
+)
+
+
 @dataclass
 class Lock:
-    """Simple lock implemented using Redis."""
+    """Lock implemented using Redis.
+
+    While the lock is held its lease is extended in the background, so it only expires
+    if the holder dies. Every acquisition gets a fencing token that is larger than the
+    tokens of earlier holders, which resources can use to reject writes from a holder
+    that lost the lock."""
 
     name: str
     "The name of the lock."
     max_time: int = 60
-    "The maximum time the lock can be locked."
+    "The lease of the lock in seconds, after which it expires unless it is extended."
+    wait: float = 0
+    "The maximum time to wait for the lock to be released if it is already locked."
     lock_value: str = field(default_factory=lambda: randbytes(8).hex())
     "The value stored in the lock. Used to determine if a lock should be released."
+    token: int | None = field(default=None, init=False)
+    "The fencing token of the current acquisition, or None if the lock isn't held."
+    _released: Event = field(default_factory=Event, init=False, repr=False)
+
+    def _try_lock(self) -> float:
+        """Try to take the lock. Return 0 if it was taken, otherwise the seconds left on
+        the current holder's lease."""
+        while True:
+            taken, value = _acquire(
+                keys=["lock:" + self.name, "lock_token:" + self.name],
+                args=[self.lock_value, self.max_time * 1000],
+            )
+            if taken:
+                self.token = int(value)
+                return 0
+            left = int(value)
+            # a lock without a lease can't expire, so only a release wakes waiters up
+            if left == -1:
+                return self.max_time
+            if left > 0:
+                return left / 1000
+            # the lease ran out right after the lock was found taken, so try again
 
     def lock(self) -> None:
-        if not rclient.set(
-            "lock:" + self.name, self.lock_value, nx=True, ex=self.max_time
-        ):
+        """Take the lock, waiting up to `wait` seconds for it to be released.
+
+        Waiters block on a release notification, checking again when the holder's lease
+        runs out in case it died without releasing. Raises LockException on timeout."""
+        with span("lock.acquire", lock=self.name):
+            left = self._acquire_or_wait()
+        if left > 0:
+            lock_failed.inc()
             raise LockException(f"Lock {self.name} already exists")
+        self._released = Event()
+        Thread(target=self._renew, args=(self._released,), daemon=True).start()
+
+    def _acquire_or_wait(self) -> float:
+        """Take the lock, waiting for it if `wait` is set. Return 0 if it was taken,
+        otherwise the seconds left on the current holder's lease."""
+        left = self._try_lock()
+        if left > 0:
+            lock_contended.inc()
+        if left > 0 and self.wait > 0:
+            deadline = monotonic() + self.wait
+            pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe("lock_released:" + self.name)
+                # the lock may have been released before we subscribed
+                left = self._try_lock()
+                while left > 0 and monotonic() < deadline:
+                    pubsub.get_message(timeout=min(left, deadline - monotonic()))
+                    left = self._try_lock()
+            finally:
+                pubsub.close()
+        return left
+
+    def _renew(self, released: Event) -> None:
+        """Extend the lease every third of it until the lock is released."""
+        while not released.wait(self.max_time / 3):
+            if not _extend(
+                keys=["lock:" + self.name], args=[self.lock_value, self.max_time * 1000]
+            ):
+                print(f"[*] Lost lock {self.name} before it was released", flush=True)
+                return
 
     def unlock(self) -> None:
-        lock = "lock:" + self.name
-        if rclient.get(lock) == self.lock_value.encode():
-            rclient.delete(lock)
+        self._released.set()
+        self.token = None
+        _release(
+            keys=["lock:" + self.name],
+            args=[self.lock_value, "lock_released:" + self.name],
+        )
 
-    def __enter__(self) -> None:
+    def held(self) -> bool:
+        """Return whether anyone holds the lock."""
+        return bool(rclient.exists("lock:" + self.name))
+
+    def __enter__(self) -> Self:
         self.lock()
+        return self
 
     def __exit__(self, *args: Any) -> None:
         self.unlock()
+
+
+def run_fenced(
+    script: Script, lock: Lock | None, keys: list[str], args: list[Any]
+) -> Any:
+    """Run a script starting with FENCE_CHECK, rejecting its writes if `lock` was taken
+    by someone else since it was acquired. Scripts run without a lock aren't fenced.
+
+    Raises FencedException if the writes were rejected."""
+
+    if lock is None or lock.token is None:
+        fence_key, token = "lock_token:", ""
+    else:
+        fence_key, token = "lock_token:" + lock.name, str(lock.token)
+    try:
+        return script(keys=[*keys, fence_key], args=[*args, token])
+    except ResponseError as e:
+        if str(e) != "fenced":
+            raise
+        raise FencedException(f"Lock {lock and lock.name} was taken by someone else")
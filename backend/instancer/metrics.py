@@ -0,0 +1,191 @@
+"""Prometheus metrics of the API and the worker.
+
+Gunicorn worker processes write their metrics to files in the directory named by
+PROMETHEUS_MULTIPROC_DIR, which gunicorn.conf.py sets up, and /metrics adds up the files
+of every process. The worker serves its own metrics on `metrics_worker_port`."""
+
+import os
+from contextlib import contextmanager
+from hmac import compare_digest
+from time import perf_counter, time
+from typing import Iterable, Iterator
+
+from flask import Flask, Response, g, request
+from kubernetes.client.exceptions import ApiException
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily, Metric
+from prometheus_client.registry import Collector
+
+from instancer.config import config, rclient
+
+request_duration = Histogram(
+    "instancer_request_duration_seconds",
+    "Time taken to serve API requests.",
+    ["endpoint", "method", "status"],
+)
+cache_requests = Counter(
+    "instancer_cache_requests_total",
+    "Lookups of cached data in Redis.",
+    ["cache", "result"],
+)
+kube_request_duration = Histogram(
+    "instancer_kube_request_duration_seconds",
+    "Time taken by Kubernetes API calls.",
+    ["method", "path"],
+)
+kube_request_errors = Counter(
+    "instancer_kube_request_errors_total",
+    "Kubernetes API calls that failed.",
+    ["method", "path", "status"],
+)
+lock_contended = Counter(
+    "instancer_lock_contended_total",
+    "Lock acquisitions that found the lock already held.",
+)
+lock_failed = Counter(
+    "instancer_lock_failed_total",
+    "Lock acquisitions that gave up because the lock stayed held.",
+)
+resync_duration = Histogram(
+    "instancer_resync_duration_seconds",
+    "Time taken by the worker to resync Redis with the cluster.",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100),
+)
+
+
+def count_cache(cache: str, hits: Iterable[bool]) -> None:
+    """Count cache lookups given whether each one was a hit."""
+
+    hit = miss = 0
+    for found in hits:
+        if found:
+            hit += 1
+        else:
+            miss += 1
+    if hit > 0:
+        cache_requests.labels(cache, "hit").inc(hit)
+    if miss > 0:
+        cache_requests.labels(cache, "miss").inc(miss)
+
+
+@contextmanager
+def kube_call(method: str, path: str) -> Iterator[None]:
+    """Time a Kubernetes API call. `path` is the templated resource path, such as
+    /api/v1/namespaces/{namespace}/services, so names don't become labels."""
+
+    start = perf_counter()
+    try:
+        yield
+    except ApiException as e:
+        kube_request_errors.labels(method, path, str(e.status)).inc()
+        raise
+    except Exception:
+        kube_request_errors.labels(method, path, "error").inc()
+        raise
+    finally:
+        kube_request_duration.labels(method, path).observe(perf_counter() - start)
+
+
+class InstanceCollector(Collector):
+    """Reads the number of live instances of each challenge and the expiration backlog
+    from Redis when metrics are scraped."""
+
+    def collect(self) -> Iterator[Metric]:
+        instances = GaugeMetricFamily(
+            "instancer_instances",
+            "Running instances of each challenge.",
+            labels=["challenge"],
+        )
+        keys = list(rclient.scan_iter("instances:chall:*", count=1000))
+        pipe = rclient.pipeline(transaction=False)
+        for key in keys:
+            pipe.scard(key)
+        for key, count in zip(keys, pipe.execute()):
+            instances.add_metric([key.decode().removeprefix("instances:chall:")], count)
+        yield instances
+
+        curtime = time()
+        # Redis has incorrect type annotations that don't allow str
+        expired = rclient.zrange("expiration", "-inf", curtime, byscore=True, withscores=True)  # type: ignore[call-overload]
+        yield GaugeMetricFamily(
+            "instancer_expiration_backlog",
+            "Instances past their expiration that the worker hasn't stopped yet.",
+            value=len(expired),
+        )
+        yield GaugeMetricFamily(
+            "instancer_expiration_backlog_seconds",
+            "Seconds the longest expired instance has been waiting to be stopped.",
+            value=curtime - expired[0][1] if len(expired) > 0 else 0,
+        )
+
+
+_instances = CollectorRegistry(auto_describe=True)
+_instances.register(InstanceCollector())
+
+
+def render() -> bytes:
+    """Render the metrics of every process serving the API in the text format."""
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)  # type: ignore[no-untyped-call]
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_instances)
+
+
+def instrument(app: Flask) -> None:
+    """Time every request to the app and serve the metrics at /metrics.
+
+    /metrics is on the public port and lists every challenge with its instance counts, so
+    it's only served when scrapes have to authenticate with the metrics token."""
+
+    if not config.metrics_enabled:
+        return
+
+    @app.before_request
+    def start_timer() -> None:
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def record_duration(response: Response) -> Response:
+        if "request_start" in g:
+            # the URL rule keeps IDs in paths from becoming labels
+            endpoint = (
+                "unmatched" if request.url_rule is None else request.url_rule.rule
+            )
+            request_duration.labels(
+                endpoint, request.method, str(response.status_code)
+            ).observe(perf_counter() - g.request_start)
+        return response
+
+    token = config.metrics_token
+    if token is None:
+        print("[*] metrics.token isn't set, so /metrics isn't served", flush=True)
+        return
+
+    @app.route("/metrics")
+    def metrics() -> Response:
+        if (
+            request.authorization is None
+            or request.authorization.token is None
+            or not compare_digest(request.authorization.token, token)
+        ):
+            return Response("unauthorized\n", status=401, mimetype="text/plain")
+        return Response(render(), content_type=CONTENT_TYPE_LATEST)
+
+
+def serve_worker_metrics() -> None:
+    """Serve the metrics of the worker on `metrics_worker_port` in the background."""
+
+    if config.metrics_enabled and config.metrics_worker_port > 0:
+        start_http_server(config.metrics_worker_port)
@@ -0,0 +1,101 @@
+from collections.abc import Callable
+from time import time
+
+from instancer.backend import Challenge
+from instancer.capacity import RESOURCES, capacity_status, reservations
+from instancer.config import config, rclient
+
+
+def _oldest_boot() -> list[str]:
+    return [ns.decode() for ns in rclient.zrange("boot_time", 0, -1)]
+
+
+def _furthest_from_expiry() -> list[str]:
+    return [ns.decode() for ns in rclient.zrange("expiration", 0, -1, desc=True)]
+
+
+def _least_recently_renewed() -> list[str]:
+    return [ns.decode() for ns in rclient.zrange("renew_time", 0, -1)]
+
+
+EVICTION_POLICIES: dict[str, Callable[[], list[str]]] = {
+    "oldest_boot": _oldest_boot,
+    "furthest_from_expiry": _furthest_from_expiry,
+    "least_recently_renewed": _least_recently_renewed,
+}
+"""Eviction policies by name. Each returns the namespaces of the running instances,
+best victim first."""
+
+
+def preemptible_instances(namespaces: list[str]) -> list[str]:
+    """Filter namespaces down to the instances that may be preempted, keeping their order.
+
+    Instances younger than the configured minimum age are never preempted. Per-team
+    instances can be preempted unless their challenge sets `preemptible: false`, and
+    shared instances only if their challenge sets `preemptible: true`."""
+
+    pipe = rclient.pipeline(transaction=False)
+    for namespace in namespaces:
+        pipe.zscore("boot_time", namespace)
+        pipe.hget(f"instance:{namespace}", "challenge_id")
+    results = pipe.execute()
+    oldest_boot = time() - config.preemption_min_age
+    allowed: dict[str, bool] = {}
+    preemptible = []
+    for i, namespace in enumerate(namespaces):
+        boot_time, chall_id = results[2 * i], results[2 * i + 1]
+        if boot_time is None or boot_time > oldest_boot or chall_id is None:
+            continue
+        chall_id = chall_id.decode()
+        if chall_id not in allowed:
+            info = Challenge.fetch_info(chall_id)
+            allowed[chall_id] = info is not None and bool(
+                info.cfg.get("preemptible", info.per_team)
+            )
+        if allowed[chall_id]:
+            preemptible.append(namespace)
+    return preemptible
+
+
+def preempt(requests: dict[str, int]) -> list[str]:
+    """Stop instances chosen by the configured eviction policy until an instance with
+    the given resource requests fits in the cluster.
+
+    The teams of the stopped instances get a terminated event with reason preempted.
+    Their capacity is only released once their pods are gone, so capacity that is still
+    draining from earlier stops counts as free here. Nothing is stopped if the instance
+    already fits or if stopping every preemptible instance wouldn't make room for it.
+    Returns the stopped namespaces."""
+
+    available = capacity_status()["resources"]
+    needed = {
+        name: requests.get(name, 0)
+        - available[name]["available"]
+        - available[name]["draining"]
+        for name in RESOURCES
+        if available[name]["available"] is not None
+    }
+    needed = {name: amount for name, amount in needed.items() if amount > 0}
+    if len(needed) == 0:
+        return []
+
+    candidates = preemptible_instances(EVICTION_POLICIES[config.preemption_policy]())
+    reserved = reservations(candidates)
+    victims = []
+    for namespace in candidates:
+        if namespace not in reserved:
+            continue
+        victims.append(namespace)
+        for name in needed:
+            needed[name] -= reserved[namespace].get(name, 0)
+        if all(amount <= 0 for amount in needed.values()):
+            break
+    else:
+        return []
+
+    print(
+        f"[*] Preempting {len(victims)} instances with policy {config.preemption_policy}...",
+        flush=True,
+    )
+    Challenge.stop_namespaces(victims, "preempt", reason="preempted")
+    return victims
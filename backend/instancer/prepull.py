@@ -0,0 +1,204 @@
+from hashlib import sha256
+from typing import Any
+
+from kubernetes.client.exceptions import ApiException
+
+# For some reason mypy says kclient isn't explicitly exported even though it is
+from instancer.backend import kapi, kclient  # type: ignore[attr-defined]
+from instancer.config import config, connect_pg
+
+DAEMONSET_NAME = "instancer-prepull"
+"Name of the DaemonSet that pulls challenge images onto every node."
+_labels = {"app.kubernetes.io/name": DAEMONSET_NAME}
+_images_annotation = "instancer.acmcyber.com/prepull-images"
+_pull_errors = {"ErrImagePull", "ImagePullBackOff", "InvalidImageName"}
+# keeps the pre-pull pods from taking capacity away from challenges
+_resources = kclient.V1ResourceRequirements(
+    requests={"cpu": "1m", "memory": "8Mi"}, limits={"cpu": "50m", "memory": "32Mi"}
+)
+
+
+def challenge_images() -> list[str]:
+    """Return the sorted images used by the containers of every challenge."""
+
+    images = set()
+    with connect_pg() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT cfg FROM challenges")
+            for (cfg,) in cur.fetchall():
+                for container in cfg.get("containers", {}).values():
+                    if "image" in container:
+                        images.add(container["image"])
+    return sorted(images)
+
+
+def _daemonset(images: list[str], digest: str) -> kclient.V1DaemonSet:
+    """Build the pre-pull DaemonSet.
+
+    The helper init container copies a static busybox into a shared volume, then every
+    image gets an init container that runs `busybox true` from that volume, so the
+    image is pulled and started even if it has no shell. A pause container keeps the
+    pod around afterwards so the DaemonSet doesn't restart it."""
+
+    mount = kclient.V1VolumeMount(name="prepull", mount_path="/prepull")
+    return kclient.V1DaemonSet(
+        metadata=kclient.V1ObjectMeta(
+            name=DAEMONSET_NAME,
+            labels=_labels,
+            annotations={_images_annotation: digest},
+        ),
+        spec=kclient.V1DaemonSetSpec(
+            selector=kclient.V1LabelSelector(match_labels=_labels),
+            template=kclient.V1PodTemplateSpec(
+                metadata=kclient.V1ObjectMeta(labels=_labels),
+                spec=kclient.V1PodSpec(
+                    enable_service_links=False,
+                    automount_service_account_token=False,
+                    termination_grace_period_seconds=0,
+                    volumes=[
+                        kclient.V1Volume(
+                            name="prepull", empty_dir=kclient.V1EmptyDirVolumeSource()
+                        )
+                    ],
+                    init_containers=[
+                        kclient.V1Container(
+                            name="helper",
+                            image=config.prepull_helper_image,
+                            command=["cp", "/bin/busybox", "/prepull/busybox"],
+                            volume_mounts=[mount],
+                            resources=_resources,
+                        ),
+                        *(
+                            kclient.V1Container(
+                                name=f"image-{i}",
+                                image=image,
+                                image_pull_policy="IfNotPresent",
+                                command=["/prepull/busybox", "true"],
+                                volume_mounts=[mount],
+                                resources=_resources,
+                            )
+                            for i, image in enumerate(images)
+                        ),
+                    ],
+                    containers=[
+                        kclient.V1Container(
+                            name="pause",
+                            image=config.prepull_pause_image,
+                            resources=_resources,
+                        )
+                    ],
+                ),
+            ),
+        ),
+    )
+
+
+def sync_prepull() -> None:
+    """Make the pre-pull DaemonSet pull exactly the images used by the challenges.
+
+    The DaemonSet is only replaced when the set of images changed, and deleted when no
+    challenge has an image."""
+
+    api = kclient.AppsV1Api(kapi)
+    images = challenge_images()
+    digest = sha256("\n".join(images).encode()).hexdigest()[:32]
+    try:
+        current = api.read_namespaced_daemon_set(
+            DAEMONSET_NAME, config.prepull_namespace
+        )
+    except ApiException as e:
+        if e.status != 404:
+            raise e
+        current = None
+
+    if len(images) == 0:
+        if current is not None:
+            print("[*] Deleting image pre-pull DaemonSet...", flush=True)
+            api.delete_namespaced_daemon_set(DAEMONSET_NAME, config.prepull_namespace)
+        return
+    if current is None:
+        print(f"[*] Creating image pre-pull DaemonSet for {len(images)} images...")
+        api.create_namespaced_daemon_set(
+            config.prepull_namespace, _daemonset(images, digest)
+        )
+    elif (current.metadata.annotations or {}).get(_images_annotation) != digest:
+        print(f"[*] Updating image pre-pull DaemonSet to {len(images)} images...")
+        api.replace_namespaced_daemon_set(
+            DAEMONSET_NAME, config.prepull_namespace, _daemonset(images, digest)
+        )
+
+
+def _node_progress(pod: kclient.V1Pod) -> dict[str, Any]:
+    """Return the images pulled, being pulled and failing to pull on a pre-pull pod's node."""
+
+    images = {
+        container.name: container.image
+        for container in pod.spec.init_containers or []
+        if container.name != "helper"
+    }
+    statuses = {
+        status.name: status for status in pod.status.init_container_statuses or []
+    }
+    pulled = []
+    pending = []
+    errors = {}
+    for name, image in images.items():
+        status = statuses.get(name)
+        # an init container that started or finished has its image on the node
+        if pod.status.phase == "Running" or (
+            status is not None
+            and (
+                status.state.running is not None or status.state.terminated is not None
+            )
+        ):
+            pulled.append(image)
+        elif (
+            status is not None
+            and status.state.waiting is not None
+            and status.state.waiting.reason in _pull_errors
+        ):
+            errors[image] = status.state.waiting.message or status.state.waiting.reason
+        else:
+            pending.append(image)
+    return {
+        "node": pod.spec.node_name,
+        "pulled": pulled,
+        "pending": pending,
+        "errors": errors,
+    }
+
+
+def prepull_status() -> dict[str, Any]:
+    """Return the pre-pull progress of the DaemonSet and of each node."""
+
+    api = kclient.AppsV1Api(kapi)
+    capi = kclient.CoreV1Api(kapi)
+    try:
+        daemonset = api.read_namespaced_daemon_set(
+            DAEMONSET_NAME, config.prepull_namespace
+        )
+    except ApiException as e:
+        if e.status != 404:
+            raise e
+        return {"enabled": config.prepull_enabled, "deployed": False}
+    pods = capi.list_namespaced_pod(
+        config.prepull_namespace,
+        label_selector=",".join(f"{k}={v}" for k, v in _labels.items()),
+    ).items
+    status = daemonset.status
+    return {
+        "enabled": config.prepull_enabled,
+        "deployed": True,
+        "images": [
+            container.image
+            for container in daemonset.spec.template.spec.init_containers
+            if container.name != "helper"
+        ],
+        "nodes_desired": status.desired_number_scheduled,
+        "nodes_updated": status.updated_number_scheduled or 0,
+        "nodes_done": status.number_ready,
+        "nodes": sorted(
+            (_node_progress(pod) for pod in pods if pod.spec.node_name is not None),
+            key=lambda node: node["node"],
+        ),
+    }
@@ -0,0 +1,215 @@
+"""On-demand sampling profiler for the API worker processes.
+
+Every worker process keeps a thread subscribed to a Redis channel, which costs nothing
+until an admin starts a profile. Each worker then samples the stacks of its threads for
+the requested window, counts them in memory and adds its counts to the profile in Redis
+when the window ends. Profiles are read back as collapsed stacks, the input format of
+flamegraph.pl, speedscope and most other flame graph tools."""
+
+import json
+import os
+import sys
+from collections import Counter
+from functools import lru_cache
+from random import randbytes
+from threading import Lock, Thread, get_ident
+from time import monotonic, sleep, time
+from types import CodeType, FrameType
+from typing import Any
+
+from redis.exceptions import RedisError
+
+from instancer.config import config, rclient
+
+CHANNEL = "profile"
+"Redis channel profiles are announced on."
+MIN_INTERVAL = 5
+"Smallest number of milliseconds allowed between samples."
+MAX_DEPTH = 128
+"Number of innermost frames kept of deeper stacks."
+REPORT_GRACE = 5
+"Seconds after the end of a profile that workers are given to report their samples."
+TRUNCATED = "[truncated]"
+"Stack that samples are counted under once a worker has seen too many distinct stacks."
+
+_listening: int | None = None
+"PID of the process the listener thread was started in."
+_listening_lock = Lock()
+
+
+class ProfileRunningError(Exception):
+    """Exception thrown when a profile is started while another one is running."""
+
+    pass
+
+
+@lru_cache(maxsize=4096)
+def _frame_name(code: CodeType) -> str:
+    filename = code.co_filename
+    # show paths relative to the import path they were found on, like module names
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(path + os.sep):
+            filename = filename[len(path) + 1 :]
+            break
+    # semicolons separate frames in collapsed stacks
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+def _collapse(frame: FrameType | None) -> str:
+    names: list[str] = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    if frame is not None:
+        names.append(TRUNCATED)
+    return ";".join(reversed(names))
+
+
+def _take_sample(stacks: Counter[str]) -> None:
+    """Count the stack of every thread in this process except the calling one."""
+
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id == get_ident():
+            continue
+        stack = _collapse(frame)
+        if stack not in stacks and len(stacks) >= config.profiling_max_stacks:
+            stack = TRUNCATED
+        stacks[stack] += 1
+
+
+def _sample(profile_id: str, ends: float, interval: float) -> None:
+    """Sample this process every `interval` seconds until `ends`, then add the counts to
+    the profile."""
+
+    stacks: Counter[str] = Counter()
+    samples = 0
+    deadline = monotonic() + ends - time()
+    while monotonic() < deadline:
+        _take_sample(stacks)
+        samples += 1
+        sleep(interval)
+
+    key = f"profile:{profile_id}"
+    pipe = rclient.pipeline()
+    for stack, count in stacks.items():
+        pipe.hincrby(f"{key}:stacks", stack, count)
+    pipe.hincrby(key, "workers", 1)
+    pipe.hincrby(key, "samples", samples)
+    pipe.expire(f"{key}:stacks", config.profiling_retention)
+    pipe.expire(key, config.profiling_retention)
+    pipe.execute()
+
+
+def _listen() -> None:
+    """Start sampling this process whenever a profile is announced."""
+
+    while True:
+        pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CHANNEL)
+            while True:
+                message = pubsub.get_message(timeout=60)
+                if message is None:
+                    continue
+                profile = json.loads(message["data"])
+                try:
+                    _sample(profile["id"], profile["ends"], profile["interval"] / 1000)
+                except RedisError as e:
+                    print(f"[*] Could not save profile due to error {e}", flush=True)
+        except RedisError as e:
+            print(f"[*] Profile listener error {e}", flush=True)
+            sleep(5)
+        finally:
+            pubsub.close()
+
+
+def listen_for_profiles() -> None:
+    """Make sure this process is listening for profiles.
+
+    Called on every request, so worker processes forked from a process that was already
+    listening start their own listener."""
+
+    global _listening
+    if not config.profiling_enabled or _listening == os.getpid():
+        return
+    with _listening_lock:
+        if _listening != os.getpid():
+            _listening = os.getpid()
+            Thread(target=_listen, daemon=True).start()
+
+
+def start_profile(duration: int, interval: int) -> dict[str, Any]:
+    """Profile every listening worker process for `duration` seconds, sampling every
+    `interval` milliseconds.
+
+    Only one profile runs at a time; raises ProfileRunningError if another one is still
+    running. Returns the profile as returned by profile_info."""
+
+    if not rclient.set("profile:running", 1, nx=True, ex=duration + REPORT_GRACE):
+        raise ProfileRunningError("another profile is still running")
+    profile_id = randbytes(8).hex()
+    started = int(time())
+    key = f"profile:{profile_id}"
+    pipe = rclient.pipeline()
+    pipe.hset(
+        key,
+        mapping={
+            "started": started,
+            "duration": duration,
+            "interval": interval,
+            "workers": 0,
+            "samples": 0,
+        },
+    )
+    pipe.expire(key, config.profiling_retention)
+    pipe.execute()
+    listeners = rclient.publish(
+        CHANNEL,
+        json.dumps({"id": profile_id, "ends": time() + duration, "interval": interval}),
+    )
+    rclient.hset(key, "listeners", listeners)
+    print(f"[*] Profile {profile_id}: sampling {listeners} processes...", flush=True)
+    info = profile_info(profile_id)
+    assert info is not None
+    return info
+
+
+def profile_info(profile_id: str) -> dict[str, Any] | None:
+    """Return how far along a profile is, or None if there is no profile with that ID.
+
+    The profile is done once every process that received it reported its samples, or
+    when the rest are taking too long to. `listeners` is None until the profile was
+    announced, which is when the number of processes that received it is known."""
+
+    profile = {
+        k.decode(): int(v) for k, v in rclient.hgetall(f"profile:{profile_id}").items()
+    }
+    if len(profile) == 0:
+        return None
+    ends = profile["started"] + profile["duration"]
+    listeners = profile.get("listeners")
+    done = (
+        listeners is not None and profile["workers"] >= listeners
+    ) or time() > ends + REPORT_GRACE
+    return {
+        "id": profile_id,
+        "state": "done" if done else "running",
+        "started": profile["started"],
+        "ends": ends,
+        "duration": profile["duration"],
+        "interval": profile["interval"],
+        "listeners": listeners,
+        "workers": profile["workers"],
+        "samples": profile["samples"],
+    }
+
+
+def collapsed_stacks(profile_id: str) -> str:
+    """Return the stacks sampled by a profile in the collapsed format, one stack of
+    semicolon-separated frames from the outermost in, followed by its count, per line.
+    """
+
+    stacks = rclient.hgetall(f"profile:{profile_id}:stacks")
+    return "".join(
+        f"{stack.decode()} {int(count)}\n" for stack, count in sorted(stacks.items())
+    )
@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from random import randbytes
+from typing import Iterator
+
+from instancer.config import config, rclient
+from instancer.tracing import span
+
+
+class RateLimitException(Exception):
+    """Exception thrown when an action is denied by a rate limit."""
+
+    retry_after: int
+    "Number of seconds the client should wait before retrying."
+
+    def __init__(self, msg: str, retry_after: int):
+        super().__init__(msg)
+        self.retry_after = max(1, retry_after)
+
+
+# Token bucket over any number of buckets, checked and consumed atomically.
+# KEYS: the bucket keys
+# ARGV: capacity and refill rate (tokens per second) for each key, in order
+# Returns 0 if a token was taken from every bucket, otherwise the number of
+# milliseconds until every bucket has a token available.
+_token_bucket = rclient.register_script(
+    """
+local t = redis.call("TIME")
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i]) / 1000
+    local state = redis.call("HMGET", key, "tokens", "ts")
+    local cur = tonumber(state[1])
+    local ts = tonumber(state[2])
+    if cur == nil or ts == nil then
+        cur = capacity
+    else
+        cur = math.min(capacity, cur + math.max(0, now - ts) * rate)
+    end
+    tokens[i] = cur
+    if cur < 1 then
+        wait = math.max(wait, math.ceil((1 - cur) / rate))
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i]) / 1000
+    redis.call("HSET", key, "tokens", tostring(tokens[i] - 1), "ts", now)
+    redis.call("PEXPIRE", key, math.ceil(capacity / rate))
+end
+return 0
+"""
+)
+
+# Counting semaphore stored as a sorted set of holder -> lease expiry.
+# KEYS[1]: the semaphore key
+# ARGV: holder, limit, lease time in milliseconds
+# Returns 0 if a slot was acquired, otherwise the number of milliseconds until
+# the oldest lease runs out.
+_semaphore_acquire = rclient.register_script(
+    """
+local t = redis.call("TIME")
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+if redis.call("ZCARD", KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call("ZADD", KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+    redis.call("PEXPIRE", KEYS[1], tonumber(ARGV[3]))
+    return 0
+end
+local oldest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+return math.max(1, tonumber(oldest[2]) - now)
+"""
+)
+
+
+def check_deploy_rate(team_id: str, chall_id: str) -> None:
+    """Take a deploy token from the team's bucket and the team's bucket for the challenge.
+
+    Buckets are never shared between teams, so one team deploying a challenge over and
+    over can't keep other teams from deploying it. Raises RateLimitException if either
+    bucket is empty. A bucket with a burst size or rate of 0 is not limited."""
+
+    keys: list[str] = []
+    args: list[float] = []
+    for key, burst, rate in [
+        (
+            f"ratelimit:deploy:team:{team_id}",
+            config.team_deploy_burst,
+            config.team_deploy_per_minute,
+        ),
+        (
+            f"ratelimit:deploy:chall:{chall_id}:team:{team_id}",
+            config.challenge_deploy_burst,
+            config.challenge_deploy_per_minute,
+        ),
+    ]:
+        if burst > 0 and rate > 0:
+            keys.append(key)
+            args.extend((burst, rate / 60))
+    if len(keys) == 0:
+        return
+    with span("redis.check_deploy_rate"):
+        wait = int(_token_bucket(keys=keys, args=args))
+    if wait > 0:
+        raise RateLimitException("deploy rate limit exceeded", -(-wait // 1000))
+
+
+@contextmanager
+def start_slot() -> Iterator[None]:
+    """Hold one of the global concurrent challenge start slots.
+
+    Raises RateLimitException if all slots are in use. A limit of 0 disables the cap."""
+
+    if config.max_concurrent_starts <= 0:
+        yield
+        return
+    holder = randbytes(8).hex()
+    with span("redis.start_slot"):
+        wait = int(
+            _semaphore_acquire(
+                keys=["semaphore:start"],
+                args=[
+                    holder,
+                    config.max_concurrent_starts,
+                    config.start_slot_lease * 1000,
+                ],
+            )
+        )
+    if wait > 0:
+        raise RateLimitException("too many concurrent deploys", min(wait // 1000, 5))
+    try:
+        yield
+    finally:
+        rclient.zrem("semaphore:start", holder)
@@ -0,0 +1,179 @@
+import re
+from random import randbytes
+from time import time
+from typing import Any
+
+from kubernetes import client as kclient
+
+from instancer.backend import STOP_CONCURRENCY, Challenge, kapi
+from instancer.config import rclient
+
+JOB_RETENTION = 86400
+"Number of seconds a bulk stop is kept after it was queued and after it finished."
+
+_label_value = re.compile(r"[A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?")
+
+
+class InvalidSelectorError(Exception):
+    """Exception thrown when a bulk stop target can't be used in a label selector."""
+
+    pass
+
+
+def find_instances(chall_id: str | None, team_id: str | None) -> list[str]:
+    """Return the namespaces of running challenge instances, optionally limited to a
+    challenge, a team or both.
+
+    Instances are found with a label selector on the namespaces and on the deployments of
+    label-scoped instances, so only two requests are made to Kubernetes. Instances that
+    are already terminating are skipped."""
+
+    selector = ["instancer.acmcyber.com/instance-id"]
+    if chall_id is not None:
+        if not _label_value.fullmatch(chall_id):
+            raise InvalidSelectorError(f"invalid challenge ID {chall_id!r}")
+        selector = [f"instancer.acmcyber.com/instance-id={chall_id}"]
+    if team_id is not None:
+        if not _label_value.fullmatch(team_id):
+            raise InvalidSelectorError(f"invalid team ID {team_id!r}")
+        selector.append(f"instancer.acmcyber.com/team-id={team_id}")
+    capi = kclient.CoreV1Api(kapi)
+    api = kclient.AppsV1Api(kapi)
+    namespaces = [
+        ns.metadata.name
+        for ns in capi.list_namespace(label_selector=",".join(selector)).items
+        if ns.status is None or ns.status.phase != "Terminating"
+    ]
+    deployments = api.list_deployment_for_all_namespaces(
+        label_selector=",".join([*selector, "instancer.acmcyber.com/instance-key"])
+    ).items
+    namespaces.extend(
+        dict.fromkeys(
+            dep.metadata.labels["instancer.acmcyber.com/instance-key"]
+            for dep in deployments
+            if dep.metadata.deletion_timestamp is None
+        )
+    )
+    return namespaces
+
+
+def start_bulk_stop(chall_id: str | None, team_id: str | None) -> str:
+    """Queue a job stopping every instance of a challenge, a team or both.
+
+    The worker runs the job, so it outlives the API process that queued it. Returns the
+    ID of the job, which can be passed to bulk_stop_progress and cancel_bulk_stop.
+    """
+
+    namespaces = find_instances(chall_id, team_id)
+    job_id = randbytes(8).hex()
+    key = f"bulk_stop:{job_id}"
+    pipe = rclient.pipeline()
+    pipe.hset(
+        key,
+        mapping={
+            "state": "queued",
+            "challenge_id": chall_id or "",
+            "team_id": team_id or "",
+            "started": int(time()),
+            "total": len(namespaces),
+            "stopped": 0,
+            "failed": 0,
+        },
+    )
+    pipe.expire(key, JOB_RETENTION)
+    if len(namespaces) > 0:
+        pipe.rpush(f"{key}:namespaces", *namespaces)
+        pipe.expire(f"{key}:namespaces", JOB_RETENTION)
+    pipe.rpush("bulk_stop:jobs", job_id)
+    pipe.publish("bulk_stop:queued", job_id)
+    pipe.execute()
+    print(f"[*] Bulk stop {job_id}: queued {len(namespaces)} instances...")
+    return job_id
+
+
+def next_bulk_stop() -> str | None:
+    """Return the ID of the oldest unfinished bulk stop, or None if there is none.
+
+    A job stays first in line until run_bulk_stop finishes it, so a job left unfinished
+    by a worker that died is resumed by the next one."""
+
+    job_id = rclient.lindex("bulk_stop:jobs", 0)
+    return None if job_id is None else job_id.decode()
+
+
+def run_bulk_stop(job_id: str) -> None:
+    """Stop the namespaces left in a bulk stop in batches, recording progress and
+    checking for cancellation between batches.
+
+    Only one process may run a job at a time, so the worker runs jobs while holding the
+    bulk_stop lock. The namespaces of a batch are only taken off the job once they were
+    stopped, so a batch interrupted by a crash is stopped again when the job resumes."""
+
+    key = f"bulk_stop:{job_id}"
+    remaining = f"{key}:namespaces"
+    # the job expires if no worker ran it for its whole retention
+    if not rclient.exists(key):
+        print(f"[*] Bulk stop {job_id} expired before it was run", flush=True)
+        pipe = rclient.pipeline()
+        pipe.delete(remaining)
+        pipe.lrem("bulk_stop:jobs", 0, job_id)
+        pipe.execute()
+        return
+    rclient.hset(key, "state", "running")
+    state = "done"
+    try:
+        while len(batch := rclient.lrange(remaining, 0, STOP_CONCURRENCY - 1)) > 0:
+            if rclient.hget(key, "cancel") is not None:
+                state = "cancelled"
+                break
+            failed = Challenge.stop_namespaces([ns.decode() for ns in batch])
+            pipe = rclient.pipeline()
+            pipe.hincrby(key, "stopped", len(batch) - failed)
+            pipe.hincrby(key, "failed", failed)
+            pipe.ltrim(remaining, len(batch), -1)
+            pipe.execute()
+    except Exception as e:
+        print(f"[*] Bulk stop {job_id} failed due to error {e}", flush=True)
+        state = "failed"
+    pipe = rclient.pipeline()
+    pipe.hset(key, mapping={"state": state, "finished": int(time())})
+    pipe.expire(key, JOB_RETENTION)
+    pipe.delete(remaining)
+    pipe.lrem("bulk_stop:jobs", 0, job_id)
+    pipe.execute()
+    print(f"[*] Bulk stop {job_id}: {state}", flush=True)
+
+
+def bulk_stop_progress(job_id: str) -> dict[str, Any] | None:
+    """Return the progress of a bulk stop, or None if there is no job with that ID."""
+
+    job = {
+        k.decode(): v.decode()
+        for k, v in rclient.hgetall(f"bulk_stop:{job_id}").items()
+    }
+    if len(job) == 0:
+        return None
+    return {
+        "id": job_id,
+        "state": job["state"],
+        "challenge_id": job["challenge_id"] or None,
+        "team_id": job["team_id"] or None,
+        "started": int(job["started"]),
+        "finished": int(job["finished"]) if "finished" in job else None,
+        "total": int(job["total"]),
+        "stopped": int(job["stopped"]),
+        "failed": int(job["failed"]),
+        "cancel_requested": "cancel" in job,
+    }
+
+
+def cancel_bulk_stop(job_id: str) -> bool:
+    """Ask a queued or running bulk stop to stop before its next batch.
+
+    Returns False if there is no queued or running job with that ID."""
+
+    key = f"bulk_stop:{job_id}"
+    if rclient.hget(key, "state") not in (b"queued", b"running"):
+        return False
+    rclient.hset(key, "cancel", 1)
+    return True
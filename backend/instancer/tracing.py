@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import asdict, dataclass, field
+from random import randbytes
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Callable, Iterator, TypeVar
+
+from instancer.config import config, rclient
+
+T = TypeVar("T")
+
+
+@dataclass
+class Span:
+    """A timed stage of a traced operation."""
+
+    name: str
+    "What the stage does, such as kube.create_namespace."
+    trace_id: str
+    "The ID of the trace the span belongs to."
+    span_id: str
+    "The ID of the span."
+    parent_id: str | None
+    "The ID of the enclosing span, or None for the root span of the trace."
+    start: float
+    "The time the span started."
+    duration: float = 0
+    "The number of seconds the span took."
+    attributes: dict[str, Any] = field(default_factory=dict)
+    "Details about the span, such as the namespace it acted on."
+    error: str | None = None
+    "The exception that ended the span, or None if it finished normally."
+
+
+@dataclass
+class _Trace:
+    spans: list[Span] = field(default_factory=list)
+    # spans can end in other threads, such as concurrent namespace deletions
+    lock: Lock = field(default_factory=Lock)
+
+
+_current: ContextVar[tuple[_Trace, Span] | None] = ContextVar(
+    "current_span", default=None
+)
+
+
+class Exporter:
+    """Sends finished traces somewhere. Subclasses override export."""
+
+    def export(self, spans: list[Span]) -> None:
+        pass
+
+
+class LogExporter(Exporter):
+    """Prints each trace as one line per span, indented under its parent."""
+
+    def export(self, spans: list[Span]) -> None:
+        depth: dict[str | None, int] = {None: -1}
+        for stage in sorted(spans, key=lambda stage: stage.start):
+            depth[stage.span_id] = depth.get(stage.parent_id, 0) + 1
+            attributes = " ".join(f"{k}={v}" for k, v in stage.attributes.items())
+            print(
+                f"[*] Trace {stage.trace_id[:8]} {'  ' * depth[stage.span_id]}{stage.name} "
+                f"{stage.duration * 1000:.1f}ms {attributes}"
+                + (f" error={stage.error}" if stage.error is not None else ""),
+                flush=True,
+            )
+
+
+class OtlpFileExporter(Exporter):
+    """Appends each trace to a file as an OTLP/JSON ExportTraceServiceRequest per line,
+    which the OpenTelemetry Collector's file receiver and most trace viewers can read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+
+    def export(self, spans: list[Span]) -> None:
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "cyber-instancer"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "instancer"},
+                            "spans": [_otlp_span(stage) for stage in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(request) + "\n")
+
+
+def _otlp_span(stage: Span) -> dict[str, Any]:
+    start = int(stage.start * 1e9)
+    return {
+        "traceId": stage.trace_id,
+        "spanId": stage.span_id,
+        **({"parentSpanId": stage.parent_id} if stage.parent_id is not None else {}),
+        "name": stage.name,
+        "kind": 1,
+        "startTimeUnixNano": str(start),
+        "endTimeUnixNano": str(start + int(stage.duration * 1e9)),
+        "attributes": [
+            {"key": k, "value": {"stringValue": str(v)}}
+            for k, v in stage.attributes.items()
+        ],
+        "status": (
+            {"code": 1} if stage.error is None else {"code": 2, "message": stage.error}
+        ),
+    }
+
+
+class MemoryExporter(Exporter):
+    """Keeps finished traces in a list, for tests."""
+
+    def __init__(self) -> None:
+        self.traces: list[list[Span]] = []
+
+    def export(self, spans: list[Span]) -> None:
+        self.traces.append(spans)
+
+
+EXPORTERS: dict[str, Callable[[], Exporter]] = {
+    "none": Exporter,
+    "log": LogExporter,
+    "otlp_file": lambda: OtlpFileExporter(config.tracing_file),
+    "memory": MemoryExporter,
+}
+"Trace exporters by name."
+
+exporter = EXPORTERS[config.tracing_exporter]()
+"The exporter finished traces are sent to."
+
+
+def set_exporter(new_exporter: Exporter) -> None:
+    """Replace the exporter finished traces are sent to."""
+
+    global exporter
+    exporter = new_exporter
+
+
+@contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[None]:
+    """Time an operation, starting a new trace unless one is already active.
+
+    When the root span of a trace ends, the trace is sent to the exporter and saved for
+    the admin API. Does nothing if tracing is disabled."""
+
+    if not config.tracing_enabled:
+        yield
+        return
+    if _current.get() is None:
+        new_trace = _Trace()
+        try:
+            with _span(new_trace, None, name, attributes):
+                yield
+        finally:
+            _finish(new_trace)
+    else:
+        with span(name, **attributes):
+            yield
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    """Time a stage of the current trace. Does nothing outside of a trace."""
+
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    with _span(current[0], current[1], name, attributes):
+        yield
+
+
+@contextmanager
+def _span(
+    cur_trace: _Trace, parent: Span | None, name: str, attributes: dict[str, Any]
+) -> Iterator[None]:
+    new_span = Span(
+        name=name,
+        trace_id=randbytes(16).hex() if parent is None else parent.trace_id,
+        span_id=randbytes(8).hex(),
+        parent_id=None if parent is None else parent.span_id,
+        start=time(),
+        attributes=attributes,
+    )
+    token = _current.set((cur_trace, new_span))
+    started = perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        new_span.duration = perf_counter() - started
+        _current.reset(token)
+        with cur_trace.lock:
+            cur_trace.spans.append(new_span)
+
+
+def _finish(cur_trace: _Trace) -> None:
+    """Export a finished trace and save it for the admin API."""
+
+    try:
+        exporter.export(cur_trace.spans)
+    except Exception as e:
+        print(f"[*] Could not export trace due to error {e}", flush=True)
+    pipe = rclient.pipeline(transaction=False)
+    pipe.lpush(
+        "traces",
+        json.dumps([asdict(stage) for stage in cur_trace.spans], default=str),
+    )
+    pipe.ltrim("traces", 0, config.tracing_retention - 1)
+    pipe.execute()
+
+
+def propagate(func: Callable[..., T]) -> Callable[..., T]:
+    """Wrap a function so it runs in the current trace even in another thread, such as
+    one of a ThreadPoolExecutor."""
+
+    context = copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def recent_traces(name: str | None = None, limit: int = 50) -> list[dict[str, Any]]:
+    """Return the most recent saved traces, newest first, optionally only those whose
+    root span has the given name.
+
+    Each trace has the name, attributes, start and duration of its root span and the
+    time spent in each stage."""
+
+    traces = []
+    for saved in rclient.lrange("traces", 0, -1):
+        spans = json.loads(saved)
+        root = next(span for span in spans if span["parent_id"] is None)
+        if name is not None and root["name"] != name:
+            continue
+        traces.append(
+            {
+                "trace_id": root["trace_id"],
+                "name": root["name"],
+                "attributes": root["attributes"],
+                "start": root["start"],
+                "duration": root["duration"],
+                "error": root["error"],
+                "spans": sorted(spans, key=lambda span: span["start"]),
+            }
+        )
+        if len(traces) >= limit:
+            break
+    return traces
+
+
+def stage_breakdown(name: str | None = None, limit: int = 50) -> dict[str, Any]:
+    """Return the count and the mean and maximum seconds of each stage across the
+    most recent traces."""
+
+    stages: dict[str, list[float]] = {}
+    for saved_trace in recent_traces(name, limit):
+        for saved_span in saved_trace["spans"]:
+            stages.setdefault(saved_span["name"], []).append(saved_span["duration"])
+    return {
+        stage: {
+            "count": len(durations),
+            "mean": sum(durations) / len(durations),
+            "max": max(durations),
+        }
+        for stage, durations in sorted(stages.items())
+    }
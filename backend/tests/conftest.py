@@ -0,0 +1,35 @@
+"""Shared test setup.
+
+The instancer modules connect to Redis and run migrations when they are imported, so the
+Redis client is swapped for an in-memory fakeredis server before any of them are. The
+fake server runs Lua, so the scripts are tested as Redis runs them."""
+
+import os
+from typing import Iterator
+
+import fakeredis
+import pytest
+import redis
+
+server = fakeredis.FakeServer()
+setattr(redis, "Redis", lambda *args, **kwargs: fakeredis.FakeRedis(server=server))
+
+# the migrations need Postgres, so mark them as done
+_rclient = fakeredis.FakeRedis(server=server)
+_rclient.set("migration:db_boot_time", "done")
+_rclient.set("migration:instance_events", "done")
+
+os.environ.setdefault(
+    "INSTANCER_LOGIN_SECRET_KEY", "+jRCqBlpa4Mqo558EVWfioZAIfiFEHgQvN6BxD7qBgQ="
+)
+os.environ.setdefault("INSTANCER_ADMIN_TEAM_ID", "4b45bb80-9a8b-47ca-ad0d-a995b1ffe6d6")
+
+from instancer.config import rclient  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clean_redis() -> Iterator[None]:
+    """Start every test with an empty Redis."""
+
+    rclient.flushall()
+    yield
@@ -0,0 +1,178 @@
+import pytest
+
+from instancer.capacity import (
+    RESERVATION_GRACE,
+    CapacityExceededError,
+    capacity_status,
+    drain,
+    draining,
+    reconcile,
+    release,
+    release_drained,
+    reservations,
+    reserve,
+    resource_amounts,
+    set_total,
+)
+from instancer.config import config, rclient
+
+
+@pytest.fixture(autouse=True)
+def total(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "capacity_enabled", True)
+    monkeypatch.setattr(config, "capacity_max_utilization", 0.5)
+    set_total({"cpu": 4000, "memory": 4096})
+
+
+def used() -> dict[str, int]:
+    return {k.decode(): int(v) for k, v in rclient.hgetall("capacity:used").items()}
+
+
+def test_resource_amounts() -> None:
+    assert resource_amounts({"cpu": "250m", "memory": "1Ki", "gpu": "1"}) == {
+        "cpu": 250,
+        "memory": 1024,
+    }
+
+
+def test_reserve_up_to_usable_capacity() -> None:
+    reserve("a", {"cpu": 1000, "memory": 1024})
+    reserve("b", {"cpu": 1000, "memory": 1024})
+    assert used() == {"cpu": 2000, "memory": 2048}
+    with pytest.raises(CapacityExceededError) as e:
+        reserve("c", {"cpu": 1, "memory": 0})
+    assert e.value.resource == "cpu"
+    assert reservations(["a", "c"]) == {"a": {"cpu": 1000, "memory": 1024}}
+
+
+def test_denied_reservation_reserves_nothing() -> None:
+    reserve("a", {"cpu": 0, "memory": 2000})
+    with pytest.raises(CapacityExceededError) as e:
+        reserve("b", {"cpu": 1000, "memory": 100})
+    assert e.value.resource == "memory"
+    assert used() == {"cpu": 0, "memory": 2000}
+
+
+def test_reserve_twice_counts_once() -> None:
+    reserve("a", {"cpu": 1000, "memory": 1024})
+    reserve("a", {"cpu": 1000, "memory": 1024})
+    assert used() == {"cpu": 1000, "memory": 1024}
+
+
+def test_unknown_total_isnt_limited() -> None:
+    set_total({"cpu": 4000})
+    reserve("a", {"cpu": 0, "memory": 1 << 40})
+
+
+def test_queued_deploys_go_first() -> None:
+    rclient.hset("deploy_queue:pending", "queued", "1")
+    with pytest.raises(CapacityExceededError) as e:
+        reserve("a", {"cpu": 1, "memory": 1})
+    assert e.value.resource == "queue"
+    reserve("a", {"cpu": 1, "memory": 1}, skip_queue=True)
+
+
+def test_release() -> None:
+    reserve("a", {"cpu": 2000, "memory": 2048})
+    release(["a", "unknown"])
+    assert used() == {"cpu": 0, "memory": 0}
+    assert reservations(["a"]) == {}
+    reserve("b", {"cpu": 2000, "memory": 2048})
+
+
+def test_release_notifies_waiters() -> None:
+    pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("capacity:released")
+    try:
+        reserve("a", {"cpu": 1, "memory": 1})
+        release(["a"])
+        # the first message read is the subscription confirmation
+        pubsub.get_message(timeout=1)
+        message = pubsub.get_message(timeout=1)
+        assert message is not None and message["data"] == b"1"
+    finally:
+        pubsub.close()
+
+
+def test_disabled(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "capacity_enabled", False)
+    reserve("a", {"cpu": 1 << 40, "memory": 1 << 40})
+    assert used() == {}
+
+
+def test_reconcile() -> None:
+    reserve("gone", {"cpu": 1000, "memory": 0})
+    reserve("kept", {"cpu": 500, "memory": 0})
+    # the reservation of a namespace that is gone is dropped after the grace period
+    reservation = rclient.hget("capacity:reservations", "gone")
+    assert reservation is not None
+    cpu, memory, time = reservation.split(b",")
+    old = int(time) - RESERVATION_GRACE - 1
+    rclient.hset("capacity:reservations", "gone", b"%s,%s,%d" % (cpu, memory, old))
+    reconcile({"kept": {"cpu": 500}, "new": {"cpu": 200, "memory": 100}})
+    assert reservations(["gone", "kept", "new"]) == {
+        "kept": {"cpu": 500, "memory": 0},
+        "new": {"cpu": 200, "memory": 100},
+    }
+    assert used() == {"cpu": 700, "memory": 100}
+
+
+def test_reconcile_keeps_recent_reservations() -> None:
+    # a namespace that was just reserved may not be listed yet
+    reserve("starting", {"cpu": 1000, "memory": 0})
+    reconcile({})
+    assert used() == {"cpu": 1000, "memory": 0}
+
+
+def test_drained_capacity_stays_used_until_released() -> None:
+    reserve("a", {"cpu": 2000, "memory": 1024})
+    drain(["a"])
+    assert reservations(["a"]) == {}
+    assert draining() == ["a"]
+    assert used() == {"cpu": 2000, "memory": 1024}
+    with pytest.raises(CapacityExceededError):
+        reserve("b", {"cpu": 1, "memory": 0})
+    release_drained(["a"])
+    assert draining() == []
+    assert used() == {"cpu": 0, "memory": 0}
+    reserve("b", {"cpu": 2000, "memory": 0})
+
+
+def test_release_doesnt_touch_draining_capacity() -> None:
+    reserve("a", {"cpu": 1000, "memory": 0})
+    drain(["a"])
+    release(["a"])
+    assert used() == {"cpu": 1000, "memory": 0}
+
+
+def test_redeployed_namespace_drains_both_reservations() -> None:
+    reserve("a", {"cpu": 500, "memory": 100})
+    drain(["a"])
+    reserve("a", {"cpu": 700, "memory": 200})
+    drain(["a"])
+    assert used() == {"cpu": 1200, "memory": 300}
+    assert capacity_status()["resources"]["cpu"]["draining"] == 1200
+    release_drained(["a"])
+    assert used() == {"cpu": 0, "memory": 0}
+
+
+def test_reconcile_counts_draining_capacity() -> None:
+    reserve("a", {"cpu": 1000, "memory": 0})
+    drain(["a"])
+    reconcile({})
+    assert used() == {"cpu": 1000, "memory": 0}
+    assert draining() == ["a"]
+
+
+def test_status() -> None:
+    reserve("a", {"cpu": 1000, "memory": 1024})
+    status = capacity_status()
+    assert status["instances"] == 1
+    assert status["resources"]["cpu"] == {
+        "total": 4000,
+        "usable": 2000,
+        "reserved": 1000,
+        "draining": 0,
+        "available": 1000,
+        "utilization": 0.25,
+    }
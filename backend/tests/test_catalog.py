@@ -0,0 +1,79 @@
+import pytest
+
+from instancer.catalog import (
+    CatalogEntry,
+    CatalogFilter,
+    search_catalog,
+    write_catalog_index,
+)
+from instancer.config import rclient
+
+ENTRIES = [
+    CatalogEntry(id="pwn1", name="Baby Buffer", author="alice", tags=[("pwn", True)]),
+    CatalogEntry(
+        id="web1",
+        name="Cookie Monster",
+        author="bob",
+        tags=[("web", True), ("easy", False)],
+    ),
+    CatalogEntry(
+        id="web2", name="Buffer Cookies", author="Alice", tags=[("web", True)]
+    ),
+]
+
+
+@pytest.fixture(autouse=True)
+def catalog() -> None:
+    write_catalog_index(ENTRIES, 60)
+
+
+def search(query: str) -> list[str]:
+    result = search_catalog(CatalogFilter(query=query))
+    assert result is not None
+    return result.ids
+
+
+def test_unbuilt_index() -> None:
+    rclient.delete("all_challs")
+    assert search_catalog(CatalogFilter()) is None
+
+
+def test_facets_and_tags() -> None:
+    result = search_catalog(CatalogFilter(categories=["web"], exclude_tags=["easy"]))
+    assert result is not None
+    assert result.ids == ["web2"]
+    assert result.categories == ["pwn", "web"]
+    assert result.tags == ["easy"]
+
+
+@pytest.mark.parametrize(
+    "query, ids",
+    [
+        ("b", ["pwn1", "web2", "web1"]),
+        ("ALI", ["pwn1", "web2"]),
+        ("cookie", ["web2", "web1"]),
+        ("buffer cook", ["web2"]),
+        ("monster bob", []),
+        ("zz", []),
+    ],
+)
+def test_query(query: str, ids: list[str]) -> None:
+    assert search(query) == ids
+
+
+def test_query_combined_with_tags() -> None:
+    result = search_catalog(CatalogFilter(categories=["web"], query="buf"))
+    assert result is not None
+    assert result.ids == ["web2"]
+
+
+def test_query_with_every_ngram_but_not_a_substring() -> None:
+    write_catalog_index([CatalogEntry(id="c", name="abcab", author="x", tags=[])], 60)
+    assert search("abcab") == ["c"]
+    assert search("abcabc") == []
+
+
+def test_rewrite_drops_old_ngrams() -> None:
+    write_catalog_index(ENTRIES[1:], 60)
+    assert search("baby") == []
+    assert search("bab") == []
@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock as ThreadLock
+from time import sleep
+
+import pytest
+
+from instancer.coalesce import (
+    Result,
+    coalesce,
+    is_final,
+    replay_response,
+    save_response,
+)
+from instancer.config import config, rclient
+from instancer.lock import Lock
+
+
+@pytest.fixture(autouse=True)
+def windows(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "deploy_coalesce_wait", 5)
+    monkeypatch.setattr(config, "deploy_idempotency_window", 60)
+
+
+class Counter:
+    """A run function that counts how often it ran."""
+
+    def __init__(self, duration: float = 0.3, fail_first: bool = False):
+        self.duration = duration
+        self.fail_first = fail_first
+        self.runs = 0
+        self._lock = ThreadLock()
+
+    def __call__(self) -> Result:
+        with self._lock:
+            self.runs += 1
+            runs = self.runs
+        sleep(self.duration)
+        if self.fail_first and runs == 1:
+            raise RuntimeError("leader failed")
+        return {"status": "ok", "run": runs}, 200
+
+
+def test_concurrent_callers_share_one_run() -> None:
+    run = Counter()
+    with ThreadPoolExecutor(5) as pool:
+        results = list(pool.map(lambda _: coalesce("k", run), range(5)))
+    assert run.runs == 1
+    assert results == [({"status": "ok", "run": 1}, 200)] * 5
+
+
+def test_later_callers_run_again() -> None:
+    run = Counter(duration=0)
+    coalesce("k", run)
+    coalesce("k", run)
+    assert run.runs == 2
+
+
+def test_leader_holds_inflight_lock() -> None:
+    def run() -> Result:
+        assert Lock("inflight:k").held()
+        return {"status": "ok"}, 200
+
+    coalesce("k", run)
+    assert not Lock("inflight:k").held()
+
+
+def test_waiter_takes_over_from_failed_leader() -> None:
+    run = Counter(fail_first=True)
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(coalesce, "k", run)
+        sleep(0.1)
+        waiter = pool.submit(coalesce, "k", run)
+        with pytest.raises(RuntimeError):
+            leader.result()
+        assert waiter.result() == ({"status": "ok", "run": 2}, 200)
+
+
+def test_waiter_gives_up(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "deploy_coalesce_wait", 0.3)
+    run = Counter(duration=1)
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(coalesce, "k", run)
+        sleep(0.1)
+        body, status = coalesce("k", run)
+        assert status == 503 and body["status"] == "temporarily_unavailable"
+        assert leader.result()[1] == 200
+    assert run.runs == 1
+
+
+@pytest.mark.parametrize(
+    "status, final",
+    [
+        (200, True),
+        (202, True),
+        (400, True),
+        (404, True),
+        (408, False),
+        (409, False),
+        (429, False),
+        (500, False),
+        (503, False),
+    ],
+)
+def test_is_final(status: int, final: bool) -> None:
+    assert is_final(status) is final
+
+
+def test_final_response_is_replayed() -> None:
+    assert replay_response("team", "key") is None
+    save_response("team", "key", ({"status": "ok"}, 200))
+    assert replay_response("team", "key") == ({"status": "ok"}, 200)
+    assert replay_response("other", "key") is None
+    ttl = rclient.ttl("idempotency:team:key")
+    assert 0 < ttl <= 60
+
+
+def test_retryable_response_isnt_saved() -> None:
+    save_response("team", "key", ({"status": "rate_limited"}, 429))
+    save_response("team", "key", ({"status": "temporarily_unavailable"}, 503))
+    assert replay_response("team", "key") is None
@@ -0,0 +1,86 @@
+import pytest
+
+from instancer.config import config
+from instancer.deploy_queue import (
+    QueueFullError,
+    enqueue_deploy,
+    pop_deploy,
+    queue_length,
+    queue_position,
+    remove_deploys,
+    requeue_deploy,
+)
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "deploy_queue_max_length", 10)
+    monkeypatch.setattr(config, "deploy_queue_max_per_team", 3)
+
+
+def pop_all() -> list[str]:
+    popped = []
+    while (deploy := pop_deploy()) is not None:
+        popped.append(deploy.namespace)
+    return popped
+
+
+def test_teams_take_turns() -> None:
+    for namespace in ["a1", "a2", "a3"]:
+        enqueue_deploy(namespace, "chall", "a")
+    enqueue_deploy("b1", "chall", "b")
+    enqueue_deploy("c1", "chall", "c")
+    enqueue_deploy("b2", "chall", "b")
+    assert pop_all() == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    assert queue_length() == 0
+
+
+def test_positions_follow_turns() -> None:
+    enqueue_deploy("a1", "chall", "a")
+    enqueue_deploy("a2", "chall", "a")
+    assert enqueue_deploy("b1", "chall", "b").position == 1
+    position = queue_position("a2")
+    assert position is not None and position.position == 2
+    assert queue_position("unknown") is None
+
+
+def test_queueing_again_keeps_place() -> None:
+    enqueue_deploy("a1", "chall", "a")
+    enqueue_deploy("b1", "chall", "b")
+    assert enqueue_deploy("a1", "chall", "a").position == 0
+    assert queue_length() == 2
+
+
+def test_team_share_is_limited() -> None:
+    for namespace in ["a1", "a2", "a3"]:
+        enqueue_deploy(namespace, "chall", "a")
+    with pytest.raises(QueueFullError) as e:
+        enqueue_deploy("a4", "chall", "a")
+    assert e.value.reason == "team_queue_full"
+    enqueue_deploy("b1", "chall", "b")
+
+
+def test_queue_length_is_limited(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "deploy_queue_max_length", 2)
+    enqueue_deploy("a1", "chall", "a")
+    enqueue_deploy("b1", "chall", "b")
+    with pytest.raises(QueueFullError) as e:
+        enqueue_deploy("c1", "chall", "c")
+    assert e.value.reason == "queue_full"
+
+
+def test_requeued_deploy_goes_first() -> None:
+    enqueue_deploy("a1", "chall", "a")
+    enqueue_deploy("b1", "chall", "b")
+    deploy = pop_deploy()
+    assert deploy is not None and deploy.namespace == "a1"
+    requeue_deploy(deploy)
+    assert pop_all() == ["a1", "b1"]
+
+
+def test_removed_deploys_arent_started() -> None:
+    enqueue_deploy("a1", "chall", "a")
+    enqueue_deploy("b1", "chall", "b")
+    enqueue_deploy("b2", "chall", "b")
+    assert remove_deploys(["a1", "b2", "unknown"]) == 2
+    assert pop_all() == ["b1"]
@@ -0,0 +1,85 @@
+from threading import Timer
+
+from instancer.config import rclient
+from instancer.events import (
+    StreamLimit,
+    last_event,
+    listen,
+    publish_event,
+    status_scopes,
+    status_versions,
+    team_status_scope,
+    touch_statuses,
+)
+from instancer.inventory import index_instance
+
+
+def test_stream_limit() -> None:
+    streams = StreamLimit(2)
+    assert streams.acquire() and streams.acquire()
+    assert not streams.acquire()
+    streams.release()
+    assert streams.acquire()
+    assert streams.open == 2
+
+
+def test_stream_limit_zero_serves_nothing() -> None:
+    assert not StreamLimit(0).acquire()
+
+
+def test_listen_sees_events_published_after_subscribing() -> None:
+    events = listen("ns", keepalive=10, duration=2)
+    assert next(events) is None
+    publish_event("ns", "queued", position=1)
+    publish_event("other", "queued", position=1)
+    event = next(events)
+    assert event["phase"] == "queued" and event["position"] == 1
+    events.close()
+
+
+def test_listen_keeps_idle_streams_alive() -> None:
+    events = listen("ns", keepalive=0.2, duration=2)
+    next(events)
+    Timer(0.5, publish_event, args=("ns", "namespace_created")).start()
+    assert next(events) is None
+    assert [e["phase"] for e in events if e is not None][0] == "namespace_created"
+
+
+def test_last_event_and_status_version() -> None:
+    assert last_event("ns") is None
+    assert status_versions(["ns"]) == ["0"]
+    publish_event("ns", "failed", reason="queue_timeout")
+    event = last_event("ns")
+    assert event is not None and event["reason"] == "queue_timeout"
+    assert status_versions(["ns"]) != ["0"]
+
+
+def test_status_scope_comes_from_inventory() -> None:
+    team_id = "4b45bb80-9a8b-47ca-ad0d-a995b1ffe6d7"
+    # a per-team namespace shortened to fit Kubernetes' length limit
+    namespace = "ci-a-very-long-challenge-id-3f2a9c"
+    pipe = rclient.pipeline()
+    index_instance(
+        pipe,
+        namespace,
+        {
+            "instancer.acmcyber.com/instance-id": "chall",
+            "instancer.acmcyber.com/team-id": team_id,
+        },
+    )
+    pipe.execute()
+    scope = f"scope:{team_status_scope(team_id)}"
+    before = status_versions([scope, "scope:shared"])
+    publish_event(namespace, "renewed")
+    after = status_versions([scope, "scope:shared"])
+    assert after[0] != before[0] and after[1] == before[1]
+
+
+def test_status_scope_of_unindexed_instance() -> None:
+    team_id = "4b45bb80-9a8b-47ca-ad0d-a995b1ffe6d7"
+    scope = f"scope:{team_status_scope(team_id)}"
+    touch_statuses(["ci-gone-3f2a9c", "ci-shared"], {"ci-gone-3f2a9c": team_id})
+    assert status_versions([scope, "scope:shared"]) != ["0", "0"]
+    assert status_scopes([f"ci-chall-t-{team_id.replace('-', '')}"]) == {
+        team_status_scope(team_id)
+    }
@@ -0,0 +1,123 @@
+from threading import Timer
+from time import monotonic, sleep
+
+import pytest
+
+import instancer.lock as lock_module
+from instancer.capacity import reservations, reserve
+from instancer.config import config, rclient
+from instancer.deploy_queue import enqueue_deploy, pop_deploy, requeue_deploy
+from instancer.lock import FencedException, Lock, LockException
+
+
+def test_lock_is_exclusive() -> None:
+    with Lock("test"):
+        with pytest.raises(LockException):
+            Lock("test").lock()
+    with Lock("test"):
+        pass
+
+
+def test_fencing_tokens_increase() -> None:
+    first = Lock("test")
+    with first:
+        first_token = first.token
+    assert first.token is None
+    second = Lock("test")
+    with second:
+        assert first_token is not None and second.token is not None
+        assert second.token > first_token
+
+
+def test_only_holder_releases() -> None:
+    holder = Lock("test")
+    holder.lock()
+    try:
+        Lock("test").unlock()
+        assert rclient.get("lock:test") == holder.lock_value.encode()
+    finally:
+        holder.unlock()
+    assert not holder.held()
+
+
+def test_expired_holder_doesnt_release_new_holder() -> None:
+    old = Lock("test")
+    old.lock()
+    # the old holder's lease ran out and someone else took the lock
+    rclient.delete("lock:test")
+    new = Lock("test")
+    new.lock()
+    try:
+        old.unlock()
+        assert rclient.get("lock:test") == new.lock_value.encode()
+        assert old.token is None
+    finally:
+        new.unlock()
+
+
+def test_lease_is_renewed_while_held() -> None:
+    with Lock("test", max_time=1) as lock:
+        sleep(1.5)
+        assert rclient.get("lock:test") == lock.lock_value.encode()
+    assert not lock.held()
+
+
+def test_waiter_wakes_up_on_release() -> None:
+    holder = Lock("test")
+    holder.lock()
+    Timer(0.2, holder.unlock).start()
+    start = monotonic()
+    # the holder's lease is a minute, so only the release notification gets us in time
+    with Lock("test", wait=5):
+        assert monotonic() - start < 2
+
+
+def test_waiter_gives_up() -> None:
+    with Lock("test"):
+        start = monotonic()
+        with pytest.raises(LockException):
+            Lock("test", wait=0.3).lock()
+        assert monotonic() - start < 2
+
+
+def test_lease_running_out_is_retried_right_away(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # the lock was found taken, but its lease was already gone when PTTL ran
+    replies = iter([[0, -2], [1, 1]])
+    monkeypatch.setattr(lock_module, "_acquire", lambda **kwargs: next(replies))
+    lock = Lock("test")
+    assert lock._try_lock() == 0
+    assert lock.token == 1
+
+
+def test_stale_holder_is_fenced(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "capacity_enabled", True)
+    stale = Lock("test")
+    stale.lock()
+    # the stale holder's lease ran out and someone else took the lock
+    rclient.delete("lock:test")
+    with Lock("test") as holder:
+        with pytest.raises(FencedException):
+            reserve("ns", {"cpu": 1, "memory": 1}, lock=stale)
+        assert reservations(["ns"]) == {}
+        reserve("ns", {"cpu": 1, "memory": 1}, lock=holder)
+        assert reservations(["ns"]) == {"ns": {"cpu": 1, "memory": 1}}
+    stale.unlock()
+
+
+def test_queue_is_fenced() -> None:
+    enqueue_deploy("a1", "chall", "a")
+    stale = Lock("deploy_queue")
+    stale.lock()
+    rclient.delete("lock:deploy_queue")
+    with Lock("deploy_queue") as holder:
+        with pytest.raises(FencedException):
+            pop_deploy(stale)
+        deploy = pop_deploy(holder)
+        assert deploy is not None
+        with pytest.raises(FencedException):
+            requeue_deploy(deploy, stale)
+        requeue_deploy(deploy, holder)
+    stale.unlock()
+    assert pop_deploy() is not None
@@ -0,0 +1,43 @@
+from time import time
+
+from instancer.config import rclient
+from instancer.profiler import profile_info, start_profile
+
+
+def test_running_until_announced() -> None:
+    # a profile whose announcement hasn't been published yet
+    rclient.hset(
+        "profile:p",
+        mapping={
+            "started": int(time()),
+            "duration": 10,
+            "interval": 10,
+            "workers": 0,
+            "samples": 0,
+        },
+    )
+    info = profile_info("p")
+    assert info is not None
+    assert info["state"] == "running"
+    assert info["listeners"] is None
+
+
+def test_done_without_listeners() -> None:
+    info = start_profile(10, 10)
+    assert info["listeners"] == 0
+    assert info["state"] == "done"
+
+
+def test_running_until_listeners_report() -> None:
+    pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("profile")
+    try:
+        info = start_profile(10, 10)
+        assert info["listeners"] == 1
+        assert info["state"] == "running"
+        rclient.hincrby(f"profile:{info['id']}", "workers", 1)
+        finished = profile_info(info["id"])
+        assert finished is not None
+        assert finished["state"] == "done"
+    finally:
+        pubsub.close()
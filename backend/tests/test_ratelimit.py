@@ -0,0 +1,94 @@
+from time import time
+
+import pytest
+
+from instancer.config import config, rclient
+from instancer.ratelimit import RateLimitException, check_deploy_rate, start_slot
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "team_deploy_burst", 2)
+    monkeypatch.setattr(config, "team_deploy_per_minute", 6)
+    monkeypatch.setattr(config, "challenge_deploy_burst", 100)
+    monkeypatch.setattr(config, "challenge_deploy_per_minute", 120)
+    monkeypatch.setattr(config, "max_concurrent_starts", 1)
+
+
+def test_burst_then_denied() -> None:
+    check_deploy_rate("team", "chall")
+    check_deploy_rate("team", "chall")
+    with pytest.raises(RateLimitException) as e:
+        check_deploy_rate("team", "chall")
+    # 6 deploys per minute refill a token every 10 seconds
+    assert 9 <= e.value.retry_after <= 10
+
+
+def test_teams_have_separate_buckets() -> None:
+    check_deploy_rate("a", "chall")
+    check_deploy_rate("a", "chall")
+    with pytest.raises(RateLimitException):
+        check_deploy_rate("a", "chall")
+    check_deploy_rate("b", "chall")
+
+
+def test_challenge_buckets_are_per_team(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "challenge_deploy_burst", 1)
+    check_deploy_rate("a", "chall")
+    with pytest.raises(RateLimitException):
+        check_deploy_rate("a", "chall")
+    # a team emptying its bucket for a challenge doesn't block anyone else
+    check_deploy_rate("a", "other")
+    check_deploy_rate("b", "chall")
+
+
+def test_denied_deploy_takes_no_tokens(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "team_deploy_burst", 2)
+    monkeypatch.setattr(config, "challenge_deploy_burst", 1)
+    check_deploy_rate("team", "chall")
+    with pytest.raises(RateLimitException):
+        check_deploy_rate("team", "chall")
+    # the team token the denied deploy would have taken is still there
+    check_deploy_rate("team", "other")
+    with pytest.raises(RateLimitException):
+        check_deploy_rate("team", "third")
+
+
+def test_tokens_refill() -> None:
+    check_deploy_rate("team", "chall")
+    check_deploy_rate("team", "chall")
+    # pretend the last deploy was 10 seconds ago
+    key = "ratelimit:deploy:team:team"
+    rclient.hset(key, "ts", int(rclient.hget(key, "ts") or 0) - 10_000)
+    check_deploy_rate("team", "chall")
+    with pytest.raises(RateLimitException):
+        check_deploy_rate("team", "chall")
+
+
+def test_zero_burst_disables_limit(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "team_deploy_burst", 0)
+    for _ in range(10):
+        check_deploy_rate("team", "chall")
+
+
+def test_start_slot_is_exclusive() -> None:
+    with start_slot():
+        with pytest.raises(RateLimitException):
+            with start_slot():
+                pass
+    with start_slot():
+        pass
+
+
+def test_start_slot_expired_lease_is_freed() -> None:
+    # a holder that died without giving back its slot
+    rclient.zadd("semaphore:start", {"dead": int(time() * 1000) - 1})
+    with start_slot():
+        pass
+
+
+def test_start_slot_disabled(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "max_concurrent_starts", 0)
+    with start_slot():
+        with start_slot():
+            pass
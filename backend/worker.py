@@ -1,67 +1,470 @@
+from collections import defaultdict
+from threading import Thread
 from time import sleep, time
 
+from kubernetes import watch as kwatch
 from kubernetes.client.exceptions import ApiException
 
 # For some reason mypy says kclient isn't explicitly exported even though it is
-from instancer.backend import Challenge, kclient  # type: ignore[attr-defined]
+from instancer.backend import (  # type: ignore[attr-defined]
+    Challenge,
+    container_requests,
+    kapi,
+    kclient,
+)
+from instancer.capacity import (
+    RESOURCES,
+    CapacityExceededError,
+    configured_total,
+    draining,
+    reconcile,
+    release_drained,
+    resource_amounts,
+    set_total,
+)
+from instancer.catalog import catalog_version
 from instancer.config import config, rclient
-from instancer.lock import Lock
+from instancer.deploy_queue import peek_deploy, pop_deploy, requeue_deploy
+from instancer.event_log import record_event
+from instancer.events import (
+    PHASES,
+    last_event,
+    publish_event,
+    touch_status,
+    touch_statuses,
+)
+from instancer.inventory import index_instance, instance_teams, unindex_instances
+from instancer.lock import Lock, LockException
+from instancer.metrics import resync_duration, serve_worker_metrics
+from instancer.preemption import preempt
+from instancer.prepull import sync_prepull
+from instancer.teardown import next_bulk_stop, run_bulk_stop
+
+
+def publish_pod_phase(namespace: str, phase: str) -> None:
+    """Publish a pod phase event unless the instance already reached it or a later phase.
+
+    This keeps a restarted watch from repeating events for instances that are already up.
+    """
+
+    last = last_event(namespace)
+    if last is not None and PHASES.index(last["phase"]) >= PHASES.index(phase):
+        return
+    publish_event(namespace, phase)
+
+
+def condition_time(condition: kclient.V1PodCondition) -> int:
+    """Return the time a pod condition last changed, or the current time if it is unknown."""
+
+    if condition.last_transition_time is None:
+        return int(time())
+    return int(condition.last_transition_time.timestamp())
+
+
+def log_ready(namespace: str, labels: dict[str, str], ready_time: int) -> None:
+    """Record how long an instance took from being created to all of its pods being
+    ready in the event log."""
+
+    boot_time = rclient.zscore("boot_time", namespace)
+    if boot_time is None:
+        return
+    record_event(
+        labels["instancer.acmcyber.com/instance-id"],
+        labels.get("instancer.acmcyber.com/team-id"),
+        "ready",
+        "ok",
+        max(ready_time - boot_time, 0),
+    )
+
+
+def watch_pods() -> None:
+    """Watch challenge pods and publish pods_scheduled and containers_ready events.
+
+    The time every pod of an instance became ready is recorded in the ready_time zset.
+    """
+
+    capi = kclient.CoreV1Api(kapi)
+    # namespace -> pod name -> (scheduled, time the pod became ready or None)
+    pods: dict[str, dict[str, tuple[bool, int | None]]] = defaultdict(dict)
+    expected: dict[str, int] = {}
+    while True:
+        try:
+            for event in kwatch.Watch().stream(
+                capi.list_pod_for_all_namespaces,
+                label_selector="instancer.acmcyber.com/instance-id",
+                timeout_seconds=300,
+            ):
+                pod = event["object"]
+                # label-scoped instances share their namespace with other instances
+                ns = (pod.metadata.labels or {}).get(
+                    "instancer.acmcyber.com/instance-key", pod.metadata.namespace
+                )
+                if event["type"] == "DELETED":
+                    pods[ns].pop(pod.metadata.name, None)
+                    if len(pods[ns]) == 0:
+                        del pods[ns]
+                        expected.pop(ns, None)
+                    continue
+                conditions = {
+                    c.type: c for c in pod.status.conditions or [] if c.status == "True"
+                }
+                pods[ns][pod.metadata.name] = (
+                    "PodScheduled" in conditions,
+                    condition_time(conditions["Ready"])
+                    if "Ready" in conditions
+                    else None,
+                )
+                try:
+                    expected[ns] = int(
+                        pod.metadata.annotations["instancer.acmcyber.com/instance-pods"]
+                    )
+                except (KeyError, TypeError, ValueError):
+                    expected[ns] = len(pods[ns])
+                states = pods[ns].values()
+                if len(states) < expected[ns]:
+                    continue
+                if all(scheduled for scheduled, _ in states):
+                    publish_pod_phase(ns, "pods_scheduled")
+                ready_times = [ready for _, ready in states if ready is not None]
+                if len(ready_times) == len(states):
+                    if rclient.zadd("ready_time", {ns: max(ready_times)}, nx=True):
+                        touch_status(ns)
+                        log_ready(ns, pod.metadata.labels, max(ready_times))
+                    publish_pod_phase(ns, "containers_ready")
+        except Exception as e:
+            print(f"[*] Pod watch failed due to error {e}, restarting...", flush=True)
+            sleep(5)
+
+
+def instance_objects(
+    capi: kclient.CoreV1Api, api: kclient.AppsV1Api
+) -> list[tuple[str, dict[str, str], dict[str, str], bool]]:
+    """Return the objects holding the state of the instances as tuples of the instance
+    namespace, labels, annotations and whether the object is being deleted.
+
+    These are every namespace, since namespaces from older versions may only have the
+    annotations, and the deployments of label-scoped instances."""
+
+    objects = [
+        (
+            ns.metadata.name,
+            ns.metadata.labels or {},
+            ns.metadata.annotations or {},
+            ns.status is not None and ns.status.phase == "Terminating",
+        )
+        for ns in capi.list_namespace().items
+    ]
+    for dep in api.list_deployment_for_all_namespaces(
+        label_selector="instancer.acmcyber.com/instance-key"
+    ).items:
+        annotations = dep.metadata.annotations or {}
+        if "instancer.acmcyber.com/chall-expires" in annotations:
+            objects.append(
+                (
+                    dep.metadata.labels["instancer.acmcyber.com/instance-key"],
+                    dep.metadata.labels,
+                    annotations,
+                    dep.metadata.deletion_timestamp is not None,
+                )
+            )
+    return objects
+
+
+def node_allocatable(capi: kclient.CoreV1Api) -> dict[str, int]:
+    """Return the CPU and memory allocatable on the ready, schedulable nodes."""
+
+    total: dict[str, int] = defaultdict(int)
+    for node in capi.list_node().items:
+        if node.spec.unschedulable:
+            continue
+        if not any(
+            c.type == "Ready" and c.status == "True"
+            for c in node.status.conditions or []
+        ):
+            continue
+        for name, amount in resource_amounts(node.status.allocatable or {}).items():
+            total[name] += amount
+    return dict(total)
+
+
+def sync_capacity(capi: kclient.CoreV1Api, live: dict[str, str]) -> None:
+    """Update the cluster capacity and the reservations of the live instances.
+
+    `live` maps the namespace of each live instance to its challenge ID."""
+
+    try:
+        total = node_allocatable(capi)
+    except ApiException as e:
+        print(f"[*] Could not list nodes due to error {e}", flush=True)
+        total = {}
+    set_total({**total, **configured_total()})
+
+    requests: dict[str, dict[str, int] | None] = {}
+    reservations = {}
+    for ns, chall_id in live.items():
+        if chall_id not in requests:
+            info = Challenge.fetch_info(chall_id)
+            requests[chall_id] = (
+                None
+                if info is None
+                else {
+                    name: sum(
+                        container_requests(cont).get(name, 0)
+                        for cont in info.cfg["containers"].values()
+                    )
+                    for name in RESOURCES
+                }
+            )
+        chall_requests = requests[chall_id]
+        if chall_requests is not None:
+            reservations[ns] = chall_requests
+    reconcile(reservations)
+
+
+def release_drained_capacity(capi: kclient.CoreV1Api, lock: Lock) -> None:
+    """Release the capacity of stopped instances once none of their pods are left, so
+    queued deploys aren't admitted onto nodes that are still full. `lock` is the deploy
+    queue lock held by the caller."""
+
+    stopped = draining()
+    if len(stopped) == 0:
+        return
+    remaining = set()
+    for pod in capi.list_pod_for_all_namespaces(
+        label_selector="instancer.acmcyber.com/instance-id"
+    ).items:
+        # label-scoped instances share their namespace with other instances
+        remaining.add(
+            (pod.metadata.labels or {}).get(
+                "instancer.acmcyber.com/instance-key", pod.metadata.namespace
+            )
+        )
+    gone = [ns for ns in stopped if ns not in remaining]
+    if len(gone) > 0:
+        print(f"[*] Releasing capacity of {len(gone)} stopped instances...", flush=True)
+        release_drained(gone, lock)
+
+
+def start_queued_deploys(lock: Lock) -> None:
+    """Start queued deploys in round-robin order until the cluster is full again.
+
+    `lock` is the deploy queue lock held by the caller."""
+
+    while (deploy := pop_deploy(lock)) is not None:
+        if deploy.enqueued + config.deploy_queue_max_wait < time():
+            print(f"[*] Dropping queued deploy of {deploy.namespace}...", flush=True)
+            publish_event(deploy.namespace, "failed", reason="queue_timeout")
+            continue
+        chall = Challenge.fetch(deploy.challenge_id, deploy.team_id)
+        if chall is None:
+            continue
+        print(f"[*] Starting queued deploy of {deploy.namespace}...", flush=True)
+        try:
+            chall.start(skip_queue=True)
+        except CapacityExceededError:
+            requeue_deploy(deploy, lock)
+            return
+        except Exception as e:
+            print(
+                f"[*] Could not start queued deploy of {deploy.namespace} due to error {e}",
+                flush=True,
+            )
+            publish_event(deploy.namespace, "failed")
+
+
+def preempt_for_queue() -> None:
+    """Preempt running instances to make room for the deploy at the head of the queue."""
+
+    deploy = peek_deploy()
+    if deploy is None:
+        return
+    chall = Challenge.fetch(deploy.challenge_id, deploy.team_id)
+    if chall is not None:
+        preempt(chall.resource_requests())
+
+
+def drain_deploy_queue() -> None:
+    """Start queued deploys whenever capacity is released, and every few seconds in case
+    the cluster capacity grew or the pods of stopped instances are gone."""
+
+    capi = kclient.CoreV1Api(kapi)
+    pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("capacity:released")
+    while True:
+        try:
+            with Lock("deploy_queue") as lock:
+                release_drained_capacity(capi, lock)
+                start_queued_deploys(lock)
+                if config.preemption_enabled:
+                    preempt_for_queue()
+        except LockException:
+            pass
+        except Exception as e:
+            print(f"[*] Deploy queue error {e}", flush=True)
+        pubsub.get_message(timeout=5)
+
+
+def run_bulk_stops() -> None:
+    """Run queued bulk stops one at a time, resuming a job left unfinished by a worker
+    that stopped while running it."""
+
+    pubsub = rclient.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("bulk_stop:queued")
+    while True:
+        try:
+            with Lock("bulk_stop"):
+                while (job_id := next_bulk_stop()) is not None:
+                    run_bulk_stop(job_id)
+        except LockException:
+            pass
+        except Exception as e:
+            print(f"[*] Bulk stop error {e}", flush=True)
+        pubsub.get_message(timeout=5)
+
+
+def resync(capi: kclient.CoreV1Api, api: kclient.AppsV1Api) -> None:
+    """Rebuild the cached instance state in Redis from the objects in the cluster."""
+
+    # keyed by str | bytes to match the type annotations of zadd
+    expirations: dict[str | bytes, int] = {}
+    boot_timestamps: dict[str | bytes, int] = {}
+    renew_timestamps: dict[str | bytes, int] = {}
+    live = {}
+    index = rclient.pipeline(transaction=False)
+    for name, labels, annotations, terminating in instance_objects(capi, api):
+        if "instancer.acmcyber.com/instance-id" in labels:
+            index_instance(index, name, labels)
+            if not terminating:
+                live[name] = labels["instancer.acmcyber.com/instance-id"]
+        if "instancer.acmcyber.com/chall-expires" in annotations:
+            try:
+                expirations[name] = int(
+                    annotations["instancer.acmcyber.com/chall-expires"]
+                )
+            except ValueError:
+                pass
+        if "instancer.acmcyber.com/chall-start-time" in annotations:
+            try:
+                renew_timestamps[name] = int(
+                    annotations["instancer.acmcyber.com/chall-start-time"]
+                )
+                # instances started before the boot time annotation existed
+                # only have the time of their last renewal
+                boot_timestamps[name] = int(
+                    annotations.get(
+                        "instancer.acmcyber.com/chall-boot-time",
+                        renew_timestamps[name],
+                    )
+                )
+            except ValueError:
+                pass
+
+    cached = {
+        ns.decode(): int(score)
+        for ns, score in rclient.zrange("expiration", 0, -1, withscores=True)
+    }
+    index.execute()
+    sync_capacity(capi, live)
+
+    if len(expirations) > 0:
+        rclient.zadd("expiration", expirations)
+
+    if len(boot_timestamps) > 0:
+        rclient.zadd("boot_time", boot_timestamps)
+
+    if len(renew_timestamps) > 0:
+        rclient.zadd("renew_time", renew_timestamps)
+
+    removed = [ns for ns in cached if ns not in expirations]
+    if len(removed) > 0:
+        rclient.zrem("expiration", *removed)
+
+    stale = [
+        ns.decode()
+        for ns in rclient.zrange("boot_time", 0, -1)
+        if ns.decode() not in boot_timestamps
+    ]
+    unready = [
+        ns.decode()
+        for ns in rclient.zrange("ready_time", 0, -1)
+        if ns.decode() not in expirations
+    ]
+    # instances that appeared, changed or disappeared without the API knowing, e.g.
+    # while it was down or when their namespace was deleted by hand
+    changed = sorted(
+        {
+            str(ns)
+            for ns, expiration in expirations.items()
+            if cached.get(str(ns)) != expiration
+        }
+        | set(removed)
+        | set(stale)
+        | set(unready)
+    )
+    # read the teams before stale instances are unindexed
+    teams = instance_teams(changed)
+
+    if len(stale) > 0:
+        pipe = rclient.pipeline()
+        pipe.zrem("boot_time", *stale)
+        pipe.zrem("renew_time", *stale)
+        unindex_instances(pipe, stale)
+        pipe.execute()
+
+    if len(unready) > 0:
+        rclient.zrem("ready_time", *unready)
+
+    touch_statuses(changed, teams)
 
 
 def main() -> None:
-    capi = kclient.CoreV1Api()
+    capi = kclient.CoreV1Api(kapi)
+    api = kclient.AppsV1Api(kapi)
+    Thread(target=watch_pods, daemon=True).start()
+    Thread(target=drain_deploy_queue, daemon=True).start()
+    Thread(target=run_bulk_stops, daemon=True).start()
+    serve_worker_metrics()
+    # namespace -> expiration time that a warning was published for
+    warned: dict[str, int] = {}
+    # catalog version the pre-pull DaemonSet was last synced at
+    prepull_version: int | None = None
     while True:
         curtime = int(time())
 
+        if config.prepull_enabled and catalog_version() != prepull_version:
+            version = catalog_version()
+            try:
+                sync_prepull()
+                prepull_version = version
+            except ApiException as e:
+                print(f"[*] Could not sync image pre-pull due to error {e}", flush=True)
+
         # Redis has incorrect type annotations that don't allow str
-        for chall in rclient.zrange("expiration", "-inf", curtime, byscore=True):  # type: ignore[call-overload]
-            Challenge.stop_namespace(chall.decode())
+        expired = rclient.zrange("expiration", "-inf", curtime, byscore=True)  # type: ignore[call-overload]
+        Challenge.stop_namespaces([chall.decode() for chall in expired], "expire")
+
+        for chall, score in rclient.zrange(
+            "expiration",
+            curtime,
+            curtime + config.expiry_warning,
+            byscore=True,
+            withscores=True,
+        ):
+            if warned.get(chall.decode()) != int(score):
+                warned[chall.decode()] = int(score)
+                publish_event(chall.decode(), "expiring_soon", expiration=int(score))
+        warned = {k: v for k, v in warned.items() if v >= curtime}
 
         last_resync = rclient.get("last_resync")
         if (
             last_resync is None
             or int(last_resync.decode()) + config.redis_resync_interval <= curtime
         ):
-            expirations = {}
-            boot_timestamps = {}
-            for ns in capi.list_namespace().items:
-                annotations = ns.metadata.annotations
-                if (
-                    isinstance(annotations, dict)
-                    and "instancer.acmcyber.com/chall-expires" in annotations
-                ):
-                    try:
-                        expirations[ns.metadata.name] = int(
-                            annotations["instancer.acmcyber.com/chall-expires"]
-                        )
-                    except ValueError:
-                        pass
-                if (
-                    isinstance(annotations, dict)
-                    and "instancer.acmcyber.com/chall-start-time" in annotations
-                ):
-                    try:
-                        boot_timestamps[ns.metadata.name] = int(
-                            annotations["instancer.acmcyber.com/chall-start-time"]
-                        )
-                    except ValueError:
-                        pass
-
-            if len(expirations) > 0:
-                rclient.zadd("expiration", expirations)
-
-            if len(boot_timestamps) > 0:
-                rclient.zadd("boot_time", boot_timestamps)
-
-            for ns in rclient.zrange("expiration", 0, -1):
-                if ns.decode() not in expirations:
-                    rclient.zrem("expiration", ns)
-
-            for ns in rclient.zrange("boot_time", 0, -1):
-                if ns.decode() not in boot_timestamps:
-                    rclient.zrem("boot_time", ns)
-
+            with resync_duration.time():
+                resync(capi, api)
             rclient.set("last_resync", int(time()))
+            # recreate the DaemonSet if it was deleted
+            prepull_version = None
 
         sleep(5)
 
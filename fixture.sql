@@ -20,6 +20,29 @@ CREATE TABLE public.teams (
     team_username text UNIQUE,
     team_email text UNIQUE
 );
+CREATE TABLE public.instance_events (
+    id bigserial PRIMARY KEY,
+    time timestamp with time zone NOT NULL,
+    challenge_id character varying(256) NOT NULL,
+    team_id UUID,
+    action character varying(16) NOT NULL,
+    outcome character varying(16) NOT NULL,
+    duration double precision NOT NULL,
+    uptime integer,
+    error text
+);
+CREATE TABLE public.instance_event_stats (
+    challenge_id character varying(256) NOT NULL,
+    action character varying(16) NOT NULL,
+    events bigint NOT NULL,
+    failures bigint NOT NULL,
+    rejections bigint NOT NULL,
+    total_duration double precision NOT NULL,
+    max_duration double precision NOT NULL,
+    total_uptime bigint NOT NULL,
+    last_event timestamp with time zone NOT NULL,
+    PRIMARY KEY (challenge_id, action)
+);
 
 COPY challenges (id, name, description, cfg, per_team, lifetime, boot_time, author) FROM stdin;
 per-team-redis-chall	Per Team Redis Chall	This is a testing challenge for the instancer.	{"containers": {"app": {"image": "docker.acmcyber.com/simple-redis-chall:latest", "ports": [8080]}, "redis": {"image": "redis:7-alpine", "ports": [6379]}}, "tcp": {"redis": [6379]}, "http": {"app": [[8080, "testing2.instancer.acmcyber.com"]]}}	t	3600	10	aplet123
@@ -55,3 +78,5 @@ ALTER TABLE ONLY public.tags
 
 ALTER TABLE ONLY public.tags
     ADD CONSTRAINT tags_challenge_id_fkey FOREIGN KEY (challenge_id) REFERENCES public.challenges(id);
+
+CREATE INDEX instance_events_challenge_id_time_idx ON public.instance_events (challenge_id, time);
@@ -12,8 +12,10 @@ import {
     ChallengeDeploymentType,
     DeploymentType,
     MessageType,
+    QueueType,
 } from "./util/types.ts";
 import {prettyTime, getCategories, getTags, isDeployed} from "./util/utility.ts";
+import {subscribeDeploymentEvents} from "./util/events.ts";
 import useAccountManagement from "./util/account";
 
 import config from "./util/config";
@@ -31,6 +33,15 @@ function createLink(host: string) {
     );
 }
 
+/* Phases after which a deployment's progress is no longer followed */
+const FINAL_PHASES = ["containers_ready", "terminated", "failed"];
+/* Milliseconds after which a deployment that never became ready is no longer followed */
+const FOLLOW_TIMEOUT = 5 * 60 * 1000;
+
+function isStarting(deployment: DeploymentType | null | undefined) {
+    return !!deployment && deployment.ready === null;
+}
+
 const Chall = () => {
     /* Redirect if not logged in */
     const {accountToken} = useAccountManagement();
@@ -44,7 +55,10 @@ const Chall = () => {
     const [chall, setChall] = useState<ChallengeInfoType | undefined | null>(undefined);
     const [deployment, setDeployment] = useState<DeploymentType | undefined>();
     const [deployed, setDeployed] = useState<boolean>(false);
+    const [queue, setQueue] = useState<QueueType | null>(null);
     const [timer, setTimer] = useState<number>(-100);
+    /* Whether a deployment is queued or starting, so its progress is followed */
+    const [following, setFollowing] = useState<boolean>(false);
 
     const captchaRef = useRef<ReCaptcha>(null);
 
@@ -62,44 +76,68 @@ const Chall = () => {
             loggedOutRedirect();
             return;
         }
-        if (timer <= 0) {
-            fetch("/api/challenge/" + ID, {
-                headers: {Authorization: `Bearer ${accountToken}`},
+        fetch("/api/challenge/" + ID, {
+            headers: {Authorization: `Bearer ${accountToken}`},
+        })
+            .then((res) => {
+                if (res.status === 404) {
+                    setChall(null);
+                    console.debug("Challenge not found");
+                    return;
+                }
+                return res.json();
             })
-                .then((res) => {
-                    if (res.status === 404) {
-                        setChall(null);
-                        console.debug("Challenge not found");
-                        return;
-                    }
-                    return res.json();
-                })
-                .then((challenge: SingleChallengeType) => {
-                    if (challenge.status === "ok") {
-                        setChall(challenge.challenge_info);
-                        fetch("/api/challenge/" + ID + "/deployment", {
-                            headers: {Authorization: `Bearer ${accountToken}`},
-                        })
-                            .then((res) => res.json())
-                            .then((challengeDeployment: ChallengeDeploymentType) => {
-                                if (challengeDeployment.status === "ok") {
-                                    setDeployment(challengeDeployment.deployment);
-                                    if (loginToken) {
-                                        setSearchParams("");
-                                    }
-                                } else {
-                                    loggedOutRedirect();
+            .then((challenge: SingleChallengeType) => {
+                if (challenge.status === "ok") {
+                    setChall(challenge.challenge_info);
+                    fetch("/api/challenge/" + ID + "/deployment", {
+                        headers: {Authorization: `Bearer ${accountToken}`},
+                    })
+                        .then((res) => res.json())
+                        .then((challengeDeployment: ChallengeDeploymentType) => {
+                            if (challengeDeployment.status === "ok") {
+                                setDeployment(challengeDeployment.deployment);
+                                setFollowing(isStarting(challengeDeployment.deployment));
+                                if (loginToken) {
+                                    setSearchParams("");
                                 }
-                            })
-                            .catch((err) => console.debug(err));
-                    } else {
-                        console.debug("Failed to get chall status");
-                        loggedOutRedirect();
-                    }
-                })
-                .catch((err) => console.debug(err));
-        }
-    }, [navigate, timer, ID, accountToken, loginToken, setSearchParams]);
+                            } else {
+                                loggedOutRedirect();
+                            }
+                        })
+                        .catch((err) => console.debug(err));
+                } else {
+                    console.debug("Failed to get chall status");
+                    loggedOutRedirect();
+                }
+            })
+            .catch((err) => console.debug(err));
+    }, [navigate, ID, accountToken, loginToken, setSearchParams]);
+
+    /* Follow the progress of a queued or starting deployment until it is up or gone */
+    useEffect(() => {
+        if (accountToken === null || !following) return;
+        const timeout = setTimeout(() => setFollowing(false), FOLLOW_TIMEOUT);
+        const unsubscribe = subscribeDeploymentEvents(ID, accountToken, (name, event) => {
+            setDeployment(event.deployment ?? undefined);
+            /* A queued event with a position means the deploy is waiting for capacity */
+            if (name === "queued") {
+                setQueue(event.position === undefined ? null : {position: event.position, eta: event.eta ?? null});
+            } else if (name !== "status" || event.deployment) {
+                setQueue(null);
+            }
+            if (name === "terminated" && event.reason === "preempted") {
+                setErrorMsg("Your instance was stopped to make room for other teams. Deploy it again to continue.");
+            }
+            if (FINAL_PHASES.includes(name) || (event.deployment && !isStarting(event.deployment))) {
+                setFollowing(false);
+            }
+        });
+        return () => {
+            clearTimeout(timeout);
+            unsubscribe();
+        };
+    }, [ID, accountToken, following]);
 
     let challInfo;
     let buttons;
@@ -133,8 +171,16 @@ const Chall = () => {
                 .then((challengeDeployment: ChallengeDeploymentType) => {
                     if (challengeDeployment.status === "ok") {
                         setDeployment(challengeDeployment.deployment);
+                        setFollowing(isStarting(challengeDeployment.deployment));
                         setErrorMsg(null);
                         if (index === 1) setExtended(true);
+                    } else if (challengeDeployment.status === "queued") {
+                        setQueue(challengeDeployment.queue ?? null);
+                        setFollowing(true);
+                        setErrorMsg(null);
+                    } else if (challengeDeployment.status === "capacity_exceeded") {
+                        updateArr(index, isShaking, setIsShaking, true);
+                        setErrorMsg("The cluster is full. Please try again in a few minutes.");
                     } else if (challengeDeployment.status === "temporarily_unavailable") {
                         console.error("Deployment error");
                         updateArr(index, isShaking, setIsShaking, true);
@@ -254,7 +300,11 @@ const Chall = () => {
             const outPorts: (string | JSX.Element)[] = [];
             const portmap = deployment.port_mappings;
             Object.keys(portmap).forEach((key) => {
-                if (typeof portmap[key] === "string") {
+                const tcpRoute = typeof portmap[key] === "string" && /^(.+):(\d+)$/.exec(portmap[key] as string);
+                if (tcpRoute) {
+                    // TCP ports routed by SNI need TLS
+                    outPorts.push("ncat --ssl " + tcpRoute[1] + " " + tcpRoute[2]);
+                } else if (typeof portmap[key] === "string") {
                     outPorts.push(createLink(portmap[key] as string));
                 } else {
                     outPorts.push("nc " + deployment.host + " " + String(portmap[key]));
@@ -368,6 +418,14 @@ const Chall = () => {
                             DEPLOY NOW
                         </button>
                     </div>
+                    {queue && (
+                        <div className="errorMsg">
+                            {`Waiting for room in the cluster: ${queue.position} deploy${
+                                queue.position === 1 ? "" : "s"
+                            } ahead`}
+                            {queue.eta !== null && `, about ${prettyTime(queue.eta)} left`}
+                        </div>
+                    )}
                     {errorMsg && <div className="errorMsg">{errorMsg}</div>}
                 </>
             );
@@ -2,17 +2,52 @@ import "./styles/index.css";
 import "./styles/challs.css";
 import React, {useState, useEffect} from "react";
 import {Link, useNavigate} from "react-router-dom";
-import {ChallengeType, ChallengesType, DisplayType} from "./util/types.ts";
+import {ChallengeType, ChallengesType} from "./util/types.ts";
 import {getCategories, getTags, isDeployed} from "./util/utility.ts";
 import {ReactComponent as FilterBtn} from "./images/filter.svg";
 import {ReactComponent as ClearBtn} from "./images/clear.svg";
 import useAccountManagement from "./util/account";
 
+/* filters are stored as "<kind>:<name>" where kind is category, tag or status */
 const include = new Set<string>([]);
 const exclude = new Set<string>([]);
 
 let userInput = "";
 
+/* query string for the challenge listing API with the current filters */
+function filterQuery() {
+    const params = new URLSearchParams();
+    include.forEach((filter) => {
+        const [kind, name] = splitFilter(filter);
+        params.append(kind, name);
+    });
+    exclude.forEach((filter) => {
+        const [kind, name] = splitFilter(filter);
+        if (kind !== "status") {
+            params.append("exclude_" + kind, name);
+        }
+    });
+    const active = !exclude.has("status:active");
+    const inactive = !exclude.has("status:inactive");
+    if (active !== inactive) {
+        params.set("status", active ? "active" : "inactive");
+    }
+    if (userInput.length !== 0) {
+        params.set("q", userInput);
+    }
+    return params.toString();
+}
+
+function splitFilter(filter: string) {
+    const idx = filter.indexOf(":");
+    return [filter.slice(0, idx), filter.slice(idx + 1)];
+}
+
+/* true if the filters exclude every challenge regardless of the catalog */
+function excludesAll() {
+    return exclude.has("status:active") && exclude.has("status:inactive");
+}
+
 /* sidebar label */
 function Title({value}: {value: number}) {
     if (value === 0) {
@@ -97,121 +132,66 @@ const ChallPage = () => {
     }
 
     /* filter system */
-    const [show, setShow] = useState<DisplayType[]>([]);
+    const [show, setShow] = useState<ChallengeType[]>([]);
+    const [query, setQuery] = useState<string>(filterQuery());
 
     /* filter dropdown */
     type option = {
         id: string;
+        kind: string;
         data: string[];
         value: number;
         include: boolean;
     };
-    const [dropdown, setDropdown] = useState<option[]>([]);
-
-    useEffect(() => {
-        function dropdowns() {
-            const challCat = new Set<string>();
-            const challTag = new Set<string>();
-
-            const getAll = (challData: DisplayType[]) => {
-                challData.forEach((elm) => {
-                    const cats = getCategories(elm.challenge.challenge_info);
-                    const tags = getTags(elm.challenge.challenge_info);
-                    cats.forEach((cat: string) => challCat.add(cat));
-                    tags.forEach((tag: string) => challTag.add(tag));
-                });
-                return [[...challCat].sort(), [...challTag].sort(), ["active", "inactive"]];
-            };
-            const all = getAll(show);
-
-            const dropdownTable: option[] = [
-                {id: "CATEGORY", data: all[0], value: 0, include: true},
-                {id: "TAG", data: all[1], value: 1, include: true},
-                {id: "CATEGORY", data: all[0], value: 2, include: false},
-                {id: "TAG", data: all[1], value: 3, include: false},
-                {id: "STATUS", data: all[2], value: 4, include: false},
-            ];
-            setDropdown(dropdownTable);
-        }
-        dropdowns();
-    }, [show]);
+    const [facets, setFacets] = useState<string[][]>([[], []]);
+    const dropdown: option[] = [
+        {id: "CATEGORY", kind: "category", data: facets[0], value: 0, include: true},
+        {id: "TAG", kind: "tag", data: facets[1], value: 1, include: true},
+        {id: "CATEGORY", kind: "category", data: facets[0], value: 2, include: false},
+        {id: "TAG", kind: "tag", data: facets[1], value: 3, include: false},
+        {id: "STATUS", kind: "status", data: ["active", "inactive"], value: 4, include: false},
+    ];
 
     /* filtering */
-    function handleChange(checked: boolean, inc: boolean, cat: string) {
+    function handleChange(checked: boolean, inc: boolean, filter: string) {
         if (checked) {
-            inc ? include.add(cat) : exclude.add(cat);
+            inc ? include.add(filter) : exclude.add(filter);
         } else {
-            inc ? include.delete(cat) : exclude.delete(cat);
+            inc ? include.delete(filter) : exclude.delete(filter);
         }
         ApplyFilter();
     }
 
-    function checkCheck(included: boolean, category: string) {
+    function checkCheck(included: boolean, filter: string) {
         if (included) {
-            return include.has(category);
+            return include.has(filter);
         }
-        return exclude.has(category);
+        return exclude.has(filter);
     }
 
     function ApplyFilter() {
-        show.forEach((chall) => {
-            const categories = getCategories(chall.challenge.challenge_info);
-            const tags = getTags(chall.challenge.challenge_info);
-            const all = new Set<string>([...categories, ...tags]);
-            if (isDeployed(chall.challenge.deployment)) {
-                all.add("active");
-            } else {
-                all.add("inactive");
-            }
-
-            let i = true;
-            let e = false;
-            if (include.size !== 0) {
-                const overlap = new Set([...include].filter((x) => all.has(x)));
-                i = overlap.size !== 0;
-            }
-            if (exclude.size !== 0) {
-                const overlap = new Set([...exclude].filter((x) => all.has(x)));
-                e = overlap.size !== 0;
-            }
-
-            if (userInput.length !== 0) {
-                if (!chall.challenge.challenge_info.name.toLowerCase().includes(userInput)) {
-                    chall.display = false;
-                } else if (i && !e) {
-                    chall.display = true;
-                }
-                if (!(i && !e)) {
-                    chall.display = false;
-                }
-            } else {
-                if (i && !e) {
-                    chall.display = true;
-                } else {
-                    chall.display = false;
-                }
-            }
-        });
-        setShow([...show]);
+        setQuery(filterQuery());
     }
 
-    /* load challenges */
+    /* load challenges, filtered by the server */
     useEffect(() => {
         if (accountToken === null) {
             navigate("/login");
-        } else {
-            fetch("/api/challenges", {
+            return;
+        }
+        const controller = new AbortController();
+        /* wait for typing to pause before searching */
+        const timer = setTimeout(() => {
+            fetch("/api/challenges?" + query, {
                 headers: {Authorization: `Bearer ${accountToken}`},
+                signal: controller.signal,
             })
                 .then((res) => res.json())
                 .then((challenges: ChallengesType) => {
                     if (challenges.status === "ok") {
                         setLoadingMsg(null);
-                        setShow(
-                            challenges.challenges.map((chall: ChallengeType) => {
-                                return {challenge: chall, display: true};
-                            })
-                        );
+                        setFacets([challenges.categories, challenges.tags]);
+                        setShow(excludesAll() ? [] : challenges.challenges);
                     } else if (challenges.status === "missing_authorization" || challenges.status === "invalid_token") {
                         navigate("/login");
                     } else {
@@ -220,11 +200,17 @@ const ChallPage = () => {
                     }
                 })
                 .catch((err) => {
-                    setLoadingMsg("An unexpected error occurred");
-                    console.debug(err);
+                    if (!controller.signal.aborted) {
+                        setLoadingMsg("An unexpected error occurred");
+                        console.debug(err);
+                    }
                 });
-        }
-    }, [navigate, accountToken]);
+        }, 150);
+        return () => {
+            clearTimeout(timer);
+            controller.abort();
+        };
+    }, [navigate, accountToken, query]);
 
     /* challenge loading screen */
     const [loadingMsg, setLoadingMsg] = useState<string | null>("Loading Challenges...");
@@ -264,7 +250,7 @@ const ChallPage = () => {
                             {dropdown.map((elm) => {
                                 const val = elm.value;
                                 return (
-                                    <div className="block" key={elm.id}>
+                                    <div className="block" key={val}>
                                         <Title value={val}></Title>
                                         <button
                                             className={expand[val] ? "menu open" : "menu close"}
@@ -292,9 +278,16 @@ const ChallPage = () => {
                                                                 <input
                                                                     type="checkbox"
                                                                     onChange={(e) =>
-                                                                        handleChange(e.target.checked, elm.include, cat)
+                                                                        handleChange(
+                                                                            e.target.checked,
+                                                                            elm.include,
+                                                                            elm.kind + ":" + cat
+                                                                        )
                                                                     }
-                                                                    defaultChecked={checkCheck(elm.include, cat)}
+                                                                    defaultChecked={checkCheck(
+                                                                        elm.include,
+                                                                        elm.kind + ":" + cat
+                                                                    )}
                                                                 ></input>
                                                                 {cat}
                                                             </label>
@@ -317,13 +310,7 @@ const ChallPage = () => {
                 <div className={open ? "cards contract" : "cards full"}>
                     <div>
                         {show.map((chall) => {
-                            if (chall.display) {
-                                return (
-                                    <ChallInfo challProp={chall.challenge} key={chall.challenge.challenge_info.id} />
-                                );
-                            } else {
-                                return null;
-                            }
+                            return <ChallInfo challProp={chall} key={chall.challenge_info.id} />;
                         })}
                     </div>
                 </div>
@@ -0,0 +1,104 @@
+import {ChallengeDeploymentType, DeploymentEventType} from "./types.ts";
+
+/* Subscribe to the server-sent deployment events of a challenge.
+ * fetch is used instead of EventSource because EventSource can't send the Authorization header.
+ * If the API has no room for another stream, the deployment is polled instead and every
+ * change is passed on as a status event.
+ * Returns a function that closes the stream or stops polling. */
+export function subscribeDeploymentEvents(
+    challId: string,
+    accountToken: string,
+    onEvent: (name: string, event: DeploymentEventType) => void
+): () => void {
+    const controller = new AbortController();
+    let retry = 3000;
+    let stopped = false;
+    let polling = false;
+    let etag: string | null = null;
+
+    function handleBlock(block: string) {
+        let name = "message";
+        let data = "";
+        for (const line of block.split("\n")) {
+            if (line.startsWith("event: ")) {
+                name = line.slice(7);
+            } else if (line.startsWith("data: ")) {
+                data += line.slice(6);
+            } else if (line.startsWith("retry: ")) {
+                retry = Number(line.slice(7));
+            }
+        }
+        if (data) {
+            onEvent(name, JSON.parse(data) as DeploymentEventType);
+        }
+    }
+
+    async function readStream(res: Response) {
+        if (res.status === 401 || res.status === 404) {
+            stopped = true;
+            return;
+        }
+        if (res.status === 503) {
+            polling = true;
+            return;
+        }
+        if (!res.ok || res.body === null) {
+            throw new Error("Failed to open deployment event stream");
+        }
+        const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = "";
+        for (;;) {
+            const {value, done} = await reader.read();
+            if (done) return;
+            buffer += value;
+            let end;
+            while ((end = buffer.indexOf("\n\n")) !== -1) {
+                handleBlock(buffer.slice(0, end));
+                buffer = buffer.slice(end + 2);
+            }
+        }
+    }
+
+    async function readDeployment(res: Response) {
+        if (res.status === 401 || res.status === 404) {
+            stopped = true;
+            return;
+        }
+        if (res.status === 304) return;
+        etag = res.headers.get("ETag");
+        const challengeDeployment = (await res.json()) as ChallengeDeploymentType;
+        if (challengeDeployment.status === "ok") {
+            onEvent("status", {deployment: challengeDeployment.deployment});
+        }
+    }
+
+    function next() {
+        if (!stopped && !controller.signal.aborted) {
+            setTimeout(polling ? poll : connect, retry);
+        }
+    }
+
+    function poll() {
+        const headers: Record<string, string> = {Authorization: `Bearer ${accountToken}`};
+        if (etag !== null) {
+            headers["If-None-Match"] = etag;
+        }
+        fetch("/api/challenge/" + challId + "/deployment", {headers, signal: controller.signal})
+            .then(readDeployment)
+            .catch((err) => console.debug(err))
+            .finally(next);
+    }
+
+    function connect() {
+        fetch("/api/challenge/" + challId + "/deployment/events", {
+            headers: {Authorization: `Bearer ${accountToken}`},
+            signal: controller.signal,
+        })
+            .then(readStream)
+            .catch((err) => console.debug(err))
+            .finally(next);
+    }
+
+    connect();
+    return () => controller.abort();
+}
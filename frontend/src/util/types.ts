@@ -1,5 +1,8 @@
 export type ChallengesType = {
     challenges: ChallengeType[];
+    total: number;
+    categories: string[];
+    tags: string[];
     status: string;
 };
 
@@ -10,12 +13,13 @@ export type SingleChallengeType = {
 
 export type ChallengeDeploymentType = {
     deployment: DeploymentType;
+    queue?: QueueType | null;
     status: string;
 };
 
-export type DisplayType = {
-    challenge: ChallengeType;
-    display: boolean;
+export type QueueType = {
+    position: number;
+    eta: number | null;
 };
 
 export type ChallengeType = {
@@ -41,9 +45,19 @@ export type DeploymentType = {
     expiration: number;
     host: string;
     start_delay: number;
+    ready: number | null;
     port_mappings: Record<string, string | number>;
 };
 
+export type DeploymentEventType = {
+    phase?: string;
+    time?: number;
+    position?: number;
+    eta?: number | null;
+    reason?: string;
+    deployment: DeploymentType | null;
+};
+
 export type MessageType = {
     msg: string;
     status: string;